@@ -12,17 +12,46 @@ Options:
      --headers=LIST      Comma separated list of dicom header names to print.
      --oneseries         Only show one series (useful for just exam info)
      --showheaders       Just list all of the headers for each archive
+     --header-cache FILE Cache archive headers in FILE (see datman.headercache)
+     -j,--jobs N         Number of archives to read at once [default: 1]
+     --format FORMAT     Output format: csv, jsonl, parquet or feather
+                         [default: csv]
+     -o,--output FILE    Write to FILE rather than to standard output (needed
+                         for the parquet and feather formats)
+
+DETAILS
+    The manifest has a row for each series, with the archive path and the
+    dicom headers given by --headers. Only these headers are read from each
+    archive (unless --header-cache is given, since the cache keeps them all).
+
+    Rows are written out as each archive is read, so that the manifest of a
+    large number of archives isn't held in memory. Archives are listed in the
+    order given, even when they are read in parallel (--jobs).
+
+    The jsonl format writes one JSON object per line. The parquet and feather
+    formats need pyarrow; parquet is written out in row groups as archives are
+    read, whereas feather can only be written once every archive has been
+    read.
+
+    Archives that can't be read are reported on standard error and left out
+    of the manifest, and archive-manifest.py then exits with status 1.
 """
 
 import datman
 import datman.utils
-import dicom
-import tarfile
-import zipfile
-import io
+import datman.headercache
+import csv
+import json
 import os.path
-import StringIO
 import pandas as pd
+import sys
+from collections import OrderedDict
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
 default_headers=[
     'StudyDescription', 
@@ -31,15 +60,27 @@ default_headers=[
     'SeriesNumber',
     'SeriesDescription']
 
+FORMATS = ('csv', 'jsonl', 'parquet', 'feather')
+
+# number of rows per parquet row group
+ROW_GROUP_SIZE = 10000
+
 def main(): 
     from docopt import docopt
-    import sys
     arguments = docopt(__doc__)
+    fmt    = arguments['--format']
+    output = arguments['--output']
+
+    get_archive_headers = datman.utils.get_archive_headers
+    get_archive_headers_many = datman.utils.get_archive_headers_many
+    if arguments['--header-cache']:
+        cache = datman.headercache.HeaderCache(arguments['--header-cache'])
+        get_archive_headers = cache.get_archive_headers
+        get_archive_headers_many = cache.get_archive_headers_many
 
     if arguments['--showheaders']:
         for archive in arguments['<archive>']:
-            manifest = datman.utils.get_archive_headers(archive, 
-                                                        stop_after_first=False)
+            manifest = get_archive_headers(archive, stop_after_first=False)
             filepath, headers = manifest.items()[0] 
             print ",".join([archive,filepath])
             print "\t"+"\n\t".join(headers.dir())
@@ -47,21 +88,165 @@ def main():
         
     headers = arguments['--headers'] and arguments['--headers'].split(',') or \
                 default_headers[:]
-    headers.insert(0,"Path")
 
+    if fmt not in FORMATS:
+        sys.exit("ERROR: Unknown format {}. Expected one of: {}".format(
+            fmt, ", ".join(FORMATS)))
+    if fmt in ('parquet', 'feather') and not output:
+        sys.exit("ERROR: --output is needed for the {} format".format(fmt))
+    if fmt in ('parquet', 'feather') and not pyarrow:
+        sys.exit("ERROR: pyarrow is needed for the {} format".format(fmt))
+
+    # only read the headers asked for (and SeriesNumber, to sort by)
+    kwargs = {}
+    if not arguments['--header-cache']:
+        try:
+            datman.utils.header_tags(headers)
+        except ValueError, e:
+            sys.exit("ERROR: {}".format(e))
+        kwargs['tags'] = headers + ['SeriesNumber']
+
+    results = get_archive_headers_many(arguments['<archive>'],
+            workers=int(arguments['--jobs']), **kwargs)
+
+    failed = 0
+    writer = WRITERS[fmt](output or sys.stdout, ["Path"] + headers)
+    try:
+        for archive, manifest, err in in_order(results, arguments['<archive>']):
+            if err:
+                sys.stderr.write("ERROR: {}: {}\n".format(archive, err))
+                failed += 1
+                continue
+            for row in get_rows(manifest, headers, arguments['--oneseries']):
+                writer.write(row)
+    finally:
+        writer.close()
+
+    if failed:
+        sys.exit("ERROR: {} of {} archives couldn't be read".format(
+            failed, len(arguments['<archive>'])))
+
+def in_order(results, archives):
+    """
+    Yields the (archive, manifest, error) results of reading archives (see
+    datman.utils.get_archive_headers_many) in the order of <archives>, as
+    soon as the results for all the archives before each one are in.
+    """
+    waiting = {}
+    archives = iter(archives)
+    expected = next(archives, None)
+    for result in results:
+        waiting[result[0]] = result
+        while expected in waiting:
+            yield waiting.pop(expected)
+            expected = next(archives, None)
+    for result in waiting.values():   # duplicate or unexpected archives
+        yield result
+
+def get_rows(manifest, headers, oneseries=False):
+    """
+    Returns the manifest rows for an archive: a list of dictionaries of the
+    Path and the given headers for each series, in series number order.
+    """
     rows = []
-    for archive in arguments['<archive>']:
-        manifest = datman.utils.get_archive_headers(archive)
-        sortedseries = sorted(manifest.iteritems(), 
-                              key = lambda x: x[1].get('SeriesNumber'))
-        for path, dataset in sortedseries:
-            row = dict([(header,dataset.get(header,"")) for header in headers])
-            row['Path'] = path 
-            rows.append(row)
-            if arguments['--oneseries']: break 
-    
-    data = pd.DataFrame(rows)
-    print data.to_csv(index=False)
+    sortedseries = sorted(manifest.iteritems(), 
+                          key = lambda x: x[1].get('SeriesNumber'))
+    for path, dataset in sortedseries:
+        row = OrderedDict([("Path", path)])
+        for header in headers:
+            row[header] = to_text(dataset.get(header, ""))
+        rows.append(row)
+        if oneseries: break 
+    return rows
+
+def to_text(value):
+    """Returns a header value as a (utf-8 encoded) string"""
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+class CSVWriter(object):
+
+    def __init__(self, output, columns):
+        self.stream = open_output(output)
+        self.writer = csv.writer(self.stream)
+        self.writer.writerow(columns)
+
+    def write(self, row):
+        self.writer.writerow(row.values())
+
+    def close(self):
+        close_output(self.stream)
+
+class JSONLinesWriter(object):
+
+    def __init__(self, output, columns):
+        self.stream = open_output(output)
+
+    def write(self, row):
+        self.stream.write(json.dumps(row) + "\n")
+
+    def close(self):
+        close_output(self.stream)
+
+class ParquetWriter(object):
+    """Writes rows to a parquet file, ROW_GROUP_SIZE rows at a time"""
+
+    def __init__(self, output, columns):
+        self.columns = columns
+        self.schema = pyarrow.schema([pyarrow.field(c, pyarrow.string())
+                                      for c in columns])
+        self.writer = pyarrow.parquet.ParquetWriter(output, self.schema)
+        self.rows = []
+
+    def write(self, row):
+        self.rows.append(row.values())
+        if len(self.rows) >= ROW_GROUP_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        arrays = [pyarrow.array(list(values), type=pyarrow.string())
+                  for values in zip(*self.rows)]
+        self.writer.write_table(pyarrow.Table.from_arrays(arrays,
+                                                          names=self.columns))
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+class FeatherWriter(object):
+    """Writes rows to a feather file (all at once, when closed)"""
+
+    def __init__(self, output, columns):
+        self.output = output
+        self.columns = columns
+        self.rows = []
+
+    def write(self, row):
+        self.rows.append(row.values())
+
+    def close(self):
+        data = pd.DataFrame(self.rows, columns=self.columns)
+        data.to_feather(self.output)
+
+WRITERS = { 'csv'     : CSVWriter,
+            'jsonl'   : JSONLinesWriter,
+            'parquet' : ParquetWriter,
+            'feather' : FeatherWriter }
+
+def open_output(output):
+    if isinstance(output, basestring):
+        return open(output, 'wb')
+    return output
+
+def close_output(stream):
+    if stream is sys.stdout:
+        stream.flush()
+    else:
+        stream.close()
 
 if __name__ == '__main__': 
     main()
@@ -11,7 +11,7 @@ Arguments:
 
     <logdir/>               Folder to contain the outputs (specific errors found)
                             of this script. A log file is created in this
-                            folder for each exam, named: dm-check-headers-<examdir>.log
+                            folder for each exam, named: dm-check-bvecs-<examdir>.log
 
     <examsdir/>             Folder with subfolder for each exam to check. Each
                             exam directory should have export nifti series,
@@ -21,49 +21,254 @@ Options:
     --filter TEXT           A string to filter exams by (ex. site name). All
                             exam folders found in <examsdir/> must have this
                             text in their name.
-    --verbose               Print mismatches to stdout as well as the log file
+    --angle-tolerance DEG   How far (in degrees) each gradient direction may be
+                            from the gold standard [default: 1]
+    --bval-tolerance N      How far each b-value may be from the gold standard
+                            [default: 5]
+    -j,--jobs N             Number of exams to check at once [default: 1]
+    --verbose               Print a summary of the mismatches in each file to
+                            stdout
+
+DETAILS
+    Gradient directions and b-values are compared as numbers, so differences
+    in how the numbers are written (e.g. 1000 vs. 1000.0) don't count. Each
+    direction is compared by the angle between it and the gold standard
+    direction, so its length (which some scanners scale by the b-value) doesn't
+    matter either.
+
+    The log file for an exam lists each direction or b-value that differs (or
+    that there is a different number of volumes) for each file.
 """
 
 from docopt import docopt
+import collections
 import datman as dm
-import difflib
+import datman.scanid
 import glob
 import logging as log
+import multiprocessing
+import numpy as np
 import os
-import pprint
-import re
 import sys
 
-def diff_files(examdir, standardsdir):
-     
+EXTS = ('bvec', 'bval')
+
+# default tolerances: how far (in degrees) each gradient direction may be from
+# the gold standard, and how far (in s/mm^2) each b-value may be
+ANGLE_TOLERANCE = 1.0
+BVAL_TOLERANCE = 5.0
+
+# a difference between an exam's bvec/bval file and the gold standard.
+#   kind      'unreadable', 'count', 'direction' or 'bval'
+#   index     the volume the difference is in (None for a whole file)
+#   expected  the gold standard value (number of volumes, vector or b-value)
+#   actual    the value found
+#   error     the size of the difference (in degrees, for directions)
+Difference = collections.namedtuple(
+    'Difference', ['kind', 'index', 'expected', 'actual', 'error'])
+
+# gold standards for each tag, {tag: {ext: [(path, values)]}}, used by
+# check_exam (set before starting any workers, so that they inherit it)
+GOLD = None
+
+def load_values(path, ext):
+    """
+    Reads a bvec or bval file into an array: 3 x N for bvecs (in FSL format,
+    although N x 3 bvecs are transposed) and a vector of N values for bvals.
+
+    Raises ValueError if the file is not a table of numbers.
+    """
+    values = np.loadtxt(path, dtype=float, ndmin=2)
+    if ext == 'bval':
+        return values.ravel()
+    if values.shape[0] != 3 and values.shape[1] == 3:
+        values = values.T
+    if values.shape[0] != 3:
+        raise ValueError("Expected 3 rows of gradient directions, found {}"
+                         .format(values.shape[0]))
+    return values
+
+def load_gold_standards(standardsdir):
+    """
+    Reads the gold standard bvec/bval files, which are named by tag (i.e. in
+    <standardsdir>/<tag>/*.bvec).
+
+    Returns {tag: {ext: [(path, values)]}}, where values is None if the file
+    can't be read.
+    """
+    gold = {}
+    for ext in EXTS:
+        for path in sorted(glob.glob("{}/*/*.{}".format(standardsdir, ext))):
+            tag = os.path.basename(os.path.dirname(path))
+            try:
+                values = load_values(path, ext)
+            except ValueError, e:
+                log.error('Cannot read gold standard {}: {}'.format(path, e))
+                values = None
+            gold.setdefault(tag, {}).setdefault(ext, []).append((path, values))
+    return gold
+
+def compare_bvecs(expected, actual, angle_tolerance=ANGLE_TOLERANCE):
+    """
+    Compares gradient directions (3 x N arrays), returning a list of a
+    Difference for each direction more than <angle_tolerance> degrees from the
+    gold standard (or that is zero where the gold standard isn't, or vice
+    versa).
+    """
+    if expected.shape != actual.shape:
+        return [Difference('count', None, expected.shape[1], actual.shape[1],
+                           None)]
+
+    expected_norms = np.sqrt((expected ** 2).sum(axis=0))
+    actual_norms = np.sqrt((actual ** 2).sum(axis=0))
+    expected_zero = expected_norms < 1e-6
+    actual_zero = actual_norms < 1e-6
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cosines = (expected * actual).sum(axis=0) / (expected_norms *
+                                                     actual_norms)
+    angles = np.degrees(np.arccos(np.clip(cosines, -1, 1)))
+    angles[expected_zero & actual_zero] = 0
+    angles[expected_zero != actual_zero] = np.inf
+
+    return [Difference('direction', int(i), tuple(expected[:, i].tolist()),
+                       tuple(actual[:, i].tolist()), float(angles[i]))
+            for i in np.flatnonzero(angles > angle_tolerance)]
+
+def compare_bvals(expected, actual, bval_tolerance=BVAL_TOLERANCE):
+    """
+    Compares b-values, returning a list of a Difference for each b-value more
+    than <bval_tolerance> from the gold standard.
+    """
+    if expected.shape != actual.shape:
+        return [Difference('count', None, len(expected), len(actual), None)]
+
+    errors = np.abs(expected - actual)
+    return [Difference('bval', int(i), float(expected[i]), float(actual[i]),
+                       float(errors[i]))
+            for i in np.flatnonzero(errors > bval_tolerance)]
+
+def diff_files(examdir, standardsdir, gold=None,
+               angle_tolerance=ANGLE_TOLERANCE, bval_tolerance=BVAL_TOLERANCE):
+    """
+    Compares the bvec and bval files in an exam against the gold standards.
+
+    <gold> is the gold standards read from <standardsdir> (see
+    load_gold_standards), which are read if not given. Read them once to
+    check many exams.
+
+    Returns a map from each file that differs from its gold standard to the
+    list of differences (as Difference objects).
+    """
+    if gold is None:
+        gold = load_gold_standards(standardsdir)
+
     diffs = {}  # map from file to diff against gold standard
-    for ext in ['bvec','bval']:
-        for test in glob.glob(examdir+'/*.'+ext):
+    for ext in EXTS:
+        for test in sorted(glob.glob(examdir+'/*.'+ext)):
             tag = dm.scanid.parse_filename(os.path.basename(test))[1]
-            gold = glob.glob("{}/{}/*.{}".format(standardsdir, tag, ext))
-            
-            if len(gold) > 1:
+            standards = gold.get(tag, {}).get(ext, [])
+
+            if len(standards) > 1:
                 log.error('More than one gold standard .{} file for tag {}'.format(ext, tag))
                 continue
-            
-            if len(gold) == 0:
+
+            if len(standards) == 0:
                 log.error('No gold standard .{} file for tag {}'.format(ext, tag))
                 continue
 
-            diff = difflib.ndiff(open(test).readlines(), open(gold[0]).readlines())
-            changes = [l for l in diff if l.startswith('+ ') or l.startswith('- ')]
+            expected = standards[0][1]
+            if expected is None:
+                continue
+
+            try:
+                actual = load_values(test, ext)
+            except ValueError, e:
+                diffs[test] = [Difference('unreadable', None, None, None,
+                                          str(e))]
+                continue
+
+            if ext == 'bvec':
+                changes = compare_bvecs(expected, actual, angle_tolerance)
+            else:
+                changes = compare_bvals(expected, actual, bval_tolerance)
+
+            if changes:
+                diffs[test] = changes
+
+    return diffs
 
-            if changes: 
-                diffs[test] = ''.join(changes)
+def describe(difference):
+    """Returns a one line description of a Difference"""
+    kind, index, expected, actual, error = difference
+    if kind == 'unreadable':
+        return "cannot read file: {}".format(error)
+    if kind == 'count':
+        return "{} volumes, expected {}".format(actual, expected)
+    if kind == 'direction':
+        return "direction {}: expected ({}), actual ({}) [{:.2f} degrees]".format(
+            index, format_vector(expected), format_vector(actual), error)
+    return "b-value {}: expected {:g}, actual {:g}".format(
+        index, expected, actual)
 
-    return diffs 
+def format_vector(vector):
+    return " ".join("{:g}".format(v) for v in vector)
+
+def summarize(differences):
+    """Returns a one line summary of the differences found in a file"""
+    kinds = collections.Counter(d.kind for d in differences)
+    if kinds['direction']:
+        largest = max(d.error for d in differences if d.kind == 'direction')
+        return "{} directions differ (by up to {:.2f} degrees)".format(
+            kinds['direction'], largest)
+    if kinds['bval']:
+        largest = max(d.error for d in differences if d.kind == 'bval')
+        return "{} b-values differ (by up to {:g})".format(
+            kinds['bval'], largest)
+    return describe(differences[0])
+
+def check_exam(args):
+    """
+    Calls diff_files for an exam against the gold standards in GOLD, and
+    returns (examdir, diffs).
+    """
+    examdir, angle_tolerance, bval_tolerance = args
+    return examdir, diff_files(examdir, None, GOLD, angle_tolerance,
+                               bval_tolerance)
+
+def check_exams(examdirs, jobs=1, angle_tolerance=ANGLE_TOLERANCE,
+                bval_tolerance=BVAL_TOLERANCE):
+    """
+    Checks exams against the gold standards in GOLD, <jobs> exams at once.
+
+    Yields (examdir, diffs) for each exam as it is checked (see diff_files),
+    not necessarily in the order given.
+    """
+    args = [(examdir, angle_tolerance, bval_tolerance) for examdir in examdirs]
+    if jobs <= 1:
+        for arg in args:
+            yield check_exam(arg)
+        return
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for result in pool.imap_unordered(check_exam, args):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
 
 def main():
+    global GOLD
     arguments = docopt(__doc__)
     standardsdir = arguments['<standards/>']
     logsdir = arguments['<logdir/>']
     examsdir = arguments['<examsdir/>']
     filtertext = arguments['--filter']
+    angle_tolerance = float(arguments['--angle-tolerance'])
+    bval_tolerance = float(arguments['--bval-tolerance'])
+    jobs = int(arguments['--jobs'])
     verbose = arguments['--verbose']
 
     log.basicConfig(
@@ -82,16 +287,18 @@ def main():
         log.error('Exams directory {} does not exist'.format(examsdir))
         sys.exit(1)
 
+    GOLD = load_gold_standards(standardsdir)
+
     globexpr = '*'
     if filtertext: 
         globexpr = '*{}*'.format(filtertext)
 
-    for examdir in glob.glob('{}/{}/'.format(examsdir,globexpr)):
-        if '_PHA_' in examdir:  # ignore phantoms
-            continue
-
-        diffs = diff_files(examdir, standardsdir)
+    examdirs = [examdir for examdir in
+                sorted(glob.glob('{}/{}/'.format(examsdir,globexpr)))
+                if '_PHA_' not in examdir]  # ignore phantoms
 
+    for examdir, diffs in check_exams(examdirs, jobs, angle_tolerance,
+                                      bval_tolerance):
         if not diffs: 
             continue
 
@@ -101,12 +308,11 @@ def main():
         if not os.path.exists(logfile):  # display warning on first encounter
             log.warn('{} mismatches for exam {}'.format(len(diffs), examdir))
 
-        fname = open(logfile, "w")
-
-        for path, diff in diffs.iteritems():
-            message = re.sub('^',path+": ", diff.strip(), flags=re.MULTILINE)
-            log.info(message)
-            fname.write(message + "\n")
+        with open(logfile, "w") as fname:
+            for path, differences in sorted(diffs.iteritems()):
+                log.info("{}: {}".format(path, summarize(differences)))
+                for difference in differences:
+                    fname.write("{}: {}\n".format(path, describe(difference)))
 
 if __name__ == '__main__':
     main()
@@ -11,8 +11,11 @@ Arguments:
                             has a sample gold standard dicom file for that tag.
 
     <logdir/>               Folder to contain the outputs (specific errors found)
-                            of this script. A log file is created in this
-                            folder for each exam, named: dm-check-headers-<examdir>.log
+                            of this script. The mismatches found are stored in
+                            dm-check-headers.db in this folder (see
+                            datman.headerchecks). Unless --no-text-logs is
+                            given, a log file is also created in this folder
+                            for each exam, named: dm-check-headers-<examdir>.log
 
     <examsdir/>             Folder with subfolder for each exam to check. Each
                             exam directory should have one dicom file sample
@@ -23,7 +26,17 @@ Options:
                             exam folders found in <examsdir/> must have this
                             text in their name.
     --ignore-headers LIST   Comma delimited list of headers to ignore
+    -j,--jobs N             Number of exams to check at once [default: 1]
+    --cache FILE            Remember the exams checked in FILE, and skip them
+                            on later runs unless they have changed
+    --no-text-logs          Only record mismatches in dm-check-headers.db,
+                            and don't write a log file for each exam
     --verbose               Print mismatches to stdout as well as the log file
+
+RESULTS CACHE
+    With --cache, an exam is only checked again if its files have changed
+    (see datman.utils.fingerprint) or the check itself has: i.e. a gold
+    standard has changed, or a different set of headers is ignored.
 """
 
 import sys
@@ -32,9 +45,14 @@ from docopt import docopt
 import dicom as dcm
 import datman as dm
 import glob
+import hashlib
+import json
 import logging as log
+import multiprocessing
 import numpy as np
+import datman.headerchecks
 import datman.utils
+import os
 import os.path
 
 DEFAULT_IGNORED_HEADERS = set([
@@ -141,6 +159,17 @@ DEFAULT_TOLERANCES = Tolerances(
     integer=INTEGER_TOLERANCES,
     decimal=DECIMAL_TOLERANCES)
 
+# tolerance types
+INTEGER = 'integer'
+DECIMAL = 'decimal'
+
+# dicom tag -> header names, looked up as needed (see header_names)
+TAG_NAMES = {}
+
+# tag -> ComparisonPlan used by check_exam (set before starting any workers,
+# so that they inherit the plans rather than having them pickled)
+PLANS = None
+
 
 def get_gold_standard_headers(path):
     """Fetches the gold standard headers.
@@ -156,74 +185,130 @@ def get_gold_standard_headers(path):
     return map
 
 
-def compare_headers(stdhdr, cmphdr, tolerances=None, ignore_headers=None):
+class ComparisonPlan(object):
     """
-    Accepts two pydicom objects and prints out header value differences.
-
-    Headers in ignore set are ignored.
+    The comparisons to make against a gold standard header.
 
-    Returns a tuple containing a list of mismatched headers (as a list of
-    Mismatch objects)
+    The plan is worked out once for each gold standard: the ignored headers
+    are left out, and the gold standard values are extracted (and rounded,
+    for headers with a tolerance) up front, so that comparing a header
+    against it only has to look up the headers in the plan.
     """
 
-    tolerances = tolerances or DEFAULT_TOLERANCES
-    ignore_headers = ignore_headers or []
+    def __init__(self, stdhdr, tolerances=None, ignore_headers=None):
+        tolerances = tolerances or DEFAULT_TOLERANCES
+        self.ignore_headers = frozenset(ignore_headers or [])
+
+        # (header, gold standard value, tolerance type, expected, tolerance)
+        self.checks = []
+        for header in header_names(stdhdr) - self.ignore_headers:
+            stdval = stdhdr.get(header)
 
-    # dir() is expensive so we cache results here
-    stdhdr_names = stdhdr.dir()
-    cmphdr_names = cmphdr.dir()
+            # integer level tolerance
+            if header in tolerances.integer:
+                n = tolerances.integer[header]
+                self.checks.append(
+                    (header, stdval, INTEGER, np.round(float(stdval)), n))
 
-    # get the unignored headers
-    headers = set(stdhdr_names).union(cmphdr_names).difference(ignore_headers)
+            # decimal level tolerance
+            elif header in tolerances.decimal:
+                n = tolerances.decimal[header]
+                self.checks.append(
+                    (header, stdval, DECIMAL, round(float(stdval), n), n))
 
-    mismatches = []  # list of Mismatches
+            # no tolerance set
+            else:
+                self.checks.append((header, stdval, None, str(stdval), None))
 
-    for header in headers:
-        if header not in stdhdr_names:
+        self.headers = frozenset(check[0] for check in self.checks)
+
+    def compare(self, cmphdr):
+        """
+        Compares a header against the plan, returning a list of Mismatch
+        objects.
+        """
+        cmphdr_names = header_names(cmphdr)
+
+        mismatches = []  # list of Mismatches
+
+        for header in cmphdr_names - self.headers - self.ignore_headers:
             mismatches.append(Mismatch(
                 header=header, expected=None, actual=cmphdr.get(header), tolerance=None))
-            continue
 
-        if header not in cmphdr_names:
-            mismatches.append(Mismatch(
-                header=header, expected=stdhdr.get(header), actual=None, tolerance=None))
-            continue
+        for header, stdval, kind, expected, n in self.checks:
+            if header not in cmphdr_names:
+                mismatches.append(Mismatch(
+                    header=header, expected=stdval, actual=None, tolerance=None))
+                continue
 
-        stdval = stdhdr.get(header)
-        cmpval = cmphdr.get(header)
+            cmpval = cmphdr.get(header)
 
-        # integer level tolerance
-        if header in tolerances.integer:
-            n = tolerances.integer[header]
+            if kind == INTEGER:
+                cmpval_rounded = np.round(float(cmpval))
+                if np.abs(expected - cmpval_rounded) > n:
+                    mismatches.append(Mismatch(
+                        header=header, expected=expected, actual=cmpval_rounded, tolerance=n))
 
-            stdval_rounded = np.round(float(stdval))
-            cmpval_rounded = np.round(float(cmpval))
-            difference = np.abs(stdval_rounded - cmpval_rounded)
+            elif kind == DECIMAL:
+                cmpval_rounded = round(float(cmpval), n)
+                if cmpval_rounded != expected:
+                    mismatches.append(Mismatch(
+                        header=header, expected=expected, actual=cmpval_rounded, tolerance=n))
 
-            if difference > n:
+            elif str(cmpval) != expected:
                 mismatches.append(Mismatch(
-                    header=header, expected=stdval_rounded, actual=cmpval_rounded, tolerance=n))
+                    header=header, expected=stdval, actual=cmpval, tolerance=None))
 
-        # decimal level tolerance
-        elif header in tolerances.decimal:
-            n = tolerances.decimal[header]
+        return mismatches
 
-            stdval_rounded = round(float(stdval), n)
-            cmpval_rounded = round(float(cmpval), n)
 
-            if stdval_rounded != cmpval_rounded:
-                mismatches.append(Mismatch(
-                    header=header, expected=stdval_rounded, actual=cmpval_rounded, tolerance=n))
+def header_names(header):
+    """
+    Returns the set of header names in a pydicom dataset (or in any other
+    object with a dir() method listing its headers).
 
-        # no tolerance set
-        elif str(cmpval) != str(stdval):
-            mismatches.append(Mismatch(
-                header=header, expected=stdval, actual=cmpval, tolerance=None))
+    Unlike dataset.dir(), the names of each dicom tag are only looked up in
+    the dicom dictionary once, and the names aren't sorted.
+    """
+    if not isinstance(header, dcm.dataset.Dataset):
+        return set(header.dir())
+
+    names = set()
+    for tag in header.keys():
+        tag_names = TAG_NAMES.get(tag)
+        if tag_names is None:
+            tag_names = TAG_NAMES[tag] = [name for name in
+                                          dcm.datadict.all_names_for_tag(tag)
+                                          if name]
+        names.update(tag_names)
+    return names
+
+
+def compare_headers(stdhdr, cmphdr, tolerances=None, ignore_headers=None):
+    """
+    Accepts two pydicom objects and prints out header value differences.
+
+    Headers in ignore set are ignored.
 
-    return mismatches
+    Returns a tuple containing a list of mismatched headers (as a list of
+    Mismatch objects)
+    """
+    return ComparisonPlan(stdhdr, tolerances, ignore_headers).compare(cmphdr)
+
+
+def make_plans(stdmap, ignore_headers, tolerances=None):
+    """
+    Makes a ComparisonPlan for each gold standard.
+
+    <stdmap> is a map from tag -> (path, headers) of the gold standards (see
+    get_gold_standard_headers). Returns a map from tag -> ComparisonPlan.
+    """
+    return {tag: ComparisonPlan(stdhdr, tolerances, ignore_headers)
+            for tag, (stdpath, stdhdr) in stdmap.items()}
 
 
-def compare_exam_headers(stdmap, examdir, ignore_headers, tolerances=None):
+def compare_exam_headers(stdmap, examdir, ignore_headers, tolerances=None,
+                         plans=None):
     """
     Compares headers for each series in an exam against gold standards
 
@@ -231,21 +316,28 @@ def compare_exam_headers(stdmap, examdir, ignore_headers, tolerances=None):
     standard headers to compare against.
 
     <ignore_headers> is a list of headers to ignore.
+
+    <plans> are the comparison plans for the gold standards (see make_plans),
+    which are made from <stdmap> if not given. Make them once to check many
+    exams against the same gold standards.
     """
+    if plans is None:
+        plans = make_plans(stdmap, ignore_headers, tolerances)
+
+    # the headers are read up to the pixel data, but only the values of the
+    # headers compared are decoded
     exam_headers = dm.utils.get_all_headers_in_folder(examdir)
 
     all_mismatches = {}
     for cmppath, cmphdr in exam_headers.iteritems():
         ident, tag, series, description = dm.scanid.parse_filename(cmppath)
 
-        if tag not in stdmap:
+        if tag not in plans:
             log.warning(
                 "{}: No matching standard for tag '{}'".format(cmppath, tag))
             continue
 
-        stdpath, stdhdr = stdmap[tag]
-        mismatches = compare_headers(
-            stdhdr, cmphdr, tolerances, ignore_headers)
+        mismatches = plans[tag].compare(cmphdr)
         if mismatches:
             all_mismatches[cmppath] = mismatches
 
@@ -260,6 +352,9 @@ def main():
     verbose = arguments['--verbose']
     filtertext = arguments['--filter']
     ignore_headers = arguments['--ignore-headers']
+    jobs = int(arguments['--jobs'])
+    cachefile = arguments['--cache']
+    text_logs = not arguments['--no-text-logs']
 
     log.basicConfig(
         level=log.WARN, format="[dm-check-headers] %(levelname)s: %(message)s")
@@ -281,32 +376,153 @@ def main():
     ignore_headers = DEFAULT_IGNORED_HEADERS.union(ignore_headers)
 
     stdmap = get_gold_standard_headers(standardsdir)
+    settings = get_settings(stdmap, ignore_headers)
+
+    global PLANS
+    PLANS = make_plans(stdmap, ignore_headers)
 
     globexpr = '*'
     if filtertext:
         globexpr = '*{}*'.format(filtertext)
 
+    cache = read_cache(cachefile)
+    examdirs = {}  # examdir -> fingerprint
     for examdir in glob.glob('{}/{}/'.format(examsdir,globexpr)):
         if '_PHA_' in examdir:  # ignore phantoms
             continue
 
-        logfile = os.path.join(logsdir, "dm-check-headers-{}.log".format(
-            os.path.basename(os.path.normpath(examdir))))
-
-        all_mismatches = compare_exam_headers(stdmap, examdir, ignore_headers)
-        if not all_mismatches:
+        key = os.path.abspath(examdir)
+        fingerprint = dm.utils.fingerprint(examdir)
+        if cache.get(key) == [fingerprint, settings]:
+            log.debug('{} unchanged since last checked. Skipping.'.format(
+                examdir))
             continue
+        examdirs[examdir] = fingerprint
+
+    store = dm.headerchecks.MismatchStore(
+        os.path.join(logsdir, dm.headerchecks.STORE_NAME))
+    try:
+        for examdir, all_mismatches in check_exams(sorted(examdirs), jobs):
+            record_mismatches(store, logsdir, examdir, all_mismatches,
+                              text_logs)
+            cache[os.path.abspath(examdir)] = [examdirs[examdir], settings]
+    finally:
+        store.close()
+        if cachefile:
+            write_cache(cachefile, cache)
+
+
+def check_exams(examdirs, jobs=1):
+    """
+    Checks exams against the gold standards in PLANS, <jobs> exams at once.
 
-        if not os.path.exists(logfile):  # display warning on first encounter
-            log.warn('{} mismatches for exam {}'.format(len(all_mismatches), examdir))
+    Yields (examdir, mismatches) for each exam as it is checked (see
+    check_exam), not necessarily in the order given.
+    """
+    if jobs <= 1:
+        for examdir in examdirs:
+            yield check_exam(examdir)
+        return
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for result in pool.imap_unordered(check_exam, examdirs):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def check_exam(examdir):
+    """
+    Checks an exam against the gold standards in PLANS.
 
+    Returns (examdir, mismatches), where mismatches maps the path of each
+    file with mismatched headers to a list of Mismatch objects. Multi-valued
+    headers are given as lists (so that the mismatches can be pickled).
+    """
+    all_mismatches = compare_exam_headers(None, examdir, None, plans=PLANS)
+    for path, mismatches in all_mismatches.items():
+        all_mismatches[path] = [m._replace(expected=to_list(m.expected),
+                                           actual=to_list(m.actual))
+                                for m in mismatches]
+    return examdir, all_mismatches
+
+
+def to_list(value):
+    """Converts a pydicom multi-valued header value to a list"""
+    if isinstance(value, dcm.multival.MultiValue):
+        return list(value)
+    return value
+
+
+def record_mismatches(store, logsdir, examdir, all_mismatches,
+                      text_logs=True):
+    """
+    Records the mismatches found in an exam in the mismatch store (see
+    datman.headerchecks), replacing any found before, and writes them to the
+    exam's log file if <text_logs> is set.
+    """
+    exam = os.path.basename(os.path.normpath(examdir))
+    first_encounter = not store.get_exam(exam)
+    store.update_exam(exam, all_mismatches)
+    if not all_mismatches:
+        return
+
+    if first_encounter:  # display warning on first encounter
+        log.warn('{} mismatches for exam {}'.format(len(all_mismatches), examdir))
+
+    messages = []
+    for path, mismatches in all_mismatches.iteritems():
+        for m in mismatches:
+            message = "{}: {}".format(path, dm.headerchecks.describe(m))
+            log.info(message)
+            messages.append(message + "\n")
+
+    if text_logs:
+        logfile = os.path.join(logsdir, dm.headerchecks.LOG_PREFIX + exam +
+                               dm.headerchecks.LOG_EXT)
         with open(logfile, "w") as fname:
-            for path, mismatches in all_mismatches.iteritems():
-                for m in mismatches:
-                    message = "{}: header {}, expected = {}, actual = {} [tolerance = {}]".format(
-                        path, m.header, m.expected, m.actual, m.tolerance)
-                    log.info(message)
-                    fname.write(message + "\n")
+            fname.writelines(messages)
+
+
+def get_settings(stdmap, ignore_headers, tolerances=None):
+    """
+    Returns a hash of everything (besides the exam itself) that decides the
+    outcome of checking an exam: the gold standard files, the ignored headers
+    and the tolerances.
+    """
+    tolerances = tolerances or DEFAULT_TOLERANCES
+    standards = sorted((tag, dm.utils.fingerprint(path))
+                       for tag, (path, headers) in stdmap.items())
+    settings = json.dumps([standards, sorted(ignore_headers),
+                           sorted(tolerances.integer.items()),
+                           sorted(tolerances.decimal.items())])
+    return hashlib.md5(settings).hexdigest()
+
+
+def read_cache(cachefile):
+    """
+    Reads the results cache: a map from the absolute path of each exam
+    checked to [fingerprint, settings] (see get_settings) when it was checked.
+    """
+    if not cachefile or not os.path.exists(cachefile):
+        return {}
+    try:
+        with open(cachefile) as stream:
+            return json.load(stream)
+    except ValueError, e:
+        log.warn('Ignoring unreadable cache {}: {}'.format(cachefile, e))
+        return {}
+
+
+def write_cache(cachefile, cache):
+    """Writes out the results cache (atomically)"""
+    tmpfile = cachefile + '.tmp'
+    with open(tmpfile, 'w') as stream:
+        json.dump(cache, stream, indent=1, sort_keys=True)
+    os.rename(tmpfile, cachefile)
 
 if __name__ == '__main__':
     main()
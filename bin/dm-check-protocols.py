@@ -23,21 +23,13 @@ DETAILS
     of that tag to the user.
 """
 
-import os
-import pandas as pd
+import sys
 import datman as dm
+import datman.exportinfo
+import datman.protocols
+import datman.utils
 from docopt import docopt
 
-def check_protocol_length(data, expected):
-    if len(data) != expected:
-        raise ValueError
-
-def find_niftis_with_tag(datadir, tag):
-    files = dm.utils.get_files_with_tag(datadir, tag)
-    files = filter(lambda x: '.nii.gz' in x, files)
-
-    return files
-
 def main():
 
     arguments       = docopt(__doc__)
@@ -49,54 +41,27 @@ def main():
     subjects = filter(lambda x: '_PHA_' not in x, subjects)
 
     # import data, get dimensions
-    data = pd.read_csv(exportinfo, skipinitialspace=True, delimiter=' ')
-    n_protocols = len(data['count'][0].split(','))
-    tags = list(data['tag'])
-
+    table = dm.exportinfo.load(exportinfo).table
     try:
-        tags.remove('?') # removed ignored series from the list if they are defined
-    except:
-        pass
-
-    tags_expected = {}
-    tags_found = {}
-
-    for i, tag in enumerate(tags):
-        try:
-            check_protocol_length(data['count'][i].split(','), n_protocols)
-            tags_expected[tag] = data['count'][i].split(',')
-        except:
-            print('ERROR: {} has the wrong number of protocols defined for {}.'.format(input_file, tags[tag]))
-            sys.exit()
-
-    # loop through subjects, reporting 
+        expected = dm.protocols.expected_counts(table)
+    except ValueError, e:
+        print('ERROR: {}: {}'.format(exportinfo, e))
+        sys.exit(1)
+
+    # count each subject's series of each tag in one pass over the data
+    index = dm.protocols.index_folder(datadir, '.nii.gz')
+    counts = dm.protocols.count_tags(index, subjects, expected.columns)
+
+    # compare the protocols, reporting the series found of each tag that has
+    # fewer than expected (by the closest protocol)
+    comparison = dm.protocols.compare(counts, expected)
     for sub in subjects:
-        subjdir = os.path.join(datadir, sub)
-
-        for tag in tags_expected:
-            files = find_niftis_with_tag(subjdir, tag)
-            tags_found[tag] = len(files)
-
-        # compare the protocols
-        successful = None
-        for protocol in range(n_protocols):
-            tags_warning = {}
-
-            for tag in tags_expected:
-                if tags_found[tag] < int(tags_expected[tag][protocol]):
-                    tags_warning[tag] = tags_found[tag]
-
-            if len(tags_warning) == 0:
-                successful = 1
-                pass
-            else:
-                continue
-
-        if not successful:
-            msg = 'ERROR: Protocol mismatch for {}: '.format(sub)
-            for tag in tags_warning:
-                msg = '{} {} {}, '.format(msg, tag, tags_warning[tag])
-            print(msg)
+        if comparison.complete[sub]:
+            continue
+        difference = comparison.difference.loc[sub]
+        short = [tag for tag in expected.columns if difference[tag] < 0]
+        print('ERROR: Protocol mismatch for {}: {}'.format(sub, ', '.join(
+            '{} {}'.format(tag, counts.loc[sub, tag]) for tag in short)))
 
 if __name__ == '__main__':
     main()
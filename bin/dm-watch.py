@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+"""
+Watches for new exams and processes each one as soon as it has arrived.
+
+Usage:
+    dm-watch.py [options] <zipdir> <dcmdir> <xnatdir>...
+
+Arguments:
+    <zipdir>             Folder that new exam zip archives are delivered to
+    <dcmdir>             Folder to link archives into (see link.py)
+    <xnatdir>            XNAT archive folder that exams are placed in, e.g.
+                         /xnat/spred/archive/SPINS/arc001
+
+Options:
+    --lookup FILE        Scan id lookup table for link.py
+                         [default: metadata/scans.csv]
+    --scanid-field STR   Dicom field to find scan ids in, for archives not in
+                         the lookup table (see link.py) [default: PatientName]
+    --datadir DIR        Parent folder to extract to [default: ./data]
+    --exportinfo FILE    Export table for xnat-extract.py
+                         [default: ./metadata/exportinfo.csv]
+    --checklist FILE     Checklist for xnat-extract.py
+    --header-cache FILE  Header cache for link.py and xnat-extract.py
+    --qcdir DIR          Folder for QC reports [default: qc]
+    --no-qc              Don't run qc.py on new exams
+    --settle SECS        How long an archive or exam must go unchanged before
+                         it is processed [default: 120]
+    --poll SECS          How often to look for changes [default: 30]
+    --retries N          How many more times to try an archive or exam that
+                         fails to be processed [default: 3]
+    --existing           Also process the archives and exams already there
+                         when dm-watch.py starts
+    -v, --verbose        Show intermediate steps
+    --debug              Show debug messages
+    -n, --dry-run        Show what would be run, but don't run it
+
+DETAILS
+    This runs the first stages of the pipeline (normally run by run.sh on a
+    schedule) for each new exam as it arrives, rather than for every exam
+    each time:
+
+        - each new archive in <zipdir> is linked into <dcmdir> (link.py)
+        - each new exam folder in an <xnatdir> is extracted into <datadir>
+          (xnat-extract.py), and then QC'd (qc.py)
+
+    Archives and exams are only processed once they are completely written,
+    i.e. once nothing in them has changed for --settle seconds. If linking,
+    extracting or QCing fails, the archive or exam is tried again after
+    another --settle seconds, up to --retries times. An exam is QC'd even if
+    some of its series failed to extract.
+
+    Archives are linked by dm-watch.py itself (with link.py's functions), so
+    the lookup table is only re-read when it changes, and <dcmdir> is only
+    listed once, when dm-watch.py starts.
+
+    On Linux, if pyinotify is installed, the folders are watched with
+    inotify so that changes are noticed straight away (this needs a local
+    filesystem, since inotify doesn't see changes made by other hosts to
+    network filesystems). Otherwise they are checked every --poll seconds.
+
+    Archives and exams present when dm-watch.py starts are assumed to have
+    been processed already, unless --existing is given.
+
+EXAMPLES
+
+    dm-watch.py --lookup metadata/scans.csv data/zips dcm \\
+        /xnat/spred/archive/SPINS/arc001
+"""
+from docopt import docopt
+import datman as dm
+import datman.scanid
+import datman.utils
+import datman.headercache
+import imp
+import os
+import os.path
+import subprocess as proc
+import sys
+import time
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+VERBOSE = False
+DEBUG   = False
+DRYRUN  = False
+
+BINDIR = os.path.dirname(os.path.abspath(__file__))
+
+link = imp.load_source('link', os.path.join(BINDIR, 'link.py'))
+
+# file extensions of exam archives
+ARCHIVE_EXTS = ('.zip', '.tar', '.tar.gz', '.tgz')
+
+def log(message):
+    print "{}: {}".format(time.strftime("%Y-%m-%d %H:%M:%S"), message)
+    sys.stdout.flush()
+
+def error(message):
+    log("ERROR: " + message)
+
+def verbose(message):
+    if not(VERBOSE or DEBUG): return
+    log(message)
+
+def debug(message):
+    if not DEBUG: return
+    log("DEBUG: " + message)
+
+def run(cmd):
+    """Runs a pipeline script, returning True if it succeeds"""
+    debug("exec: {}".format(" ".join(cmd)))
+    if DRYRUN:
+        log("Would run: {}".format(" ".join(cmd)))
+        return True
+    returncode = proc.call(cmd)
+    if returncode != 0:
+        error("{} exited with {}".format(" ".join(cmd), returncode))
+    return returncode == 0
+
+def main():
+    global VERBOSE
+    global DEBUG
+    global DRYRUN
+    arguments  = docopt(__doc__)
+    zipdir     = arguments['<zipdir>']
+    dcmdir     = arguments['<dcmdir>']
+    xnatdirs   = arguments['<xnatdir>']
+    settle     = float(arguments['--settle'])
+    poll       = float(arguments['--poll'])
+    existing   = arguments['--existing']
+    retries    = int(arguments['--retries'])
+    VERBOSE    = arguments['--verbose']
+    DEBUG      = arguments['--debug']
+    DRYRUN     = arguments['--dry-run']
+
+    link.VERBOSE = VERBOSE
+    link.DEBUG   = DEBUG
+    link.DRYRUN  = DRYRUN
+
+    linker = Linker(dcmdir, arguments['--lookup'], arguments['--scanid-field'],
+                    arguments['--header-cache'])
+    handlers = { zipdir : linker.link }
+    for xnatdir in xnatdirs:
+        handlers[xnatdir] = lambda path: extract_exam(path, arguments)
+
+    watch(handlers, settle, poll, existing, retries)
+
+def watch(handlers, settle, poll, existing=False, retries=0):
+    """
+    Watches folders for new entries, and calls a handler for each new entry
+    once it has settled.
+
+    <handlers> maps each folder to watch to the function to call with the
+    path of each new entry in it. An entry has settled once its signature
+    (see signature()) hasn't changed for <settle> seconds. A handler returns
+    False (or raises an exception) if it fails, and the entry is then
+    handled again once it has settled again, up to <retries> more times.
+    """
+    done = set()
+    failures = {}   # entry -> number of times handling it has failed
+    if not existing:
+        for folder in handlers:
+            done.update(list_entries(folder))
+
+    # only the watched folders themselves are watched with inotify (not the
+    # trees below them, which may be huge): new entries wake us up straight
+    # away, and pending entries are checked on every pass until they settle
+    notifier = None
+    if pyinotify:
+        watches = pyinotify.WatchManager()
+        notifier = pyinotify.Notifier(watches)
+        for folder in handlers:
+            watches.add_watch(folder, pyinotify.IN_CREATE |
+                pyinotify.IN_MOVED_TO | pyinotify.IN_CLOSE_WRITE)
+        verbose("Watching {} with inotify".format(", ".join(handlers)))
+    else:
+        verbose("Checking {} every {} seconds".format(", ".join(handlers),
+                                                      poll))
+
+    pending = {}   # entry -> (signature, time it was last seen to change)
+    while True:
+        check_folders(handlers, done, pending, failures, time.time(), settle,
+                      retries)
+
+        # wait for something to happen, or until it's time to check on the
+        # pending entries (or to look for changes, without inotify)
+        timeout = poll
+        if pending:
+            timeout = min(timeout, settle)
+        if notifier:
+            if notifier.check_events(timeout=int(timeout * 1000)):
+                notifier.read_events()
+                notifier.process_events()
+        else:
+            time.sleep(timeout)
+
+def check_folders(handlers, done, pending, failures, now, settle, retries):
+    """
+    Looks for new or changed entries in each watched folder, and handles
+    those that have settled (see watch()).
+
+    Entries are added to <done> once they have been handled successfully, or
+    once they have failed <retries> + 1 times. Until then a failed entry is
+    treated as a new one, so it is handled again once it has settled again.
+    """
+    for folder, handler in sorted(handlers.items()):
+        entries = list_entries(folder)
+        for entry in entries:
+            if entry in done:
+                continue
+            try:
+                update_pending(pending, entry, signature(entry), now)
+            except OSError:   # removed in the meantime
+                pending.pop(entry, None)
+
+        for entry in find_settled(pending, now, settle):
+            if entry not in entries:
+                continue
+            del pending[entry]
+            try:
+                handled = handler(entry) is not False
+            except Exception, e:
+                error("Processing {} failed: {}".format(entry, e))
+                handled = False
+
+            if handled:
+                done.add(entry)
+                failures.pop(entry, None)
+                continue
+
+            failures[entry] = failures.get(entry, 0) + 1
+            if failures[entry] > retries:
+                error("Giving up on {} after {} tries.".format(
+                    entry, failures[entry]))
+                done.add(entry)
+                del failures[entry]
+            else:
+                log("Will try {} again in {} seconds.".format(entry, settle))
+                pending[entry] = (None, now)
+
+def list_entries(folder):
+    """Returns the paths of the entries in a folder"""
+    try:
+        return [os.path.join(folder, f) for f in os.listdir(folder)
+                if not f.startswith('.')]
+    except OSError, e:
+        error("Can't list {}: {}".format(folder, e))
+        return []
+
+def signature(path):
+    """
+    Returns a (count, size, mtime) tuple that changes whenever the file or
+    folder does, i.e. the number of files, their total size and the latest
+    modification time of any of them.
+    """
+    if not os.path.isdir(path):
+        stat = os.stat(path)
+        return 1, stat.st_size, stat.st_mtime
+
+    count, size, mtime = 0, 0, os.stat(path).st_mtime
+    for dirpath, dirs, files in os.walk(path):
+        for f in dirs + files:
+            stat = os.lstat(os.path.join(dirpath, f))
+            count += 1
+            size += stat.st_size
+            mtime = max(mtime, stat.st_mtime)
+    return count, size, mtime
+
+def update_pending(pending, entry, signature, now):
+    """
+    Records the signature of a new entry, restarting the wait for it to
+    settle if it has changed.
+    """
+    if entry not in pending or pending[entry][0] != signature:
+        debug("{} changed".format(entry))
+        pending[entry] = (signature, now)
+
+def find_settled(pending, now, settle):
+    """
+    Returns the entries that haven't changed for at least <settle> seconds,
+    in the order they last changed.
+    """
+    settled = [(changed, entry) for entry, (signature, changed)
+               in pending.items() if now - changed >= settle]
+    return [entry for changed, entry in sorted(settled)]
+
+class Linker(object):
+    """
+    Links new exam archives into the dcm folder, as link.py does.
+
+    The dcm folder is listed once, and the links made are added to that
+    listing, and the lookup table is only read again when it changes, so
+    linking an archive doesn't cost a scan of either.
+    """
+    def __init__(self, dcmdir, lookup_table, scanid_field='PatientName',
+                 cachefile=None):
+        self.dcmdir = os.path.normpath(dcmdir)
+        self.lookup_table = lookup_table
+        self.scanid_field = scanid_field
+        self.lookup = None
+        self.lookup_mtime = None
+        self.already_linked = link.find_linked(self.dcmdir)
+        self.get_archive_headers_many = dm.utils.get_archive_headers_many
+        if cachefile:
+            self.get_archive_headers_many = dm.headercache.HeaderCache(
+                cachefile).get_archive_headers_many
+
+    def load_lookup(self):
+        """Returns the lookup table, reading it again if it has changed"""
+        mtime = os.stat(self.lookup_table).st_mtime
+        if mtime != self.lookup_mtime:
+            debug("Reading {}".format(self.lookup_table))
+            self.lookup = link.load_lookup_table(self.lookup_table)
+            self.lookup_mtime = mtime
+        return self.lookup
+
+    def link(self, path):
+        """
+        Links a new exam archive into the dcm folder.
+
+        Returns False if the archive's headers couldn't be read, so that it
+        is tried again.
+        """
+        if not path.endswith(ARCHIVE_EXTS):
+            debug("{} is not an archive. Ignoring.".format(path))
+            return True
+        realpath = os.path.realpath(path)
+        if realpath in self.already_linked:
+            verbose("{} already linked at {}".format(
+                path, self.already_linked[realpath]))
+            return True
+
+        log("Linking new archive {}".format(path))
+        failed = []
+
+        def get_archive_headers_many(archives, workers, stop_after_first):
+            for archive, manifest, err in self.get_archive_headers_many(
+                    archives, workers=workers,
+                    stop_after_first=stop_after_first):
+                if err:
+                    failed.append(archive)
+                yield archive, manifest, err
+
+        plan = link.make_link_plan([path], self.dcmdir, self.load_lookup(),
+            self.scanid_field, get_archive_headers_many)
+        link.apply_link_plan(plan)
+        for archivepath, target in plan:
+            self.already_linked[os.path.realpath(archivepath)] = target
+        return not failed
+
+def extract_exam(path, arguments):
+    """
+    Extracts a new exam from the XNAT archive, and QCs it.
+
+    Returns False if extracting or QCing it failed.
+    """
+    try:
+        scanid = dm.scanid.parse(os.path.basename(path))
+    except dm.scanid.ParseException:
+        verbose("{} is not named as an exam. Ignoring.".format(path))
+        return True
+
+    log("Extracting new exam {}".format(path))
+    cmd = [sys.executable, os.path.join(BINDIR, 'xnat-extract.py'),
+           '--datadir', arguments['--datadir'],
+           '--exportinfo', arguments['--exportinfo']]
+    for option in ['--checklist', '--header-cache']:
+        if arguments[option]:
+            cmd += [option, arguments[option]]
+    extracted = run(cmd + [path])
+    if arguments['--no-qc']:
+        return extracted
+
+    # QC whatever was exported, even if some series failed
+    log("QCing new exam {}".format(scanid))
+    qcd = run([sys.executable, os.path.join(BINDIR, 'qc.py'),
+               '--datadir', arguments['--datadir'],
+               '--qcdir', arguments['--qcdir'], str(scanid)])
+    return extracted and qcd
+
+if __name__ == '__main__':
+    main()
+
+# vim: ts=4 sw=4:
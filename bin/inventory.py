@@ -3,10 +3,12 @@
 Updates the inventory with problematic exported exam series. 
 
 Usage: 
-    update-inventory.py [options] <archivedir>...
+    update-inventory.py [options] [<archivedir>...]
 
 Arguments:
-    <archivedir>            Path to scan folder within the XNAT archive
+    <archivedir>            Path to scan folder within the XNAT archive. Only
+                            the exams with these names are inventoried (by
+                            default, every subject in the data directory is)
 
 Options: 
     --datadir DIR         Parent folder data is extract to 
@@ -21,6 +23,9 @@ Options:
     --formats LIST        Formats to check (as a comma separated list) 
                           [default: all]
 
+    -v,--verbose          Show intermediate steps
+    -n,--dry-run          Print the inventory rather than updating it
+
 DETAILS
     Problematic exports can happen in several ways: 
 
@@ -35,12 +40,190 @@ DETAILS
       3. A series that has been flagged as unusable in the inventory appears in
          the data folder.
 
-    This program will scan the given archive for original exam acquistions, and
-    and scan data directory for exported acquisitions, and then compares what
-    is found with what is expected to be exported (as listed in the exportinfo
-    and inventory files). 
+    This program scans the data directory for exported acquisitions, and then
+    compares what is found with what is expected to be exported (as listed in
+    the exportinfo and inventory files). The data directory is listed once for
+    each format, and every subject is checked against every protocol in the
+    exportinfo file at once (see datman.protocols). Each subject is compared
+    against the first protocol it has every series for, or if none, the one it
+    is missing the fewest series for.
+
+    The subjects checked are those with a folder in the data folder of any
+    format, so a subject with nothing exported in one format is reported as
+    missing every series of that format.
+
+INVENTORY
+    The inventory is a CSV file with the columns subject, format, tag, series,
+    problem and count. It has a row for each problem found: "missing" or
+    "extra" series of a tag (count is the number of series missing or extra),
+    or a "flagged" series in the data folder.
+
+    To flag a series as unusable, add a row for it to the inventory with the
+    problem "unusable", giving the series file name (without an extension)
+    e.g.
+
+        subject,format,tag,series,problem,count
+        SPN01_CMH_0001_01,,,SPN01_CMH_0001_01_01_T1_02_SagT1,unusable,
+
+    These rows are kept when the inventory is updated. Every other row is
+    replaced.
 """
 from docopt import docopt
+import datman as dm
+import datman.exportinfo
+import datman.protocols
+import datman.scanid
+import datman.utils
+import os.path
+import pandas as pd
+import sys
+
+VERBOSE = False
+DRYRUN  = False
+
+INVENTORY_COLUMNS = ['subject', 'format', 'tag', 'series', 'problem', 'count']
+
+# problem recorded by hand for series that shouldn't be used
+UNUSABLE = 'unusable'
+
+def log(message): 
+    print message
+    sys.stdout.flush()
+
+def error(message): 
+    log("ERROR: " + message)
+
+def verbose(message): 
+    if not VERBOSE: return
+    log(message)
+
+def main():
+    global VERBOSE
+    global DRYRUN
+    arguments   = docopt(__doc__)
+    archivedirs = arguments['<archivedir>']
+    datadir     = arguments['--datadir']
+    exportinfo  = arguments['--exportinfo']
+    inventory   = arguments['--inventory']
+    formats     = arguments['--formats']
+    VERBOSE     = arguments['--verbose']
+    DRYRUN      = arguments['--dry-run']
+
+    exportinfo = dm.exportinfo.load(exportinfo)
+    try:
+        expected = dm.protocols.expected_counts(exportinfo.table)
+    except ValueError, e:
+        error(str(e))
+        sys.exit(1)
+
+    if formats == 'all':
+        formats = exportinfo.formats
+    else:
+        formats = formats.split(',')
+
+    exams = None
+    if archivedirs:
+        exams = set(get_timepoint(os.path.basename(os.path.normpath(path)))
+                    for path in archivedirs)
+
+    current = read_inventory(inventory)
+    unusable = current[current['problem'] == UNUSABLE]
+
+    fmtdirs = {}
+    for fmt in formats:
+        fmtdir = os.path.join(datadir, fmt)
+        if not os.path.isdir(fmtdir):
+            verbose("{} does not exist. Skipping.".format(fmtdir))
+            continue
+        fmtdirs[fmt] = fmtdir
+    subjects = find_subjects(fmtdirs.values(), exams)
+
+    problems = [unusable]
+    for fmt, fmtdir in sorted(fmtdirs.items()):
+        problems.append(find_problems(fmtdir, fmt, exportinfo, expected,
+                                      unusable['series'], subjects))
+
+    updated = pd.concat(problems, ignore_index=True)[INVENTORY_COLUMNS]
+    if exams is not None:
+        # keep what was found before for the other exams
+        others = current[(current['problem'] != UNUSABLE) &
+                         ~current['subject'].isin(exams)]
+        updated = pd.concat([updated, others], ignore_index=True)
+
+    updated = updated.sort_values(['subject', 'format', 'tag', 'series',
+                                   'problem']).reset_index(drop=True)
+    if DRYRUN:
+        log(updated.to_csv(index=False))
+        return
+    updated.to_csv(inventory, index=False)
+
+def find_subjects(fmtdirs, exams=None):
+    """
+    Returns the sorted list of subjects (other than phantoms) with a folder
+    in any of the format folders, optionally only those in <exams>.
+    """
+    subjects = set()
+    for fmtdir in fmtdirs:
+        subjects.update(dm.utils.get_subjects(fmtdir))
+    return sorted(s for s in subjects if not dm.scanid.is_phantom(s) and
+                  (exams is None or s in exams))
+
+def find_problems(fmtdir, fmt, exportinfo, expected, flagged, subjects):
+    """
+    Finds the missing, extra and flagged series of <subjects> in the data
+    folder of a format, returning them as inventory rows. A subject without
+    a folder in it is missing every series.
+    """
+    ext = dm.protocols.FORMAT_EXTS.get(fmt)
+
+    index = dm.protocols.index_folder(fmtdir, ext)
+    index = index[index['folder'].isin(subjects)]
+
+    # only tags exported in this format are expected to be found
+    tags = [tag for tag in expected.columns
+            if fmt in exportinfo.exports.get(tag, [])]
+    counts = dm.protocols.count_tags(index, subjects, tags)
+    comparison = dm.protocols.compare(counts, expected[tags])
+
+    missing = dm.protocols.missing_series(comparison)
+    missing = pd.DataFrame({'subject': missing['subject'],
+                            'tag': missing['tag'],
+                            'problem': 'missing',
+                            'count': missing['missing'].astype(str)})
+
+    extra = dm.protocols.extra_series(comparison)
+    extra = pd.DataFrame({'subject': extra['subject'],
+                          'tag': extra['tag'],
+                          'problem': 'extra',
+                          'count': extra['extra'].astype(str)})
+
+    flagged = dm.protocols.flagged_series(index, flagged)
+    flagged = pd.DataFrame({'subject': flagged['folder'],
+                            'tag': flagged['tag'],
+                            'series': flagged['name'],
+                            'problem': 'flagged'})
+
+    verbose("{}: {} subjects, {} missing, {} extra, {} flagged".format(
+        fmtdir, len(subjects), len(missing), len(extra), len(flagged)))
+
+    problems = pd.concat([p.reindex(columns=INVENTORY_COLUMNS)
+                          for p in [missing, extra, flagged]],
+                         ignore_index=True)
+    problems['format'] = fmt
+    return problems
+
+def read_inventory(path):
+    """Reads the inventory (or returns an empty one if it doesn't exist)"""
+    if not os.path.exists(path):
+        return pd.DataFrame(columns=INVENTORY_COLUMNS)
+    return pd.read_csv(path, dtype=str).reindex(columns=INVENTORY_COLUMNS)
+
+def get_timepoint(name):
+    """Returns the timepoint (subject folder) name for an exam name"""
+    try:
+        return dm.scanid.parse(name).get_full_subjectid_with_timepoint()
+    except dm.scanid.ParseException:
+        return name
 
 if __name__ == '__main__':
-    arguments = docopt(__doc__)
+    main()
@@ -17,6 +17,9 @@ Options:
                                 [default: metadata/scans.csv]
     --scanid_field STR       Dicom field to match target_name with 
                              [default: PatientName]
+    --header-cache FILE      Cache archive headers in FILE (see
+                             datman.headercache)
+    -j,--jobs N              Number of archives to read at once [default: 1]
     -v,--verbose             Verbose logging
     --debug                  Debug logging
     -n,--dry-run             Dry run
@@ -74,6 +77,7 @@ import pandas as pd
 import datman as dm
 import datman.utils
 import datman.scanid
+import datman.headercache
 import glob
 import os.path
 import sys
@@ -106,84 +110,161 @@ def main():
     targetdir    = arguments['<targetdir>']
     lookup_table = arguments['--lookup']
     scanid_field = arguments['--scanid_field']
+    cachefile    = arguments['--header-cache']
+    jobs         = int(arguments['--jobs'])
     VERBOSE      = arguments['--verbose']
     DEBUG        = arguments['--debug']
     DRYRUN       = arguments['--dry-run']
 
 
-    lookup = pd.read_table(lookup_table, sep='\s+', dtype=str)
+    lookup = load_lookup_table(lookup_table)
+
+    get_archive_headers_many = dm.utils.get_archive_headers_many
+    if cachefile:
+        get_archive_headers_many = dm.headercache.HeaderCache(
+                                cachefile).get_archive_headers_many
     targetdir = os.path.normpath(targetdir)
 
-    already_linked = { os.path.realpath(f):f for f in glob.glob(targetdir+'/*') if os.path.islink(f)}
+    already_linked = find_linked(targetdir)
 
+    unlinked = []
     for archivepath in archives: 
 
-        if os.path.realpath(archivepath) in already_linked.keys(): 
+        if os.path.realpath(archivepath) in already_linked: 
             verbose("{} already linked at {}".format(archivepath, already_linked[os.path.realpath(archivepath)]))
             continue
+        unlinked.append(archivepath)
 
-        # get some DICOM headers from the archive
-        header = None
-        try:
-            header = dm.utils.get_archive_headers(
-                                archivepath, stop_after_first=True).values()[0]
-        except:
-            verbose("{}: Contains no DICOMs. Skipping.".format(archivepath))
-            continue
+    plan = make_link_plan(unlinked, targetdir, lookup, scanid_field, 
+                          get_archive_headers_many, jobs)
+    apply_link_plan(plan)
 
-        # search the lookup and the headers for a valid scan ID 
-        scanid, lookupinfo = get_scanid_from_lookup_table(archivepath, lookup)
-        debug("Found {} as scanid from lookup table {}".format(scanid, lookup_table))
+def find_linked(targetdir):
+    """
+    Returns a dictionary mapping the real path of each archive linked into
+    targetdir to its link.
+    """
+    return { os.path.realpath(f):f for f in glob.glob(targetdir+'/*') 
+             if os.path.islink(f) }
+
+def make_link_plan(archives, targetdir, lookup, scanid_field, 
+                   get_archive_headers_many, jobs=1):
+    """
+    Works out where to link each archive, returning a list of (archivepath,
+    target) pairs in the order archives are given. 
+
+    Archives in the lookup table are resolved from the table alone, and their
+    DICOM headers are only read if the table lists headers to check. The
+    headers of the rest are read (<jobs> archives at once) to look for a
+    scan ID in them. 
+    """
+    resolved = {}     # archivepath -> scanid
+    unresolved = []   # archives to read headers from
+    for archivepath in archives: 
+        scanid, expected = get_scanid_from_lookup_table(archivepath, lookup)
+        debug("Found {} as scanid from lookup table".format(scanid))
 
         if scanid == '<ignore>': 
             verbose("Ignoring {}".format(archivepath))
+        elif scanid and not expected: 
+            resolved[archivepath] = scanid
+        else: 
+            unresolved.append(archivepath)
+
+    # get some DICOM headers from each remaining archive
+    for archivepath, manifest, err in get_archive_headers_many(
+            unresolved, workers=jobs, stop_after_first=True): 
+
+        if err: 
+            error("{}: Can't read DICOM headers: {}. Skipping.".format(
+                archivepath, err))
             continue
+        if not manifest:
+            verbose("{}: Contains no DICOMs. Skipping.".format(archivepath))
+            continue
+        header = manifest.values()[0]
 
         # if we have a scan id, then validate any expected DICOM headers, 
         # otherwise, check the DICOM headers for a valid scan id
+        scanid, expected = get_scanid_from_lookup_table(archivepath, lookup)
         if scanid: 
-            if not validate(archivepath, header, lookupinfo):
+            if not validate(archivepath, header, expected):
                 error("{}: DICOM headers do not match expected from scans.csv. Skipping.".format(
                     archivepath))
                 continue
-        elif header:
+        else:
             scanid = get_scanid_from_header(archivepath, header, scanid_field) 
             debug("Found {} as scanid from header.".format(scanid))
 
         if scanid is None: 
             error("{}: Cannot find scan id. Skipping".format(archivepath))
             continue
+        resolved[archivepath] = scanid
 
-        # do the linking 
-        target = os.path.join(targetdir,scanid) + datman.utils.get_extension(archivepath)
-        if os.path.exists(target): 
+    plan = []
+    targets = set()
+    for archivepath in archives: 
+        if archivepath not in resolved: 
+            continue
+        target = os.path.join(targetdir,resolved[archivepath]) + \
+                 datman.utils.get_extension(archivepath)
+        if target in targets or os.path.exists(target): 
             verbose("{} already exists for archive {}. Skipping.".format(
                 target,archivepath))
             continue
+        targets.add(target)
+        plan.append((archivepath, target))
+    return plan
 
+def apply_link_plan(plan):
+    """Makes the links in a plan (see make_link_plan)"""
+    for archivepath, target in plan: 
         relpath = os.path.relpath(archivepath,os.path.dirname(target))
         log("linking {} to {}".format(relpath, target))
         if not DRYRUN:
             os.symlink(relpath, target)
 
+def load_lookup_table(path):
+    """
+    Reads the lookup table into a dictionary index. 
+
+    Returns a dictionary mapping each source_name to (target_name, expected),
+    where expected is a dictionary of the DICOM headers to check (from the
+    dicom_* columns) mapped to the values they should have. Headers with no
+    value given for an archive aren't checked. If a source_name is listed
+    more than once, the first entry is used. 
+    """
+    lookup = pd.read_table(path, sep='\s+', dtype=str)
+
+    columns    = lookup.columns.values.tolist()
+    dicom_cols = [c for c in columns if c.startswith('dicom_')]
+    fields     = [c.split("_")[1] for c in dicom_cols]
+
+    index = {}
+    for row in lookup[['source_name', 'target_name'] + dicom_cols].itertuples(
+            index=False):
+        if row[0] in index: 
+            continue
+        expected = dict((field, str(value)) 
+                        for field, value in zip(fields, row[2:]) 
+                        if pd.notnull(value))
+        index[row[0]] = (row[1], expected)
+    return index
+
 def get_scanid_from_lookup_table(archivepath, lookup):
     """
-    Gets the scanid from the lookup table (pandas dataframe)
+    Gets the scanid from the lookup table (see load_lookup_table)
 
-    Returns the scanid and the rest of the lookup table information (e.g.
-    expected dicom header matches). If no match is found, both the scan id and
-    lookup table info is None.
+    Returns the scanid and the expected dicom header values. If no match is
+    found, both the scan id and the expected values are None.
     """
     basename    = os.path.basename(os.path.normpath(archivepath))
     source_name = basename[:-len(datman.utils.get_extension(basename))]
-    lookupinfo  = lookup[ lookup['source_name'] == source_name ]
 
-    if len(lookupinfo) == 0:
+    if source_name not in lookup:
         debug("{} not found in source_name column.".format(source_name))
         return (None, None)
-    else: 
-        scanid = lookupinfo['target_name'].tolist()[0]
-        return (scanid, lookupinfo)
+    return lookup[source_name]
 
 def get_scanid_from_header(archivepath, header, scanid_field):
     """
@@ -211,29 +292,25 @@ def get_scanid_from_header(archivepath, header, scanid_field):
         return None
 
 
-def validate(archivepath, header, lookupinfo):
+def validate(archivepath, header, expected):
     """
     Validates an exam archive against the lookup table
 
-    Checks that all dicom_* dicom header fields match the lookup table
+    Checks that all dicom_* dicom header fields match the lookup table, given
+    as a dictionary of header -> expected value (see load_lookup_table). 
     """
-    columns    = lookupinfo.columns.values.tolist()
-    dicom_cols = [c for c in columns if c.startswith('dicom_')]
-
-    for c in dicom_cols:
-        f = c.split("_")[1]
+    for f, value in sorted(expected.items()):
 
         if f not in header:
             error("{}: {} field is not in {} dicom headers".format(
-                archivepath, scanid_field, archivepath))
+                archivepath, f, archivepath))
             return False
 
-        actual   = str(header.get(f))
-        expected = str(lookupinfo[c].tolist()[0])
+        actual = str(header.get(f))
 
-        if actual != expected :
+        if actual != value:
             error("{}: dicom field '{}' = '{}', expected '{}'".format(
-                archivepath, f, actual, expected))
+                archivepath, f, actual, value))
             return False
     return True
 
@@ -3,10 +3,11 @@
 Produces QC documents for each exam.
 
 Usage:
-    qc.py [options]
+    qc.py [options] [<scanid>...]
 
 Arguments:
-    <scanid>        Scan ID to QC for. E.g. DTI_CMH_H001_01_01
+    <scanid>        Scan ID to QC for. E.g. DTI_CMH_H001_01_01 (by default,
+                    every exam in the datadir is QC'd)
 
 Options:
     --datadir DIR      Parent folder holding exported data [default: data]
@@ -43,6 +44,7 @@ import nibabel as nib
 import datman as dm
 import datman.utils
 import datman.scanid
+import datman.headerchecks
 import subprocess as proc
 from copy import copy
 from docopt import docopt
@@ -697,9 +699,19 @@ def dti_qc(fpath, doc, cur):
     montage(fpath, 'DTI Directions', filename, doc, mode='4d', maxval=0.25)
     find_epi_spikes(fpath, filename, doc, 'dti', cur=cur, bvec=bvec)
 
-def add_header_checks(fpath, doc, logdata):
+def add_header_checks(fpath, doc, logdata, store=None):
+    """
+    Adds the header mismatches found for a scan, taken from the mismatch store
+    (see datman.headerchecks) if given, and from the lines of the header check
+    logs of any exams the store hasn't checked (see qc_folder).
+    """
     filestem = os.path.basename(fpath).replace(dm.utils.get_extension(fpath),'')
-    lines = [re.sub('^.*?: *','',line) for line in logdata if filestem in line]
+    lines = []
+    if store:
+        lines = [dm.headerchecks.describe(m) + '\n'
+                 for m in store.get_series(filestem)]
+    if not lines and logdata:
+        lines = [re.sub('^.*?: *','',line) for line in logdata if filestem in line]
     if not lines:
         return
 
@@ -755,13 +767,17 @@ def qc_folder(scanpath, subject, qcdir, cur, QC_HANDLERS):
         found_files.extend(glob.glob(scanpath + '/' + filetype))
     found_files.sort()
 
-    # load up any header/bvec check log files for the subjectt
-    header_check_logs = glob.glob(os.path.join(qcdir, 'logs', 'dm-check-headers-'+subject+'*'))
-    header_check_log = []
-    for logfile in header_check_logs:
-        header_check_log += open(logfile).readlines()
-
-    # load up any header/bvec check log files for the subjectt
+    # look up header check results in the mismatch store, and in the header
+    # check log files of any of the subject's exams that the store hasn't
+    # checked (e.g. checked before the store existed)
+    header_check_store = None
+    storefile = os.path.join(qcdir, 'logs', dm.headerchecks.STORE_NAME)
+    if os.path.exists(storefile):
+        header_check_store = dm.headerchecks.MismatchStore(storefile)
+    header_check_log = dm.headerchecks.read_logs(
+        os.path.join(qcdir, 'logs'), subject, header_check_store)
+
+    # load up any bvec check log files for the subject
     bvecs_check_logs = glob.glob(os.path.join(qcdir, 'logs', 'dm-check-bvecs-'+subject+'*'))
     bvecs_check_log = []
     for logfile in bvecs_check_logs:
@@ -773,8 +789,8 @@ def qc_folder(scanpath, subject, qcdir, cur, QC_HANDLERS):
         if tag not in QC_HANDLERS:
             logger.info("QC hanlder for scan {} (tag {}) not found. Skipping.".format(fname, tag))
             continue
-        if header_check_log:
-            add_header_checks(fname, doc, header_check_log)
+        if header_check_store or header_check_log:
+            add_header_checks(fname, doc, header_check_log, header_check_store)
         if bvecs_check_log:
             add_bvec_checks(fname, doc, bvecs_check_log)
         QC_HANDLERS[tag](fname, doc, cur)
@@ -784,6 +800,8 @@ def qc_folder(scanpath, subject, qcdir, cur, QC_HANDLERS):
     d['CreationDate'] = datetime.datetime.today()
     d['ModDate'] = datetime.datetime.today()
     pdf.close()
+    if header_check_store:
+        header_check_store.close()
 
 def main():
     """
@@ -824,6 +842,7 @@ def main():
     datadir   = arguments['--datadir']
     qcdir     = arguments['--qcdir']
     dbdir     = arguments['--dbdir']
+    scanids   = arguments['<scanid>']
     verbose   = arguments['--verbose']
     debug     = arguments['--debug']
     DRYRUN    = arguments['--dry-run']
@@ -849,7 +868,12 @@ def main():
     if db_is_new == True:
         create_db(cur)
 
-    for path in glob.glob(timepoint_glob):
+    timepoints = glob.glob(timepoint_glob)
+    if scanids: 
+        wanted = set(get_timepoint(scanid) for scanid in scanids)
+        timepoints = [p for p in timepoints if os.path.basename(p) in wanted]
+
+    for path in timepoints:
         subject = os.path.basename(path)
 
         # skip phantoms
@@ -863,5 +887,15 @@ def main():
     cur.close()
     db.close()
 
+def get_timepoint(scanid):
+    """
+    Returns the timepoint folder name (e.g. DTI_CMH_H001_01) for a scan ID,
+    which may also be given as just the timepoint.
+    """
+    try:
+        return dm.scanid.parse(scanid).get_full_subjectid_with_timepoint()
+    except dm.scanid.ParseException:
+        return scanid
+
 if __name__ == "__main__":
     main()
@@ -6,13 +6,26 @@ Usage:
     extract.py [options] <archivedir>...
 
 Arguments:
-    <archivedir>            Path to scan folder within the XNAT archive
+    <archivedir>            Path to scan folder within the XNAT archive, or
+                            to a zip or tar archive of the exam
 
 Options: 
     --datadir DIR           Parent folder to extract to [default: ./data]
     --exportinfo FILE       Table listing acquisitions to export by format
                             [default: ./metadata/exportinfo.csv]
     --checklist FILE        Checklist listing subjects/series to ignore
+    --header-cache FILE     Cache archive headers in FILE (see
+                            datman.headercache)
+    -j, --jobs N            Number of conversions to run at once [default: 1]
+    --format-jobs LIMITS    Limit the number of conversions to run at once for
+                            particular formats, as a comma separated list of
+                            format=N (e.g. nrrd=2,mnc=4)
+    --no-verify             Don't check converted NifTis against the DICOMs
+    --in-process            Write NifTis and NRRDs of simple series in-process,
+                            rather than with dcm2nii and DWIConvert (see
+                            CONVERSION)
+    --scratch DIR           Where to unpack series from zip or tar archives
+                            (default: /dev/shm, if available)
     -v, --verbose           Show intermediate steps
     --debug                 Show debug messages
     -n, --dry-run           Do nothing
@@ -37,6 +50,19 @@ INPUT FOLDERS
         002/
         ...
 
+    Alternatively, <archivedir> may be a zip or tar (.tar, .tar.gz, .tgz or
+    .tar.bz2) archive of an exam, named according to our data naming scheme
+    (as linked by link.py), e.g.
+
+        /archive/SPINS/dicom/SPN01_CMH_0001_01_01.zip
+
+    Each series folder within the archive (i.e. each folder with files in it)
+    is unpacked to a scratch folder just before it is converted, and removed
+    as soon as it has been converted to every format, so that at most one
+    series per conversion job is unpacked at a time. The scratch folder is in
+    /dev/shm (i.e. in memory) when possible, see --scratch. Non-dicom
+    resources are not exported from archives. 
+
 OUTPUT FOLDERS
     Each dicom series will be converted and placed into a subfolder of the
     datadir named according to the converted filetype and subject ID, e.g. 
@@ -106,22 +132,82 @@ NON-DICOM DATA
             SPN01_CMH_0001_01_01_CAT_002_catalog.xml
             ... 
 
+CONVERSION
+    Series are converted to NifTi with dcm2nii, to NRRD with DWIConvert and
+    to MINC with dcm2mnc. The .dcm export copies the file the series' headers
+    were read from.
+
+    With --in-process, each series is instead decoded once, and the decoded
+    volume is shared by its NifTi and NRRD exports, which are written
+    in-process. Only simple series are decoded this way: a single volume of
+    uncompressed, single-frame slices with the same size and orientation,
+    evenly spaced (e.g. most structural scans). Other series (e.g. mosaics,
+    multi-frame DICOMs, and multi-volume series such as fMRI and DTI) are
+    still converted with dcm2nii and DWIConvert.
+
+    NifTis written in-process differ from dcm2nii's: they are in the
+    orientation of the DICOM slices, rather than being reoriented to the
+    nearest orthogonal orientation, and they keep the DICOM pixel type
+    (float32 if the series is rescaled). So don't mix the two in a dataset
+    whose downstream processing expects one or the other.
+
+OUTPUT WRITING
+    Each output is written to a temporary .xnat-extract-* folder alongside it
+    and renamed into place once complete, so that outputs that exist are
+    never partially written (and an interrupted export is simply redone).
+    Before it is moved into place, each NifTi is checked against the DICOM
+    series: the number of DICOMs must match the number of slices and volumes
+    in the NifTi (see verify_nii). Use --no-verify to skip this check. 
+
+EXPORT MANIFESTS
+    A manifest of what has been exported from each exam is kept in
+    manifests/<scanid>.json in the data folder. It records a fingerprint of
+    each series folder (made from the file names, sizes and modification times
+    along with a sample of the data) and of each file exported from it.
+
+    A series whose fingerprint matches the manifest, and whose outputs are all
+    unchanged, is skipped without reading any of its DICOMs. If the series has
+    changed (e.g. it was re-archived with new slices), its old outputs are
+    removed and it is exported again, as is any output that has been changed
+    or removed. Editing the export table makes all series be looked at again.
+
+PARALLEL EXPORTS
+    By default, each series is converted to each format in turn. With --jobs,
+    the series to export from all of the <archivedir>s are found first, and
+    then the conversions (one for each series and format, plus copying each
+    exam's resources) are run N at a time. Output from each conversion is
+    held back until it finishes, and is shown in the same order as it would
+    be without --jobs.
+
 EXAMPLES
 
     xnat-extract.py /xnat/spred/archive/SPINS/arc001/SPN01_CMH_0001_01_01
 
+    xnat-extract.py --jobs 16 --format-jobs nrrd=4 \
+        /xnat/spred/archive/SPINS/arc001/SPN01_CMH_*
+
 """
 from docopt import docopt
-import pandas as pd
 import datman as dm
 import datman.utils
 import datman.scanid
+import datman.headercache
+import datman.exportinfo
+import collections
+import gzip
 import os.path
 import sys
 import subprocess as proc
 import tempfile
 import glob
+import hashlib
+import json
+import functools
 import shutil
+import tarfile
+import threading
+import zipfile
+from multiprocessing.pool import ThreadPool
 
 STAGE_NAME = 'xnat-extract'  # checklist stage name
 
@@ -129,7 +215,54 @@ DEBUG  = False
 VERBOSE= False
 DRYRUN = False
 
+# reads the dicom headers from an archive (see datman.utils.get_archive_headers)
+get_archive_headers = dm.utils.get_archive_headers
+
+# format -> the most conversions to that format to run at once
+FORMAT_LIMITS = {}
+
+# check converted NifTis against the DICOM series (see verify_nii)
+VERIFY = True
+
+# decode series once and write NifTis and NRRDs in-process, where possible
+# (see SeriesVolume)
+IN_PROCESS = False
+
+# formats written in-process from the decoded series
+DECODED_FORMATS = ('nii', 'nrrd')
+
+# transfer syntaxes of uncompressed pixel data (implicit VR little endian,
+# explicit VR little endian and explicit VR big endian)
+UNCOMPRESSED_SYNTAXES = ('1.2.840.10008.1.2', '1.2.840.10008.1.2.1',
+                         '1.2.840.10008.1.2.2')
+
+# nrrd names of numpy data types
+NRRD_TYPES = {
+    'int8'   : 'int8',
+    'uint8'  : 'uint8',
+    'int16'  : 'short',
+    'uint16' : 'ushort',
+    'int32'  : 'int',
+    'uint32' : 'uint',
+    'float32': 'float',
+    'float64': 'double',
+}
+
+# where series are unpacked from zip or tar archives (None for the default
+# temporary folder)
+SCRATCH = None
+
+# extensions of zip and tar archives of exams
+ARCHIVE_EXTS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2')
+
+# holds the log output of the export task running in each thread
+_output = threading.local()
+
 def log(message): 
+    buffer = getattr(_output, 'buffer', None)
+    if buffer is not None:
+        buffer.append(message)
+        return
     print message
     sys.stdout.flush()
 
@@ -148,6 +281,10 @@ def makedirs(path):
     debug("makedirs: {}".format(path))
     if not DRYRUN: os.makedirs(path)
 
+def remove(path):
+    debug("remove: {}".format(path))
+    if not DRYRUN: os.remove(path)
+
 def run(cmd):
     debug("exec: {}".format(cmd))
     if not DRYRUN: 
@@ -166,88 +303,793 @@ def main():
     global DEBUG 
     global DRYRUN
     global VERBOSE
+    global get_archive_headers
+    global SCRATCH
+    global VERIFY
+    global IN_PROCESS
     arguments = docopt(__doc__)
     archives       = arguments['<archivedir>']
     exportinfofile = arguments['--exportinfo']
     datadir        = arguments['--datadir']
     checklistfile  = arguments['--checklist']
+    cachefile      = arguments['--header-cache']
+    jobs           = int(arguments['--jobs'])
+    formatjobs     = arguments['--format-jobs']
+    SCRATCH        = arguments['--scratch'] or default_scratch()
+    VERIFY         = not arguments['--no-verify']
+    IN_PROCESS     = arguments['--in-process']
     VERBOSE        = arguments['--verbose']
     DEBUG          = arguments['--debug']
     DRYRUN         = arguments['--dry-run']
 
-    exportinfo = pd.read_table(exportinfofile, sep='\s*', engine="python")
+    exportinfo = dm.exportinfo.load(exportinfofile)
+
+    if cachefile:
+        get_archive_headers = dm.headercache.HeaderCache(
+                                cachefile).get_archive_headers
 
     if checklistfile and not os.path.exists(checklistfile): 
         error('Checklist {} does not exist'.format(checklistfile))
         sys.exit(1)
 
+    if formatjobs:
+        try:
+            for limit in formatjobs.split(','):
+                fmt, n = limit.split('=')
+                FORMAT_LIMITS[fmt.strip()] = int(n)
+                if int(n) < 1:
+                    raise ValueError()
+        except ValueError:
+            error('--format-jobs should look like nrrd=2,mnc=4, not {}'.format(
+                formatjobs))
+            sys.exit(1)
+
     debug('Using checklist: {}'.format(checklistfile))
     checklist = dm.checklist.load(checklistfile)
 
+    tasks = []
+    exams = []
+    errors = False
     for archivepath in archives:
         verbose("Exporting {}".format(archivepath))
-        extract_archive(exportinfo, archivepath, datadir, checklist)
+        try: 
+            exam_tasks, exam = extract_archive(exportinfo, archivepath, 
+                datadir, checklist)
+        except Exception, e: 
+            error("Exporting {} failed: {}".format(archivepath, e))
+            errors = True
+            continue
+        tasks.extend(exam_tasks)
+        exam and exams.append(exam)
+
+    failed = run_tasks(tasks, jobs)
+
+    failed_series = set(task[2][0] for task in failed)
+    for exam in exams: 
+        update_manifest(exam, failed_series)
+
+    if failed or errors: 
+        sys.exit(1)
+
+def default_scratch():
+    """Returns /dev/shm if it is available for scratch files, else None"""
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return None
+
+def run_tasks(tasks, jobs=1):
+    """
+    Runs export tasks (see extract_archive), <jobs> at a time. 
+
+    Output from each task is logged once it finishes, in the order of tasks.
+    Returns the list of tasks that failed. 
+    """
+    if jobs > 1: 
+        results = run_parallel(tasks, jobs)
+    else: 
+        results = (run_task(task) for task in tasks)
+
+    failed = []
+    for task, (messages, ok) in zip(tasks, results):
+        for message in messages: 
+            log(message)
+        if not ok: 
+            failed.append(task)
+    return failed
+
+def run_parallel(tasks, jobs):
+    """
+    Runs tasks <jobs> at a time, respecting the limit on the conversions to
+    each format run at once (FORMAT_LIMITS). 
+
+    A task is only handed to the pool once there is a worker free for it and
+    its format is under its limit, so tasks of other formats are started
+    ahead of tasks waiting on a limit rather than queueing behind them. 
+
+    Yields the result of each task (see run_task), in the order of tasks. 
+    """
+    waiting = list(enumerate(tasks))
+    running = {}    # format -> number of its tasks running
+    results = {}    # task number -> result, until it is yielded
+    changed = threading.Condition()
+
+    def finished(i, fmt, result):
+        with changed:
+            results[i] = result
+            running[fmt] -= 1
+            changed.notify()
+
+    pool = ThreadPool(jobs)
+    try:
+        for i in range(len(tasks)):
+            with changed:
+                while i not in results:
+                    start = []
+                    for n, task in waiting:
+                        if sum(running.values()) >= jobs:
+                            break
+                        fmt = task[0]
+                        if running.get(fmt, 0) >= FORMAT_LIMITS.get(fmt, jobs):
+                            continue
+                        running[fmt] = running.get(fmt, 0) + 1
+                        start.append((n, task))
+                    started = set(n for n, task in start)
+                    waiting[:] = [w for w in waiting if w[0] not in started]
+                    for n, task in start:
+                        pool.apply_async(run_task, (task,), callback=
+                            functools.partial(finished, n, task[0]))
+                    if i not in results:
+                        changed.wait()
+                result = results.pop(i)
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def run_task(task):
+    """
+    Runs an export task. 
+
+    Returns the task's log messages, and whether it succeeded. 
+    """
+    fmt, exporter, args = task
+    _output.buffer = []
+    ok = True
+    try:
+        exporter(*args)
+    except Exception, e:
+        error("Exporting {} to {} failed: {}".format(args[0], fmt, e))
+        ok = False
+    finally: 
+        messages, _output.buffer = _output.buffer, None
+    return messages, ok
 
 
 def extract_archive(exportinfo, archivepath, exportdir, checklist):
     """
     Exports an XNAT archive to various file formats.
 
+    The headers of each series are read once, from a single DICOM, and these
+    are shared by the exports of the series to each format, as is the series'
+    decoded volume (see SeriesVolume). 
+
     The <archivepath> is the XNAT archive directory to extract from. This
     should point to a single scan folder, and the folder should be named
-    according to our data naming scheme. 
+    according to our data naming scheme. It may also be a zip or tar archive
+    of the exam (see ExamArchive). 
 
     This function searches through the SCANS subfolder (archivepath) for series
-    and converts each series, placing them in an appropriately named folder
-    under exportdir. 
+    and plans the conversion of each series, to be placed in an appropriately
+    named folder under exportdir. Series that haven't changed since they were
+    last exported (according to the exam's export manifest, see
+    read_manifest) are skipped without reading them. 
+
+    Returns the list of export tasks as (format, exporter, args) tuples, where
+    calling exporter(*args) does the export (see run_tasks), and the exam
+    record to pass to update_manifest once the tasks have run. 
     """
 
     archivepath = os.path.normpath(archivepath)
     basename    = os.path.basename(archivepath)
+    isfolder    = os.path.isdir(archivepath)
+    if not isfolder: 
+        basename = strip_archive_ext(basename)
 
     try:
         scanid = datman.scanid.parse(basename)
     except datman.scanid.ParseException, e:
         error("{} folder is not named according to the data naming policy. " \
               "Skipping".format(archivepath))
-        return
+        return [], None
 
     scanspath = os.path.join(archivepath,'SCANS')
-    if not os.path.isdir(scanspath):
+    if isfolder and not os.path.isdir(scanspath):
         error("{} doesn't exist. Not an XNAT archive. "\
               "Skipping.".format(scanspath))
-        return
-
-    fmts         = get_formats_from_exportinfo(exportinfo)
+        return [], None
+    if not isfolder and not (zipfile.is_zipfile(archivepath) or 
+                             tarfile.is_tarfile(archivepath)):
+        error("{} is not a folder, zip or tar archive. "\
+              "Skipping.".format(archivepath))
+        return [], None
+
+    fmts         = exportinfo.formats
     unknown_fmts = [fmt for fmt in fmts if fmt not in exporters]
 
     if len(unknown_fmts) > 0: 
         error("Unknown formats requested for export of {}: {}. " \
               "Skipping.".format(archivepath, ",".join(unknown_fmts)))
-        return
+        return [], None
+
+    manifestfile = os.path.join(exportdir, "manifests", str(scanid) + ".json")
+    manifest     = read_manifest(manifestfile, get_settings(exportinfo))
+    exam = {
+        'archivepath'  : archivepath,
+        'exportdir'    : exportdir,
+        'manifestfile' : manifestfile,
+        'manifest'     : manifest, 
+        'exported'     : {},   # series folder -> (fingerprint, output stems)
+        'fingerprint'  : None, # of the zip or tar archive, if complete
+    }
+
+    archive = None
+    if not isfolder: 
+        # a zip or tar archive that is unchanged need not even be opened
+        exam['fingerprint'] = dm.utils.fingerprint(archivepath)
+        if manifest.get('fingerprint') == exam['fingerprint'] and \
+                not any(is_stale(record, exportdir) 
+                        for record in manifest['series'].values()):
+            debug("{}: unchanged since it was exported. Skipping.".format(
+                archivepath))
+            return [], None
+        archive = ExamArchive(archivepath, SCRATCH)
+
+    try: 
+        tasks = plan_series(exportinfo, archivepath, exportdir, checklist, 
+                            scanid, exam, archive)
+    except: 
+        if archive: archive.close()
+        raise
+
+    # the archive is opened again by the first export that uses it, and
+    # closed by the last
+    if archive: 
+        archive.close()
 
-    # export each series to datadir/fmt/subject/
+    # export non dicom resources
+    if isfolder: 
+        tasks.append(("resources", export_resources, 
+            (archivepath, exportdir, scanid)))
+    return tasks, exam
+
+def plan_series(exportinfo, archivepath, exportdir, checklist, scanid, exam, 
+                archive=None):
+    """
+    Plans the export of each series in an exam that has changed since it was
+    last exported (see extract_archive), from the exam folder or from its zip
+    or tar archive (an ExamArchive). 
+
+    Returns the list of export tasks. 
+    """
+    fmts      = exportinfo.formats
+    manifest  = exam['manifest']
     timepoint = scanid.get_full_subjectid_with_timepoint()
 
+    # export each series to datadir/fmt/subject/
+    tasks = []
     stem  = str(scanid)
-    for src, header in dm.utils.get_archive_headers(archivepath).items():
-        export_series(exportinfo, src, header, fmts, timepoint, stem, 
-                exportdir, checklist)
+    folders = archive.folders.keys() if archive else \
+              get_series_folders(archivepath)
+    for folder in folders:
+        src         = os.path.join(archivepath, folder) if archive else folder
+        key         = os.path.relpath(src, archivepath)
+        fingerprint = archive.fingerprint(folder) if archive else \
+                      dm.utils.fingerprint(src)
+        record      = manifest['series'].get(key)
+        if record and not remove_stale_outputs(record, fingerprint, exportdir):
+            debug("{}: unchanged since it was exported. Skipping.".format(src))
+            continue
 
-    # export non dicom resources
-    export_resources(archivepath, exportdir, scanid)
+        if archive: 
+            header = archive.read_header(folder)
+        else: 
+            header = get_archive_headers(src, stop_after_first=True).get(src)
+
+        series_tasks = []
+        if header: 
+            series_tasks = export_series(exportinfo, src, header, fmts, 
+                    timepoint, stem, exportdir, checklist)
+        if series_tasks is None: 
+            exam['fingerprint'] = None  # to be looked at again next time
+            continue
+
+        if archive: 
+            # unpack the series for its exports, rather than reading src
+            archive.reserve(folder, len(series_tasks))
+            series_tasks = [(fmt, exporter, args + (archive, folder))
+                            for fmt, exporter, args in series_tasks]
+
+        tasks.extend(series_tasks)
+        exam['exported'][src] = (fingerprint, 
+            [os.path.join(args[1], args[2]) for _, _, args in series_tasks])
+    return tasks
+
+def strip_archive_ext(filename):
+    """Returns an archive's file name without its extension (e.g. .tar.gz)"""
+    exts = [ext for ext in ARCHIVE_EXTS if filename.endswith(ext)]
+    if exts: 
+        return filename[:-len(max(exts, key=len))]
+    return dm.utils.splitext(filename)[0]
+
+class ExamArchive(object):
+    """
+    A zip or tar archive of an exam, from which series are unpacked as they
+    are needed. 
+
+    The files in each folder of the archive (the folders attribute, in
+    archive order) are unpacked together into a scratch folder by extract(),
+    and the scratch folder is removed once each of the exports reserved for
+    the series (see reserve()) have called release(). 
+
+    The archive is open once created, so that its series can be planned
+    (see fingerprint() and read_header()), and should then be closed (see
+    close()) until its exports run, so that the archives of many exams
+    aren't held open at once. extract() opens it again, and it is closed
+    once every reserved export is done. 
+    """
+
+    def __init__(self, path, scratch=None):
+        self.path      = path
+        self.scratch   = scratch
+        self.lock      = threading.Lock()
+        self.uses      = {}   # folder -> exports yet to release the series
+        self.extracted = {}   # folder -> scratch folder
+        self.zip       = None
+        self.tar       = None
+        self.folders   = None
+        self.open()
+
+    def open(self):
+        """Opens the archive, if it isn't open, and lists its members"""
+        if self.zip or self.tar: 
+            return
+
+        # folder -> [(name, size, checksum, member)]
+        self.folders = collections.OrderedDict()
+        if zipfile.is_zipfile(self.path):
+            self.zip, self.tar = zipfile.ZipFile(self.path), None
+            members = [(i.filename, i.file_size, i.CRC, i) 
+                       for i in self.zip.infolist() 
+                       if not i.filename.endswith('/')]
+        else:
+            self.zip, self.tar = None, tarfile.open(self.path)
+            members = [(m.name, m.size, m.chksum, m) 
+                       for m in self.tar.getmembers() if m.isfile()]
+        for member in members:
+            folder = os.path.dirname(member[0])
+            self.folders.setdefault(folder, []).append(member)
+
+    def fingerprint(self, folder):
+        """
+        Returns a fingerprint of the files in a folder, from their names,
+        sizes and checksums (the zip CRC, or the tar header checksum). 
+        """
+        members = [member[:3] for member in self.folders[folder]]
+        return "{}:{}".format(len(members), 
+                              hashlib.md5(repr(members)).hexdigest())
+
+    def read_header(self, folder):
+        """
+        Reads the dicom headers of the series in a folder, from the first
+        dicom found in it (trying the most dicom-like files first, see
+        datman.utils.dicom_likeness). Returns None if there are no dicoms. 
+        """
+        import dicom
+        members = self.folders[folder]
+        if self.zip: 
+            members = sorted(members, 
+                             key=lambda m: dm.utils.dicom_likeness(m[3]))
+        with self.lock: 
+            for name, size, checksum, member in members: 
+                if size < dm.utils.DICOM_MIN_SIZE: 
+                    continue
+                if self.zip: 
+                    stream = self.zip.open(member)
+                else: 
+                    stream = self.tar.extractfile(member)
+                try: 
+                    return dm.utils.read_header(stream)
+                except dicom.filereader.InvalidDicomError: 
+                    continue
+                finally: 
+                    stream.close()
+        return None
+
+    def reserve(self, folder, uses):
+        """Notes that <uses> exports will extract and release the folder"""
+        with self.lock: 
+            self.uses[folder] = self.uses.get(folder, 0) + uses
+
+    def in_use(self):
+        """Are any exports yet to release their series?"""
+        with self.lock: 
+            return any(self.uses.values())
+
+    def close(self):
+        """
+        Closes the archive (forgetting its members until it is opened
+        again), and removes any series still unpacked
+        """
+        for seriesdir in self.extracted.values(): 
+            shutil.rmtree(seriesdir, ignore_errors=True)
+        self.extracted = {}
+        if self.zip or self.tar: 
+            (self.zip or self.tar).close()
+        self.zip, self.tar, self.folders = None, None, None
+
+    def extract(self, folder):
+        """
+        Unpacks the files in a folder, returning where they are (opening the
+        archive again if need be)
+        """
+        with self.lock: 
+            if folder not in self.extracted: 
+                self.open()
+                seriesdir = tempfile.mkdtemp(prefix='xnat-extract-', 
+                                             dir=self.scratch)
+                debug("Unpacking {}/{} to {}".format(
+                    self.path, folder, seriesdir))
+                try: 
+                    for name, size, checksum, member in self.folders[folder]:
+                        if self.zip: 
+                            stream = self.zip.open(member)
+                        else: 
+                            stream = self.tar.extractfile(member)
+                        path = os.path.join(seriesdir, os.path.basename(name))
+                        with open(path, 'wb') as f:
+                            shutil.copyfileobj(stream, f)
+                        stream.close()
+                except: 
+                    shutil.rmtree(seriesdir)
+                    raise
+                self.extracted[folder] = seriesdir
+            return self.extracted[folder]
+
+    def release(self, folder):
+        """Notes that an export is done with a folder"""
+        with self.lock: 
+            self.uses[folder] -= 1
+            if self.uses[folder] == 0 and folder in self.extracted: 
+                debug("Removing {}".format(self.extracted[folder]))
+                shutil.rmtree(self.extracted.pop(folder))
+            if not any(self.uses.values()): 
+                self.close()
+
+class SeriesVolume(object):
+    """
+    The image volume of a DICOM series, decoded once (see decode_series) and
+    shared by the series' exports. 
+
+    The series is decoded by the first export to load() it, and the volume
+    is dropped once each of the exports reserved for the series (see
+    reserve()) have called release(). If the series can't be decoded,
+    load() returns None and the exports fall back to the external
+    converters. 
+    """
+
+    def __init__(self):
+        self.lock    = threading.Lock()
+        self.uses    = 0      # exports yet to release the volume
+        self.loaded  = False
+        self.volume  = None
+
+    def reserve(self, uses):
+        """Notes that <uses> exports will load and release the volume"""
+        with self.lock: 
+            self.uses += uses
+
+    def load(self, seriesdir):
+        """Returns the decoded volume (a Volume), or None"""
+        with self.lock: 
+            if not self.loaded: 
+                self.loaded = True
+                try: 
+                    self.volume = decode_series(seriesdir)
+                    debug("Decoded {}: shape {}, {}".format(seriesdir, 
+                        self.volume.data.shape, self.volume.data.dtype))
+                except Exception, e: 
+                    verbose("Can't decode {} in-process, using external " \
+                            "converters: {}".format(seriesdir, e))
+            return self.volume
+
+    def release(self):
+        """Notes that an export is done with the volume"""
+        with self.lock: 
+            self.uses -= 1
+            if self.uses == 0: 
+                self.volume = None
+
+# a decoded DICOM series: its pixel data, as an array indexed by column, row
+# and slice, and the affine that maps those indices to patient (LPS)
+# coordinates in mm
+Volume = collections.namedtuple('Volume', ['data', 'affine'])
+
+def decode_series(seriesdir):
+    """
+    Decodes a DICOM series into a Volume. 
+
+    Only a single volume of uncompressed, single-frame slices with the same
+    size and orientation, evenly spaced, can be decoded. Raises ValueError
+    for anything else (e.g. mosaics, multi-frame DICOMs, or multi-volume
+    series). Rescaled pixel values are decoded as floats. 
+    """
+    import dicom
+    import numpy as np
+
+    slices = []
+    for path in list_dicoms(seriesdir): 
+        ds = dicom.read_file(path)
+        if ds.file_meta.TransferSyntaxUID not in UNCOMPRESSED_SYNTAXES: 
+            raise ValueError("{} is compressed".format(path))
+        if int(getattr(ds, 'NumberOfFrames', 1) or 1) != 1: 
+            raise ValueError("{} is multi-frame".format(path))
+        if 'MOSAIC' in getattr(ds, 'ImageType', []): 
+            raise ValueError("{} is a mosaic".format(path))
+        if int(getattr(ds, 'SamplesPerPixel', 1)) != 1: 
+            raise ValueError("{} is not greyscale".format(path))
+        slices.append(ds)
+    if not slices: 
+        raise ValueError("No DICOMs found")
+
+    geometries = set((ds.Rows, ds.Columns, 
+                      tuple(round(float(n), 4) 
+                            for n in ds.ImageOrientationPatient),
+                      tuple(round(float(n), 4) for n in ds.PixelSpacing))
+                     for ds in slices)
+    if len(geometries) > 1: 
+        raise ValueError("Slices differ in size, orientation or spacing")
+
+    orientation = np.array(slices[0].ImageOrientationPatient, dtype=float)
+    row, column = orientation[:3], orientation[3:]
+    normal      = np.cross(row, column)
+    positions   = np.array([ds.ImagePositionPatient for ds in slices], 
+                           dtype=float)
+    order       = np.argsort(positions.dot(normal), kind='mergesort')
+    positions   = positions[order]
+    slices      = [slices[i] for i in order]
+
+    if len(slices) > 1: 
+        steps = np.diff(positions, axis=0)
+        step  = steps.mean(axis=0)
+        if np.linalg.norm(step) < 0.01: 
+            raise ValueError("Slices share a position (more than one volume)")
+        if not np.allclose(steps, step, atol=0.01): 
+            raise ValueError("Slices are unevenly spaced or share positions")
+    else: 
+        step = normal * float(getattr(slices[0], 'SliceThickness', 1) or 1)
+
+    planes = []
+    for ds in slices: 
+        pixels    = ds.pixel_array.T   # column, row
+        slope     = float(getattr(ds, 'RescaleSlope', 1))
+        intercept = float(getattr(ds, 'RescaleIntercept', 0))
+        if (slope, intercept) != (1, 0): 
+            pixels = pixels.astype(np.float32) * slope + intercept
+        planes.append(pixels)
+
+    row_spacing, column_spacing = [float(n) for n in slices[0].PixelSpacing]
+    affine = np.eye(4)
+    affine[:3, 0] = row * column_spacing
+    affine[:3, 1] = column * row_spacing
+    affine[:3, 2] = step
+    affine[:3, 3] = positions[0]
+    return Volume(np.dstack(planes), affine)
+
+def write_nii(volume, path):
+    """Writes a decoded series (see decode_series) as a NifTi"""
+    import nibabel
+    import numpy as np
+
+    # nifti coordinates are RAS rather than LPS
+    affine = np.diag([-1, -1, 1, 1]).dot(volume.affine)
+    image = nibabel.Nifti1Image(volume.data, affine)
+    image.set_qform(affine, code=1)   # scanner coordinates
+    image.set_sform(affine, code=1)
+    image.header.set_xyzt_units('mm')
+    nibabel.save(image, path)
+
+def write_nrrd(volume, path):
+    """Writes a decoded series (see decode_series) as a gzipped NRRD"""
+    data = volume.data
+    vector = lambda v: "({})".format(",".join(repr(float(n)) for n in v))
+    header = [
+        "NRRD0004",
+        "type: {}".format(NRRD_TYPES[data.dtype.name]),
+        "dimension: 3",
+        "space: left-posterior-superior",
+        "sizes: {}".format(" ".join(str(n) for n in data.shape)),
+        "space directions: {}".format(
+            " ".join(vector(volume.affine[:3, i]) for i in range(3))),
+        "kinds: domain domain domain",
+        "endian: little",
+        "encoding: gzip",
+        "space origin: {}".format(vector(volume.affine[:3, 3])),
+    ]
+    with open(path, 'wb') as stream: 
+        stream.write("\n".join(header) + "\n\n")
+        compressed = gzip.GzipFile(fileobj=stream, mode='wb')
+        compressed.write(
+            data.astype(data.dtype.newbyteorder('<')).tobytes(order='F'))
+        compressed.close()
+
+def export(src, outputdir, stem, exporter, header=None, volume=None, 
+           archive=None, folder=None):
+    """
+    Exports a series using one of the exporters, given the series' header
+    and decoded volume (a SeriesVolume) to share with its other exports. 
+
+    If the series is in a zip or tar archive (see ExamArchive) it is unpacked
+    from the archive first (except in a dry run, when nothing is unpacked).
+    The archive's copy of the series, and the decoded volume, are released
+    once done. 
+    """
+    try: 
+        if archive and DRYRUN: 
+            verbose("Would unpack {} to export it to {}".format(
+                src, os.path.join(outputdir, stem)))
+            return
+        seriesdir = archive.extract(folder) if archive else src
+        exporter(seriesdir, outputdir, stem, header, volume)
+    finally: 
+        if archive: archive.release(folder)
+        if volume: volume.release()
+
+def get_series_folders(archivepath):
+    """
+    Returns the folders within an archive that may hold a series, i.e. every
+    folder that contains files. 
+    """
+    folders = []
+    for dirpath, dirnames, filenames in os.walk(archivepath):
+        if filenames: 
+            folders.append(dirpath)
+    return sorted(folders)
+
+def get_settings(exportinfo):
+    """
+    Returns a fingerprint of the export settings. Exports made with different
+    settings are not reused. 
+    """
+    return hashlib.md5(exportinfo.table.to_csv(index=False)).hexdigest()
+
+def read_manifest(manifestfile, settings):
+    """
+    Reads the export manifest for an exam. 
+
+    The manifest records a fingerprint (see datman.utils.fingerprint) of each
+    series folder in the exam, along with the fingerprint of each file
+    exported from it, as JSON: 
+
+        {
+          "settings": "<fingerprint of the exportinfo table>",
+          "series": {
+            "SCANS/2/DICOM": {
+              "fingerprint": "...",
+              "outputs": {"nii/SPN01_CMH_0001_01/...nii.gz": "...", ...}
+            },
+            ...
+          }
+        }
+
+    Series folders are relative to the exam folder, and outputs are relative
+    to the data folder. Series that were not exported (e.g. because they
+    didn't match any pattern) are recorded with no outputs. 
+
+    Returns an empty manifest if there is none yet, or if it was written with
+    different settings. 
+    """
+    manifest = {'settings': settings, 'series': {}}
+    if not os.path.exists(manifestfile):
+        return manifest
+
+    try:
+        with open(manifestfile) as stream:
+            saved = json.load(stream)
+    except ValueError, e:
+        error("Manifest {} is corrupt, ignoring it: {}".format(manifestfile, e))
+        return manifest
+
+    if saved.get('settings') != settings:
+        verbose("Export settings have changed since {} was written. " \
+                "Ignoring it.".format(manifestfile))
+        return manifest
+    return saved
+
+def is_stale(record, exportdir):
+    """
+    Returns True if any output in a series' manifest record is missing, or
+    has changed since it was exported. 
+    """
+    for output, output_fingerprint in record['outputs'].items():
+        path = os.path.join(exportdir, output)
+        if not os.path.exists(path) or \
+                dm.utils.fingerprint(path) != output_fingerprint:
+            return True
+    return False
+
+def remove_stale_outputs(record, fingerprint, exportdir):
+    """
+    Checks the manifest record of a series against the series' fingerprint. 
+
+    If the series has changed, all of the outputs exported from it are
+    removed. Otherwise, any outputs that have changed since they were exported
+    (e.g. were only partly written) are removed. 
+
+    Returns True if the series needs to be exported again. 
+    """
+    stale = False
+    changed = record['fingerprint'] != fingerprint
+    for output, output_fingerprint in record['outputs'].items():
+        path = os.path.join(exportdir, output)
+        if not os.path.exists(path): 
+            stale = True
+        elif changed or dm.utils.fingerprint(path) != output_fingerprint:
+            verbose("{} is out of date. Removing.".format(path))
+            remove(path)
+            stale = True
+    return changed or stale
+
+def update_manifest(exam, failed):
+    """
+    Records the series exported from an exam in its manifest. 
+
+    <failed> is the set of series folders with exports that failed, which are
+    left out of the manifest so that they are exported again next time. 
+    """
+    if DRYRUN or not exam['exported']: 
+        return
+
+    exportdir = exam['exportdir']
+    series    = exam['manifest']['series']
+    exam['manifest']['fingerprint'] = exam['fingerprint']
+    for src, (fingerprint, stems) in exam['exported'].items():
+        key = os.path.relpath(src, exam['archivepath'])
+        if src in failed: 
+            series.pop(key, None)
+            exam['manifest']['fingerprint'] = None
+            continue
+
+        outputs = {}
+        for stem in stems: 
+            for path in glob.glob(stem + ".*"):
+                outputs[os.path.relpath(path, exportdir)] = \
+                    dm.utils.fingerprint(path)
+        series[key] = {'fingerprint': fingerprint, 'outputs': outputs}
+
+    manifestfile = exam['manifestfile']
+    debug("Updating manifest {}".format(manifestfile))
+    if not os.path.exists(os.path.dirname(manifestfile)):
+        makedirs(os.path.dirname(manifestfile))
+    with open(manifestfile + ".tmp", 'w') as stream:
+        json.dump(exam['manifest'], stream, indent=2, sort_keys=True)
+    os.rename(manifestfile + ".tmp", manifestfile)
 
 def export_series(exportinfo, src, header, formats, timepoint, stem, 
         exportdir, checklist):
     """
-    Exports the given DICOM folder into the given formats.
+    Plans the export of the given DICOM folder into the given formats.
+
+    <exportinfo> is a datman.exportinfo.ExportInfo. 
+
+    Returns a list of export tasks (see extract_archive), or None if the
+    series is to be skipped for now (it is blacklisted, or the export patterns
+    are ambiguous), rather than because there is nothing to export. 
     """
     description   = header.get("SeriesDescription")
     mangled_descr = dm.utils.mangle(description)
     series        = str(header.get("SeriesNumber")).zfill(2)
-    tagmap        = dict(zip(exportinfo['pattern'].tolist(),
-                             exportinfo['tag'].tolist()))
-    tag           = dm.utils.guess_tag(mangled_descr, tagmap)
+    tag, exports  = exportinfo.lookup(mangled_descr)
 
     debug("{}: description = {}, series = {}, tag = {}".format(
         src, description, series, tag))
@@ -255,23 +1097,27 @@ def export_series(exportinfo, src, header, formats, timepoint, stem,
     if not tag:
         verbose("No matching export pattern for {}, descr: {}. Skipping".format( 
             src, description))
-        return 
+        return []
     elif type(tag) is list: 
         error("Multiple export patterns match for {}, descr: {}, tags: {}".format(
             src, description, tag))
-        return
-
-    tag_exportinfo = exportinfo[exportinfo['tag'] == tag]
+        return None
 
     # update the filestem with _tag_series_description
     stem  += "_" + "_".join([tag,series,mangled_descr]) 
 
     if checklist.is_blacklisted(STAGE_NAME, stem):
         debug("{} in blacklist. Skipping.".format(stem))
-        return 
+        return None
+
+    # the series' header, and its decoded volume, are shared by its exports
+    volume = None
+    if IN_PROCESS and any(fmt in exports for fmt in DECODED_FORMATS): 
+        volume = SeriesVolume()
 
+    tasks = []
     for fmt in formats:
-        if all(tag_exportinfo['export_'+fmt] == 'no'):
+        if fmt not in exports:
             debug("{}: export_{} set to 'no' for tag {} so skipping".format(
                 src, fmt, tag))
             continue
@@ -279,19 +1125,12 @@ def export_series(exportinfo, src, header, formats, timepoint, stem,
         outputdir  = os.path.join(exportdir,fmt,timepoint)
         if not os.path.exists(outputdir): makedirs(outputdir)
 
-        exporters[fmt](src,outputdir,stem)
-
-def get_formats_from_exportinfo(dataframe):
-    """
-    Gets the export formats from the column names in an exportinfo table.
-
-    Columns that begin with "export_" are extracted, and the format identifier
-    from each column is returned, as a list. 
-    """
+        tasks.append((fmt, export, 
+                      (src,outputdir,stem,exporters[fmt],header,volume)))
 
-    columns = dataframe.columns.values.tolist()
-    formats = [c.split("_")[1] for c in columns if c.startswith("export_")]
-    return formats
+    if volume: 
+        volume.reserve(len(tasks))
+    return tasks
 
 def export_resources(archivepath, exportdir, scanid):
     """
@@ -309,7 +1148,7 @@ def export_resources(archivepath, exportdir, scanid):
     if not os.path.exists(outputdir): makedirs(outputdir)
     run("rsync -r {}/ {}/".format(sourcedir, outputdir))
 
-def export_mnc_command(seriesdir,outputdir,stem):
+def export_mnc_command(seriesdir,outputdir,stem,header=None,volume=None):
     """
     Converts a DICOM series to MINC format
     """
@@ -321,13 +1160,19 @@ def export_mnc_command(seriesdir,outputdir,stem):
         return
 
     verbose("Exporting series {} to {}".format(seriesdir, outputfile))
-    cmd = 'dcm2mnc -fname {} -dname "" {}/* {}'.format(
-            stem,seriesdir,outputdir)
-    run(cmd)
-
-def export_nii_command(seriesdir,outputdir,stem):
+    tmpdir = make_tempdir(outputdir)
+    try: 
+        cmd = 'dcm2mnc -fname {} -dname "" {}/* {}'.format(
+                stem,seriesdir,tmpdir)
+        run(cmd)
+        rename(os.path.join(tmpdir,stem) + ".mnc", outputfile)
+    finally: 
+        remove_tempdir(tmpdir)
+
+def export_nii_command(seriesdir,outputdir,stem,header=None,volume=None):
     """
-    Converts a DICOM series to NifTi format
+    Converts a DICOM series to NifTi format, from its decoded volume (a
+    SeriesVolume) if it can be decoded, or else with dcm2nii. 
     """
     outputfile = os.path.join(outputdir,stem) + ".nii.gz"
 
@@ -339,22 +1184,39 @@ def export_nii_command(seriesdir,outputdir,stem):
     verbose("Exporting series {} to {}".format(seriesdir, outputfile))
 
     # convert into tempdir
-    tmpdir = tempfile.mkdtemp()
-    run('dcm2nii -x n -g y  -o {} {}'.format(tmpdir,seriesdir))
-
-    # move nii in tempdir to proper location
-    for f in glob.glob("{}/*".format(tmpdir)):
-        bn = os.path.basename(f)
-        ext = dm.utils.get_extension(f)
-        if bn.startswith("o") or bn.startswith("co"): 
-            continue
-        else:
-            run("mv {} {}/{}{}".format(f, outputdir, stem, ext))
-    shutil.rmtree(tmpdir)
-
-def export_nrrd_command(seriesdir,outputdir,stem):
+    tmpdir = make_tempdir(outputdir)
+    try: 
+        decoded = volume.load(seriesdir) if volume and not DRYRUN else None
+        if decoded is not None: 
+            tmpfile = os.path.join(tmpdir,stem) + ".nii.gz"
+            debug("write: {}".format(tmpfile))
+            write_nii(decoded, tmpfile)
+        else: 
+            run('dcm2nii -x n -g y  -o {} {}'.format(tmpdir,seriesdir))
+
+        # move nii in tempdir to proper location, the .nii.gz last so that
+        # the other files (e.g. .bvec) are in place if it is
+        outputs = {}
+        for f in glob.glob("{}/*".format(tmpdir)):
+            bn = os.path.basename(f)
+            ext = dm.utils.get_extension(f)
+            if bn.startswith("o") or bn.startswith("co"): 
+                continue
+            outputs[os.path.join(outputdir,stem) + ext] = f
+
+        niftis = [f for ext, f in outputs.items() if ext == outputfile]
+        if VERIFY and niftis: 
+            verify_nii(niftis[0], seriesdir)
+
+        for output in sorted(outputs, key=lambda f: f == outputfile):
+            rename(outputs[output], output)
+    finally: 
+        remove_tempdir(tmpdir)
+
+def export_nrrd_command(seriesdir,outputdir,stem,header=None,volume=None):
     """
-    Converts a DICOM series to NRRD format
+    Converts a DICOM series to NRRD format, from its decoded volume (a
+    SeriesVolume) if it can be decoded, or else with DWIConvert. 
     """
     outputfile = os.path.join(outputdir,stem) + ".nrrd"
 
@@ -365,14 +1227,29 @@ def export_nrrd_command(seriesdir,outputdir,stem):
 
     verbose("Exporting series {} to {}".format(seriesdir, outputfile))
 
-    cmd = 'DWIConvert -i {} --conversionMode DicomToNrrd -o {}.nrrd ' \
-          '--outputDirectory {}'.format(seriesdir,stem,outputdir)
-
-    run(cmd)
-
-def export_dcm_command(seriesdir,outputdir,stem):
+    tmpdir = make_tempdir(outputdir)
+    try: 
+        tmpfile = os.path.join(tmpdir,stem) + ".nrrd"
+        decoded = volume.load(seriesdir) if volume and not DRYRUN else None
+        if decoded is not None: 
+            debug("write: {}".format(tmpfile))
+            write_nrrd(decoded, tmpfile)
+        else: 
+            cmd = 'DWIConvert -i {} --conversionMode DicomToNrrd ' \
+                  '-o {}.nrrd --outputDirectory {}'.format(
+                    seriesdir,stem,tmpdir)
+            run(cmd)
+        rename(tmpfile, outputfile)
+    finally: 
+        remove_tempdir(tmpdir)
+
+def export_dcm_command(seriesdir,outputdir,stem,header=None,volume=None):
     """
     Copies a single DICOM from the series.
+
+    This is the file the series' header was read from, if it is in the
+    series folder, so that the series doesn't need to be searched for a
+    DICOM again. 
     """
     outputfile = os.path.join(outputdir,stem) + ".dcm"
     if os.path.exists(outputfile):
@@ -381,19 +1258,89 @@ def export_dcm_command(seriesdir,outputdir,stem):
         return
 
     import dicom
-    dcmfile = None
-    for path in glob.glob(seriesdir + '/*'):
-        try:
-            dicom.read_file(path)
-            dcmfile = path            
-            break
-        except dicom.filereader.InvalidDicomError, e:
-            pass
+    dcmfile = getattr(header, 'filename', None)
+    if not (dcmfile and os.path.isfile(dcmfile) and 
+            os.path.samefile(os.path.dirname(dcmfile), seriesdir)):
+        dcmfile = None
+        for path in sorted(glob.glob(seriesdir + '/*')):
+            try:
+                dm.utils.read_header(path)
+                dcmfile = path            
+                break
+            except dicom.filereader.InvalidDicomError, e:
+                pass
     
     assert dcmfile is not None, "No dicom files found in {}".format(seriesdir)
     verbose("Exporting a dcm file from {} to {}".format(seriesdir, outputfile))
-    cmd = 'cp {} {}'.format(dcmfile, outputfile)
-    run(cmd)
+    tmpdir = make_tempdir(outputdir)
+    try: 
+        tmpfile = os.path.join(tmpdir,stem) + ".dcm"
+        run('cp {} {}'.format(dcmfile, tmpfile))
+        rename(tmpfile, outputfile)
+    finally: 
+        remove_tempdir(tmpdir)
+
+def make_tempdir(outputdir):
+    """
+    Makes a temporary folder in outputdir to export into. 
+
+    Exports are written here first and then renamed into place, so that an
+    output only appears once it is complete (renaming is atomic within a
+    filesystem). An interrupted export leaves only a .xnat-extract-* folder. 
+    """
+    if DRYRUN: 
+        return os.path.join(outputdir, ".xnat-extract-tmp")
+    return tempfile.mkdtemp(prefix=".xnat-extract-", dir=outputdir)
+
+def remove_tempdir(tmpdir):
+    if not DRYRUN: shutil.rmtree(tmpdir, ignore_errors=True)
+
+def rename(src, dst):
+    """Moves a finished export from its temporary folder into place"""
+    debug("rename: {} {}".format(src, dst))
+    if DRYRUN: 
+        return
+    if not os.path.exists(src): 
+        raise ValueError("Expected output {} was not made".format(src))
+    os.rename(src, dst)
+
+def list_dicoms(seriesdir):
+    """
+    Lists the DICOM files in a series folder, by name (i.e. leaving out files
+    with a known non-dicom extension, see datman.utils.NON_DICOM_EXTS). 
+    """
+    return [os.path.join(seriesdir, f) for f in sorted(os.listdir(seriesdir))
+            if os.path.isfile(os.path.join(seriesdir, f)) and 
+               f != 'DICOMDIR' and
+               os.path.splitext(f)[1].lower() not in dm.utils.NON_DICOM_EXTS]
+
+def count_dicoms(seriesdir):
+    """Counts the DICOM files in a series folder (see list_dicoms)"""
+    return len(list_dicoms(seriesdir))
+
+def verify_nii(niftifile, seriesdir):
+    """
+    Checks a converted NifTi against the DICOM series it came from. 
+
+    The number of DICOMs should match the number of slices times the number
+    of volumes (one slice per file), the number of volumes (e.g. mosaics, one
+    volume per file), or be 1 (multi-frame). Any axis may be the slice axis,
+    since the converter may reorient the image. 
+
+    Raises ValueError if the NifTi doesn't match. 
+    """
+    import nibabel
+    shape = nibabel.load(niftifile).shape
+    volumes = 1
+    for n in shape[3:]: 
+        volumes *= n
+    expected = set([1, volumes] + [n * volumes for n in shape[:3]])
+    dicoms = count_dicoms(seriesdir)
+    debug("verify: {} has shape {}, {} has {} dicoms".format(
+        niftifile, shape, seriesdir, dicoms))
+    if dicoms not in expected: 
+        raise ValueError("NifTi of shape {} doesn't match the {} DICOMs in " \
+                         "{}".format(shape, dicoms, seriesdir))
 
 exporters = {
     "mnc" : export_mnc_command,
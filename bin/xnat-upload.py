@@ -21,6 +21,13 @@ Options:
     -u,--username USER    XNAT username. If specified then the credentials
                           file is ignored and you are prompted for password.
 
+    -j,--jobs N           Number of non-dicom files to upload at once
+                          [default: 4]
+
+    --retries N           Number of times to retry a request if the server
+                          can't be reached or is unavailable (waiting a
+                          little longer before each retry) [default: 5]
+
     -v,--verbose          Be chatty
 
 """
@@ -28,13 +35,14 @@ from docopt import docopt
 import datman as dm
 import datman.scanid
 import datman.utils
-import dicom as dcm
 import getpass
-import io
 import logging
+import multiprocessing.pool
 import os.path
 import requests
+import requests.adapters
 import sys
+import time
 import zipfile
 
 logging.basicConfig(level=logging.WARN,
@@ -53,6 +61,13 @@ ATTACH_URL = "{server}/data/archive/projects/{project}/subjects/{subject}" \
 
 dcm_exts = ('dcm','img')
 
+# HTTP statuses worth retrying a request after (i.e. the server or a proxy
+# in front of it being briefly unavailable)
+RETRY_STATUSES = (500, 502, 503, 504)
+
+# seconds to wait before the first retry, doubling with each retry after
+BACKOFF = 2
+
 def main():
     arguments = docopt(__doc__)
     server   = arguments['--server']
@@ -61,6 +76,8 @@ def main():
     verbose  = arguments['--verbose']
     username = arguments['--username']
     credfile = arguments['--credfile']
+    jobs     = int(arguments['--jobs'])
+    retries  = int(arguments['--retries'])
 
     if verbose:
         logger.setLevel(logging.INFO)
@@ -78,72 +95,134 @@ def main():
         logger.error("{} is not a valid scan identifier".format(scanid))
         sys.exit(1)
 
-    subject = scanid
-    session = scanid
-    auth = (username, password) 
+    session = make_session((username, password), jobs)
+    upload(session, server, project, scanid, archive, jobs, retries)
+
+    print("Subject {} uploaded to xnat".format(scanid))
+
+def make_session(auth, jobs=1):
+    """
+    Returns a requests.Session that keeps enough connections to the server
+    open for <jobs> uploads at once.
+    """
+    session = requests.Session()
+    session.auth = auth
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                            pool_maxsize=max(jobs, 1))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def upload(session, server, project, scanid, archive, jobs=1, retries=0):
+    """
+    Uploads an exam archive to XNAT, as subject and session <scanid>.
+
+    Each request is retried up to <retries> times if it fails because the
+    server is unavailable, so that a failure part way through only repeats
+    the request that failed.
+    """
     url_params = { 'server'  : server,
                    'project' : project,
-                   'subject' : subject,
-                   'session' : session }
+                   'subject' : scanid,
+                   'session' : scanid }
 
     # Upload
     # https://wiki.xnat.org/pages/viewpage.action?pageId=5017279
 
     # create the subject
-    logger.info("Creating subject {}".format(subject))
-    r = requests.put(CREATE_URL.format(**url_params), auth=auth)
-    
-    r.raise_for_status()
+    logger.info("Creating subject {}".format(scanid))
+    request(session, 'PUT', CREATE_URL.format(**url_params), retries)
 
-    # upload the DICOM data
+    # upload the DICOM data, streamed from the archive (XNAT only takes the
+    # archive as a whole, so a retry has to send it again from the start)
     # NOTE: If your project is not set to auto archive, then this will end up
     # in the prearchive
     logger.info("Uploading dicom data...")
-    r = requests.post(UPLOAD_URL.format(**url_params), 
-            auth=auth, 
+    request(session, 'POST', UPLOAD_URL.format(**url_params), retries,
             headers={'Content-Type' : 'application/zip'},
-            data=open(archive))
-            
-    r.raise_for_status()
+            data=lambda: open(archive, 'rb'))
 
     # upload non-dicom stuff
     logger.info("Scanning for non-dicom data...")
     zf = zipfile.ZipFile(archive)
+    files = find_non_dicoms(zf)
 
+    logger.info("Uploading non-dicom data...")
+    def attach(filename):
+        url = ATTACH_URL.format(filename=filename, **url_params)
+        try:
+            request(session, 'POST', url, retries,
+                    data=lambda: zf.read(filename))
+        except requests.exceptions.RequestException, e:
+            logger.error("ERROR uploading file {}".format(filename))
+            raise e
+
+    if jobs > 1 and len(files) > 1:
+        pool = multiprocessing.pool.ThreadPool(min(jobs, len(files)))
+        try:
+            pool.map(attach, files)
+        finally:
+            pool.close()
+    else:
+        map(attach, files)
+
+def request(session, method, url, retries=0, data=None, **kwargs):
+    """
+    Makes a request, retrying (after waiting BACKOFF seconds, then twice
+    that, and so on) if the server can't be reached or is unavailable.
+
+    <data> is a function returning the request body, called for each attempt
+    so that a file body is read from the start each time. Raises
+    requests.exceptions.HTTPError if the request fails.
+    """
+    for attempt in range(retries + 1):
+        body = data and data()
+        try:
+            r = session.request(method, url, data=body, **kwargs)
+            if r.status_code not in RETRY_STATUSES or attempt == retries:
+                r.raise_for_status()
+                return r
+            reason = "{} {}".format(r.status_code, r.reason)
+            r.close()
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout), e:
+            if attempt == retries:
+                raise
+            reason = str(e)
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+
+        wait = BACKOFF * 2 ** attempt
+        logger.warn("{} {} failed ({}). Retrying in {} seconds.".format(
+            method, url, reason, wait))
+        time.sleep(wait)
+
+def find_non_dicoms(zf):
+    """Returns the names of the files in a zipfile.ZipFile that aren't dicoms"""
     # filter dirs
-    files = zf.namelist()
-    files = filter(lambda f: not f.endswith('/'), files)
+    files = filter(lambda f: not f.endswith('/'), zf.namelist())
 
     # filter files named like dicoms
     files = filter(lambda f: not is_named_like_a_dicom(f), files)
 
-    # filter actual dicoms :D
-    files = filter(lambda f: not is_dicom(io.BytesIO(zf.read(f))), files)
-
-    logger.info("Uploading non-dicom data...")
-    for f in files:
-        r = None
-        try:
-            r = requests.post(ATTACH_URL.format(filename=f, **url_params),
-                    data=zf.read(f),
-                    auth=auth)
-
-            r.raise_for_status() 
-        except requests.exceptions.HTTPError, e:
-            logger.error("ERROR uploading file {}".format(f))
-            raise e
-
-    print("Subject {} uploaded to xnat".format(subject))
+    # filter actual dicoms, by the start of each file only :D
+    files = filter(lambda f: not is_dicom(zf.open(f)), files)
+    return files
 
 def is_named_like_a_dicom(path):
     return any(map(lambda x: path.lower().endswith(x), dcm_exts))
 
 def is_dicom(fileobj):
+    """
+    Checks for the 'DICM' prefix following the 128 byte preamble, reading no
+    more of the file than that.
+    """
     try:
-        dcm.read_file(fileobj)
-        return True
-    except dcm.filereader.InvalidDicomError:
-        return False
+        prefix = fileobj.read(dm.utils.DICOM_MIN_SIZE)
+    finally:
+        fileobj.close()
+    return prefix[128:] == 'DICM'
 
 if __name__ == '__main__':
     try:
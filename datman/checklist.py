@@ -1,4 +1,10 @@
 import collections
+import contextlib
+import fcntl
+import os
+import re
+import sqlite3
+import tempfile
 import yaml
 
 tree = lambda: collections.defaultdict(tree)
@@ -59,36 +65,100 @@ class Checklist:
     """
 
     def __init__(self, stream=None):
-        if not stream:
-            self.data = tree()
+        # changes made since loading, as (section, key) -> value for entries
+        # blacklisted and a set of (section, key) for entries unblacklisted
+        self._added = {}
+        self._removed = set()
+
+        # When possible, only the outline of the document is read to start
+        # with, and each /blacklist/<stage> section is parsed the first time
+        # it is used (see index_sections). _unparsed holds the text of the
+        # sections not yet parsed, and _data is None until the whole document
+        # is needed.
+        self._data = None
+        self._unparsed = {}
+        self._text = stream.read() if stream else ''
+
+        self._blacklist = tree()
+
+        index = index_sections(self._text)
+        if index:
+            self._unparsed = index
         else:
-            self.data = tree_load(stream, yaml.SafeLoader) or tree()
-        
-        if not isinstance(self.data, dict):
+            self._parse()
+
+    @property
+    def data(self):
+        """The checklist document, as a tree of dictionaries"""
+        if self._data is None:
+            self._parse()
+        return self._data
+
+    def _parse(self):
+        """Parses the entire document, keeping any sections parsed so far"""
+        data = tree_load(self._text, yaml.SafeLoader) or tree()
+
+        if not isinstance(data, dict):
             raise FormatError("root node is not a dict")
 
-        self._blacklist = self.data['blacklist']
-        
-        if not isinstance(self._blacklist, dict):
+        if not isinstance(data['blacklist'], dict):
             raise FormatError("node /blacklist does not contain a dict")
-    
+
+        data['blacklist'].update(self._blacklist)
+        self._data = data
+        self._blacklist = data['blacklist']
+        self._unparsed = {}
+
+    def _section(self, section):
+        """Returns /blacklist/<section>, parsing it if need be"""
+        text = self._unparsed.pop(section, None)
+        if text is not None:
+            parsed = tree_load(text, yaml.SafeLoader)
+            if isinstance(parsed, dict) and parsed.keys() == [section]:
+                self._blacklist[section] = parsed[section]
+            else:
+                # not the simple key we took it for, so fall back to parsing
+                # the whole document
+                self._unparsed[section] = text
+                self._parse()
+        return self._blacklist[section]
+
     def blacklist(self, section, key, value=None):
         if not self.is_blacklisted(section, key): 
             self._blacklist[section][key] = value
+            self._added[(section, key)] = value
+            self._removed.discard((section, key))
 
     def is_blacklisted(self, section, key):
-        _section = self._blacklist[section]
+        _section = self._section(section)
 
         if not isinstance(_section, dict):
             raise FormatError("/blacklist/{} does not contain dicts".format(section))
 
-        return key in self._blacklist[section]
+        return key in _section
 
     def unblacklist(self, section, key):
         try:
-            del self._blacklist[section][key]
+            del self._section(section)[key]
         except KeyError:
             pass
+        self._added.pop((section, key), None)
+        self._removed.add((section, key))
+
+    def merge(self, stream):
+        """Re-reads the checklist from stream and re-applies the changes made
+        to this checklist since it was loaded.
+
+        Entries blacklisted or unblacklisted by someone else in the meantime
+        are kept, unless this checklist changed the same entry.
+        """
+        changes = self._added, self._removed
+        self.__init__(stream)
+        added, removed = changes
+        for section, key in removed:
+            self.unblacklist(section, key)
+        for (section, key), value in added.items():
+            self.blacklist(section, key, value)
 
     def save(self, stream):
         yaml.dump(self.data, stream, default_flow_style=False)
@@ -100,17 +170,276 @@ class Checklist:
         return str(self)
 
 
-def load(stream_or_file=None):
-    """Convenience method for loading a checklist from a file or stream"""
-    stream = stream_or_file
-    if isinstance(stream_or_file, basestring):
-        stream = open(stream_or_file, 'r')
-    return Checklist(stream)
+class SQLiteChecklist:
+    """A checklist backed by a sqlite database instead of a YAML document.
+
+    This has the same interface as Checklist, but each blacklist entry is a
+    row in an indexed table, so looking up an entry doesn't require loading
+    the whole checklist, and each change is written to the database
+    immediately (and atomically) rather than when the checklist is saved.
+
+    YAML checklists can be imported with import_yaml(), and save() writes the
+    checklist out as a YAML document, so the two are interchangeable:
+
+        c = datman.checklist.load('checklist.db')
+        c.import_yaml(open('checklist.yaml'))
+        ...
+        c.save(open('checklist.yaml', 'w'))
+
+    Sections of the YAML document other than /blacklist are kept as-is.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS blacklist (
+            section TEXT,
+            key     TEXT,
+            value   TEXT,
+            PRIMARY KEY (section, key)
+        );
+        CREATE TABLE IF NOT EXISTS documents (
+            name    TEXT PRIMARY KEY,
+            value   TEXT
+        );
+        """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.text_factory = str   # as in YAML, so exports are the same
+        self.db.executescript(self.SCHEMA)
+
+    def blacklist(self, section, key, value=None):
+        with self.db:
+            self.db.execute(
+                'INSERT OR IGNORE INTO blacklist VALUES (?, ?, ?)',
+                (section, key, yaml.safe_dump(value)))
+
+    def is_blacklisted(self, section, key):
+        return self.db.execute(
+            'SELECT 1 FROM blacklist WHERE section = ? AND key = ?',
+            (section, key)).fetchone() is not None
 
-def save(checklist, stream_or_file):
-    """Convenience method for saving a checklist from a file or stream"""
-    stream = stream_or_file
-    if isinstance(stream_or_file, basestring):
-        stream = open(stream_or_file, 'w')
+    def unblacklist(self, section, key):
+        with self.db:
+            self.db.execute(
+                'DELETE FROM blacklist WHERE section = ? AND key = ?',
+                (section, key))
+
+    def import_yaml(self, stream):
+        """Adds the contents of a YAML checklist to this one"""
+        data = Checklist(stream).data
+        with self.db:
+            blacklist = data.pop('blacklist', None) or {}
+            for section, entries in blacklist.items():
+                if not isinstance(entries, dict):
+                    raise FormatError(
+                        "/blacklist/{} does not contain dicts".format(section))
+                self.db.executemany(
+                    'INSERT OR REPLACE INTO blacklist VALUES (?, ?, ?)',
+                    [(section, key, yaml.safe_dump(value))
+                     for key, value in entries.items()])
+            self.db.executemany(
+                'INSERT OR REPLACE INTO documents VALUES (?, ?)',
+                [(name, yaml.safe_dump(value)) for name, value in data.items()])
+
+    def export_yaml(self):
+        """Returns the checklist as a dictionary, as it is in YAML"""
+        data = tree()
+        for name, value in self.db.execute('SELECT name, value FROM documents'):
+            data[name] = yaml.safe_load(value)
+        data['blacklist']  # always present, even if empty
+        for section, key, value in self.db.execute(
+                'SELECT section, key, value FROM blacklist'):
+            data['blacklist'][section][key] = yaml.safe_load(value)
+        return data
+
+    def save(self, stream):
+        yaml.dump(self.export_yaml(), stream, default_flow_style=False)
+
+    def __str__(self):
+        return yaml.dump(self.export_yaml(), default_flow_style=False)
+
+    def __repr__(self):
+        return str(self)
 
-    checklist.save(stream)
+
+# a top-level key in a YAML document, or a key within /blacklist, which needs
+# no quoting or conversion (e.g. not "no", "123" or "'quoted'")
+YAML_KEY_RE = re.compile(r"^( *)([A-Za-z_][\w.-]*):(?:[ ]+(.*?))?[ ]*(?:#.*)?$")
+
+def index_sections(text):
+    """Finds the text of each /blacklist/<stage> section of a checklist.
+
+    Returns a dictionary of stage -> text, where text is a YAML document
+    holding just that stage (i.e. "stage:\n  series: ...\n"). Parsing all of
+    the YAML in a large checklist is slow, while splitting it into sections
+    like this is quick, and most scripts only ever look at one section.
+
+    This relies on the document being written in block style with simple keys
+    (as yaml.dump writes it), so returns None if it finds anything else, or if
+    there is no /blacklist, in which case the whole document should be parsed.
+    """
+    sections = collections.OrderedDict()
+    top = indent = None    # indentation of the top-level and stage keys
+    stage = None           # the stage being read, if any
+    in_blacklist = False
+
+    for line in text.splitlines(True):
+        content = line.strip()
+        if not content or content.startswith('#'):
+            if stage:
+                sections[stage].append(line)
+            continue
+        if '\t' in line[:len(line) - len(line.lstrip())]:
+            return None
+
+        depth = len(line) - len(line.lstrip(' '))
+        if top is None:
+            top = depth
+        if depth < top:
+            return None
+
+        if depth == top:
+            match = YAML_KEY_RE.match(line)
+            if not match:
+                return None
+            stage = None
+            in_blacklist = match.group(2) == 'blacklist'
+            if in_blacklist and match.group(3):
+                return None    # not in block style (e.g. "blacklist: {}")
+            continue
+
+        if not in_blacklist:
+            continue
+        if indent is None:
+            indent = depth
+        if depth < indent:
+            return None
+        if depth == indent:
+            match = YAML_KEY_RE.match(line)
+            if not match or match.group(2) in sections:
+                return None
+            stage = match.group(2)
+            sections[stage] = []
+        sections[stage].append(line)
+
+    if not sections:
+        return None
+    return dict((stage, ''.join(lines)) for stage, lines in sections.items())
+
+
+@contextlib.contextmanager
+def locked(path):
+    """Holds the write lock on the checklist at path for the duration of a with
+    block.
+
+    The lock is taken on a sidecar file (path + '.lock') rather than the
+    checklist itself, since saving replaces the checklist file. Readers don't
+    need the lock, since a checklist file is never modified in place.
+    """
+    lockfile = open(path + '.lock', 'a')
+    try:
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        yield
+    finally:
+        lockfile.close()   # releases the lock
+
+def signature(path_or_stream):
+    """Returns something that changes whenever a checklist file is saved, or
+    None if it doesn't exist"""
+    try:
+        if isinstance(path_or_stream, basestring):
+            stat = os.stat(path_or_stream)
+        else:
+            stat = os.fstat(path_or_stream.fileno())
+    except OSError:
+        return None
+    return stat.st_ino, stat.st_size, stat.st_mtime
+
+# file extensions of checklists stored as sqlite databases
+SQLITE_EXTS = ('.db', '.sqlite')
+
+# checklists loaded from files, as realpath -> Checklist
+_loaded = {}
+
+def load(stream_or_file=None, cache=False):
+    """Convenience method for loading a checklist from a file or stream
+
+    Files ending in one of SQLITE_EXTS are loaded as a SQLiteChecklist.
+
+    If cache is True, a checklist loaded from a file is kept, and loading the
+    same file again with cache=True returns the same Checklist unless the file
+    has been changed (e.g. saved by another process) in the meantime. This
+    makes it cheap for long-running scripts to call load() each time they need
+    the checklist in order to pick up any changes. Cached checklists are
+    shared between callers, so should only be read: load a checklist without
+    the cache in order to change it.
+    """
+    if not isinstance(stream_or_file, basestring):
+        return Checklist(stream_or_file)
+
+    if stream_or_file.endswith(SQLITE_EXTS):
+        return SQLiteChecklist(stream_or_file)
+
+    path = os.path.realpath(stream_or_file)
+    checklist = _loaded.get(path)
+    if cache and checklist and checklist.source[1] == signature(path):
+        return checklist
+
+    with open(stream_or_file, 'r') as stream:
+        checklist = Checklist(stream)
+        checklist.source = stream_or_file, signature(stream)
+    if cache:
+        _loaded[path] = checklist
+    return checklist
+
+def save(checklist, stream_or_file, merge=False):
+    """Convenience method for saving a checklist from a file or stream
+
+    When saving to a file, the file is locked against other writers while it
+    is being saved, and the new checklist is written alongside it then renamed
+    into place, so that readers never see a partially written checklist.
+
+    If merge is True and the file has been changed (e.g. by another job) since
+    the checklist was loaded from it, the file is re-read and only the changes
+    made to the checklist are applied to it, rather than overwriting it. (This
+    only applies to Checklists, since a SQLiteChecklist saves each change as
+    it is made.)
+    """
+    if not isinstance(stream_or_file, basestring):
+        checklist.save(stream_or_file)
+        return
+
+    path = stream_or_file
+    if isinstance(checklist, SQLiteChecklist) and path == checklist.path:
+        return  # changes are already saved
+
+    with locked(path):
+        current = signature(path)
+        merge = merge and isinstance(checklist, Checklist)
+        if merge and current and \
+                getattr(checklist, 'source', None) != (path, current):
+            with open(path, 'r') as stream:
+                checklist.merge(stream)
+
+        fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                       prefix='.checklist')
+        try:
+            with os.fdopen(fd, 'w') as stream:
+                checklist.save(stream)
+                stream.flush()
+                os.fsync(stream.fileno())
+            if current:
+                mode = os.stat(path).st_mode & 0777
+            else:
+                umask = os.umask(0)
+                os.umask(umask)
+                mode = 0666 & ~umask
+            os.chmod(tmpfile, mode)   # mkstemp creates files as 0600
+            os.rename(tmpfile, path)
+        except:
+            os.remove(tmpfile)
+            raise
+        if isinstance(checklist, Checklist):
+            checklist.source = path, signature(path)
+            checklist._added, checklist._removed = {}, set()
@@ -0,0 +1,125 @@
+"""
+The export info table, which maps series descriptions to tags and lists the
+formats each tag is exported to (see xnat-extract.py). For example:
+
+    pattern       tag     export_mnc  export_nii  export_nrrd  count
+    Localiser     LOC     no          no          no           1
+    T1            T1      yes         yes         yes          1
+    DTI-60        DTI-60  no          yes         yes          3
+
+Looking up a series description matches it against every pattern in the
+table. ExportInfo compiles the patterns once, so that each lookup is cheap:
+
+    import datman.exportinfo
+    exportinfo = datman.exportinfo.load('metadata/exportinfo.csv')
+
+    tag, formats = exportinfo.lookup('Sag-T1-BRAVO')   # 'T1', ['mnc', ...]
+"""
+import pandas as pd
+import re
+
+# characters with a special meaning in a regex; patterns without them are
+# plain substrings, and can be matched without using re
+REGEX_CHARS = set('.^$*+?{}[]\\|()')
+
+
+class ExportInfo(object):
+    """
+    The export info table, compiled for looking up series descriptions.
+
+    The table itself is available as the table attribute, and the formats it
+    lists (from its export_<format> columns) as the formats attribute.
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self.formats = [c.split("_")[1] for c in table.columns.values.tolist()
+                        if c.startswith("export_")]
+
+        # tag -> formats to export to. A format is exported unless every row
+        # for the tag says "no".
+        self.exports = {}
+        for tag, rows in table.groupby('tag', sort=False):
+            self.exports[str(tag)] = [fmt for fmt in self.formats
+                if not all(rows['export_' + fmt] == 'no')]
+
+        # (tag, substrings, regexes) matching each tag's patterns, along with a
+        # regex that matches any pattern, to rule out most descriptions quickly
+        patterns = {}
+        for pattern, tag in zip(table['pattern'].tolist(),
+                                table['tag'].tolist()):
+            patterns.setdefault(str(tag), []).append(str(pattern))
+
+        self._matchers = []
+        for tag, tag_patterns in sorted(patterns.items()):
+            literals = [p for p in tag_patterns if not REGEX_CHARS & set(p)]
+            regexes = [p for p in tag_patterns if p not in literals]
+            self._matchers.append((tag, literals, compile_any(regexes)))
+        self._any = compile_any(sum(patterns.values(), []))
+
+        self._cache = {}
+
+    def match(self, description):
+        """
+        Returns the sorted list of tags with a pattern that matches (i.e.
+        re.search finds) the description.
+        """
+        tags = self._cache.get(description)
+        if tags is not None:
+            return tags
+
+        tags = []
+        if any(r.search(description) for r in self._any):
+            for tag, literals, regexes in self._matchers:
+                if any(p in description for p in literals) or \
+                        any(r.search(description) for r in regexes):
+                    tags.append(tag)
+
+        self._cache[description] = tags
+        return tags
+
+    def guess_tag(self, description):
+        """
+        Returns the tag for a series description: None if there is no
+        matching tag, or a list of tags if there is more than one (as with
+        datman.utils.guess_tag).
+        """
+        tags = self.match(description)
+        if not tags:
+            return None
+        if len(tags) == 1:
+            return tags[0]
+        return tags
+
+    def lookup(self, description):
+        """
+        Returns (tag, formats) for a series description, where tag is as for
+        guess_tag(), and formats is the list of formats the series is to be
+        exported to (empty unless a single tag matches).
+        """
+        tag = self.guess_tag(description)
+        if tag is None or isinstance(tag, list):
+            return tag, []
+        return tag, self.exports[tag]
+
+
+def compile_any(patterns):
+    """
+    Compiles a list of regexes for finding whether any of them match.
+
+    Returns a list of compiled regexes: a single regex combining all of the
+    patterns where possible, or each of the patterns compiled separately if
+    they can't be combined (i.e. they have groups, which backreferences in
+    them may refer to by number). Raises re.error if a pattern is invalid.
+    """
+    compiled = [re.compile(p) for p in patterns]
+    if len(compiled) < 2 or any(r.groups for r in compiled):
+        return compiled
+    return [re.compile("|".join("(?:{})".format(p) for p in patterns))]
+
+
+def load(path):
+    """Reads an export info table from a (whitespace separated) file"""
+    return ExportInfo(pd.read_table(path, sep='\s*', engine="python"))
+
+# vim: ts=4 sw=4:
@@ -0,0 +1,257 @@
+"""
+A persistent, on-disk cache of the dicom headers found in exam archives.
+
+Reading headers from an archive means opening (and often decompressing) it,
+which adds up when the same archives are visited on every run. The cache
+remembers the headers found in each archive, keyed by the archive path along
+with its size and modification time, so that an archive is only re-read when
+it changes. For example:
+
+    import datman.headercache
+    cache = datman.headercache.HeaderCache('metadata/headers.db')
+
+    cache.prefetch('data/zips')   # scan any new or changed archives
+    manifest = cache.get_archive_headers('data/zips/2014_0126_FB001.zip')
+
+get_archive_headers() returns the same path->headers mapping as
+datman.utils.get_archive_headers(), but the headers are Header objects (plain
+dictionaries of header name -> value) rather than pydicom datasets. Only
+simple, named headers are cached: sequences, binary data and private tags are
+not.
+"""
+import datman.utils
+import dicom as dcm
+import glob
+import json
+import os
+import sqlite3
+
+# value representations not worth caching (sequences and binary data)
+UNCACHED_VRS = set(['SQ', 'OB', 'OW', 'OF', 'UN', 'OB or OW', 'US or SS or OW'])
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS archives (
+    path     TEXT PRIMARY KEY,
+    size     INTEGER,
+    mtime    REAL,
+    complete INTEGER
+);
+CREATE TABLE IF NOT EXISTS headers (
+    path      TEXT,
+    seriesdir TEXT,
+    filename  TEXT,
+    headers   TEXT,
+    PRIMARY KEY (path, seriesdir)
+);
+"""
+
+
+class Header(dict):
+    """Dicom headers from the cache, as a dictionary of name -> value"""
+
+    filename = None
+
+    def dir(self):
+        return sorted(self.keys())
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class HeaderCache(object):
+    """A cache of archive headers backed by a sqlite database"""
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.executescript(SCHEMA)
+
+    def get_archive_headers(self, archive, stop_after_first=False):
+        """
+        Get dicom headers from a scan archive, reading the archive only if it
+        isn't cached or has changed since it was cached.
+
+        See datman.utils.get_archive_headers.
+        """
+        path = os.path.realpath(archive)
+        size, mtime = signature(path)
+
+        if self._is_cached(path, size, mtime, stop_after_first):
+            manifest = self._load(path)
+        else:
+            manifest = self._store(path, size, mtime,
+                datman.utils.get_archive_headers(archive, stop_after_first),
+                not stop_after_first)
+
+        if stop_after_first:
+            return first_series(manifest)
+        return manifest
+
+    def get_archive_headers_many(self, archives, workers=1,
+                                 stop_after_first=False):
+        """
+        Get dicom headers from many scan archives, reading any that aren't
+        cached (or have changed) in parallel.
+
+        Yields (archive, manifest, error) tuples, see
+        datman.utils.get_archive_headers_many. Cached archives come first,
+        along with any that can't be looked at (e.g. are missing).
+        """
+        unread = {}
+        for archive in archives:
+            path = os.path.realpath(archive)
+            try:
+                size, mtime = signature(path)
+            except OSError, e:
+                yield archive, None, "{}: {}".format(e.__class__.__name__, e)
+                continue
+            if self._is_cached(path, size, mtime, stop_after_first):
+                manifest = self._load(path)
+                if stop_after_first:
+                    manifest = first_series(manifest)
+                yield archive, manifest, None
+            else:
+                unread[archive] = (path, size, mtime)
+
+        for archive, manifest, error in datman.utils.get_archive_headers_many(
+                unread.keys(), workers, stop_after_first):
+            if manifest is not None:
+                path, size, mtime = unread[archive]
+                manifest = self._store(path, size, mtime, manifest,
+                                       not stop_after_first)
+            yield archive, manifest, error
+
+    def prefetch(self, directory, pattern='*', workers=1):
+        """
+        Cache the headers of every archive in a directory that isn't cached
+        already (or has changed since it was), using <workers> processes.
+
+        Returns the list of archives that were read. Archives that can't be
+        looked at (e.g. were removed in the meantime) are skipped.
+        """
+        unread = []
+        for archive in sorted(glob.glob(os.path.join(directory, pattern))):
+            path = os.path.realpath(archive)
+            try:
+                size, mtime = signature(path)
+            except OSError:
+                continue
+            if not self._is_cached(path, size, mtime):
+                unread.append(archive)
+
+        scanned = []
+        for archive, manifest, error in self.get_archive_headers_many(
+                unread, workers):
+            if manifest is not None:  # otherwise, not an archive
+                scanned.append(archive)
+        return sorted(scanned)
+
+    def invalidate(self, archive):
+        """Remove an archive from the cache"""
+        path = os.path.realpath(archive)
+        with self.db:
+            self.db.execute('DELETE FROM archives WHERE path = ?', (path,))
+            self.db.execute('DELETE FROM headers WHERE path = ?', (path,))
+
+    def close(self):
+        self.db.close()
+
+    def _load(self, path):
+        manifest = {}
+        for seriesdir, filename, headers in self.db.execute(
+                'SELECT seriesdir, filename, headers FROM headers '
+                'WHERE path = ?', (path,)):
+            header = Header(json.loads(headers))
+            header.filename = filename
+            manifest[seriesdir] = header
+        return manifest
+
+    def _is_cached(self, path, size, mtime, stop_after_first=False):
+        """
+        Is the archive cached and unchanged? Unless stop_after_first, the
+        cached headers must be from a scan of the entire archive.
+        """
+        row = self.db.execute(
+            'SELECT size, mtime, complete FROM archives WHERE path = ?',
+            (path,)).fetchone()
+        return bool(row) and row[0] == size and row[1] == mtime and \
+            bool(row[2] or stop_after_first)
+
+    def _store(self, path, size, mtime, manifest, complete):
+        """Cache the manifest for an archive, returning the cached version"""
+        manifest = dict((seriesdir, to_header(dataset))
+                        for seriesdir, dataset in manifest.items())
+
+        with self.db:
+            self.db.execute('DELETE FROM headers WHERE path = ?', (path,))
+            self.db.execute(
+                'INSERT OR REPLACE INTO archives VALUES (?, ?, ?, ?)',
+                (path, size, mtime, complete))
+            self.db.executemany(
+                'INSERT INTO headers VALUES (?, ?, ?, ?)',
+                [(path, seriesdir, header.filename, json.dumps(header))
+                 for seriesdir, header in manifest.items()])
+        return manifest
+
+
+def signature(path):
+    """
+    Returns a (size, mtime) pair that changes whenever the archive does.
+
+    For a folder archive, size is the number of files and folders within it
+    and mtime is the latest modification time of any folder within it (adding,
+    removing or renaming a file updates its folder's modification time).
+    """
+    if not os.path.isdir(path):
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime
+
+    size = 0
+    mtime = os.stat(path).st_mtime
+    for dirpath, dirs, files in os.walk(path):
+        size += len(dirs) + len(files)
+        for d in dirs:
+            mtime = max(mtime, os.stat(os.path.join(dirpath, d)).st_mtime)
+    return size, mtime
+
+
+def first_series(manifest):
+    """Trim a manifest down to a single series (as with stop_after_first)"""
+    if not manifest:
+        return manifest
+    key = sorted(manifest.keys())[0]
+    return {key: manifest[key]}
+
+
+def to_header(dataset):
+    """Convert a pydicom dataset into a (cacheable) Header"""
+    header = Header()
+    header.filename = getattr(dataset, 'filename', None)
+    for tag in dataset.keys():
+        keyword = dcm.datadict.keyword_for_tag(tag)
+        if not keyword:
+            continue
+        try:
+            element = dataset[tag]
+        except Exception:
+            continue  # unreadable value
+        if element.VR in UNCACHED_VRS:
+            continue
+        header[keyword] = to_value(element.value)
+    return header
+
+
+def to_value(value):
+    """Convert a dicom value to something that can be stored as JSON"""
+    if isinstance(value, (list, tuple)):
+        return [to_value(v) for v in value]
+    if isinstance(value, (int, long)):
+        return int(value)
+    if isinstance(value, unicode):
+        return value
+    return str(value).decode('utf-8', 'replace')
+
+# vim: ts=4 sw=4:
@@ -0,0 +1,185 @@
+"""
+A store of the header mismatches found by dm-check-headers.py.
+
+Mismatches are kept in a sqlite database, indexed by exam, series and header,
+so that the mismatches for a single series (e.g. for its QC report) can be
+looked up directly rather than by searching log files. For example:
+
+    import datman.headerchecks
+    store = datman.headerchecks.MismatchStore('qc/logs/dm-check-headers.db')
+
+    for m in store.get_series('DTI_CMH_H001_01_01_T1_02_SagT1-BRAVO'):
+        print m.header, m.expected, m.actual
+
+Series are named by the file name of the series (without an extension), so
+that they can be looked up by the name of any file exported from it.
+
+Expected and actual header values are stored as JSON, and so come back as
+plain python values (multi-valued headers as lists).
+
+The store also records when each exam was checked, whether or not it had any
+mismatches, so that an exam with no mismatches can be told apart from one
+that hasn't been checked (see is_checked).
+"""
+import collections
+import datman.utils
+import glob
+import json
+import os.path
+import sqlite3
+import time
+
+# name of the store in the dm-check-headers.py log folder
+STORE_NAME = 'dm-check-headers.db'
+
+# the dm-check-headers.py log file of an exam is LOG_PREFIX + exam + LOG_EXT
+LOG_PREFIX = 'dm-check-headers-'
+LOG_EXT = '.log'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS mismatches (
+    exam      TEXT,
+    series    TEXT,
+    path      TEXT,
+    header    TEXT,
+    expected  TEXT,
+    actual    TEXT,
+    tolerance TEXT
+);
+CREATE INDEX IF NOT EXISTS mismatches_exam ON mismatches (exam);
+CREATE INDEX IF NOT EXISTS mismatches_series ON mismatches (series);
+CREATE INDEX IF NOT EXISTS mismatches_header ON mismatches (header);
+CREATE TABLE IF NOT EXISTS checked (
+    exam       TEXT PRIMARY KEY,
+    checked_at REAL
+);
+"""
+
+COLUMNS = ['exam', 'series', 'path', 'header', 'expected', 'actual',
+           'tolerance']
+
+# a header of a series that doesn't match the gold standard
+Mismatch = collections.namedtuple('Mismatch', COLUMNS)
+
+
+class MismatchStore(object):
+    """The header mismatches of each exam, backed by a sqlite database"""
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.executescript(SCHEMA)
+
+    def update_exam(self, exam, mismatches, checked_at=None):
+        """
+        Replaces the mismatches stored for an exam, and records that it was
+        checked at <checked_at> (a time.time() value, by default now).
+
+        <mismatches> maps the path of each file checked to a list of its
+        mismatches: objects with header, expected, actual and tolerance
+        attributes (as found by dm-check-headers.py).
+        """
+        if checked_at is None:
+            checked_at = time.time()
+        rows = []
+        for path, file_mismatches in sorted(mismatches.items()):
+            series = series_name(path)
+            for m in file_mismatches:
+                rows.append((exam, series, path, m.header,
+                             to_json(m.expected), to_json(m.actual),
+                             to_json(m.tolerance)))
+        with self.db:
+            self.db.execute('DELETE FROM mismatches WHERE exam = ?', (exam,))
+            self.db.executemany(
+                'INSERT INTO mismatches VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            self.db.execute('INSERT OR REPLACE INTO checked VALUES (?, ?)',
+                            (exam, checked_at))
+
+    def find(self, exam=None, series=None, header=None):
+        """
+        Returns the list of mismatches for the given exam, series and/or
+        header, ordered by series and header.
+        """
+        where = [(column, value) for column, value in
+                 [('exam', exam), ('series', series), ('header', header)]
+                 if value is not None]
+        query = 'SELECT {} FROM mismatches'.format(', '.join(COLUMNS))
+        if where:
+            query += ' WHERE ' + ' AND '.join(
+                '{} = ?'.format(column) for column, value in where)
+        query += ' ORDER BY series, header'
+
+        mismatches = []
+        for row in self.db.execute(query, [value for column, value in where]):
+            exam, series, path, header, expected, actual, tolerance = row
+            mismatches.append(Mismatch(exam, series, path, header,
+                                       json.loads(expected),
+                                       json.loads(actual),
+                                       json.loads(tolerance)))
+        return mismatches
+
+    def get_exam(self, exam):
+        """Returns the list of mismatches found in an exam"""
+        return self.find(exam=exam)
+
+    def get_series(self, series):
+        """
+        Returns the list of mismatches found in a series, given as the name
+        (or path) of a file from the series.
+        """
+        return self.find(series=series_name(series))
+
+    def is_checked(self, exam):
+        """
+        Has the exam been checked? (Exams stored before checks were recorded
+        count as checked if they have mismatches.)
+        """
+        for table in ['checked', 'mismatches']:
+            query = 'SELECT 1 FROM {} WHERE exam = ? LIMIT 1'.format(table)
+            if self.db.execute(query, (exam,)).fetchone():
+                return True
+        return False
+
+    def exams(self):
+        """Returns the sorted list of exams with mismatches"""
+        return [row[0] for row in self.db.execute(
+            'SELECT DISTINCT exam FROM mismatches ORDER BY exam')]
+
+    def close(self):
+        self.db.close()
+
+
+def read_logs(logsdir, subject, store=None):
+    """
+    Returns the lines of the dm-check-headers.py log files of a subject's
+    exams, leaving out (without reading) those of exams in the store.
+    """
+    lines = []
+    for logfile in sorted(glob.glob(os.path.join(
+            logsdir, LOG_PREFIX + subject + '*' + LOG_EXT))):
+        exam = os.path.basename(logfile)[len(LOG_PREFIX):-len(LOG_EXT)]
+        if store and store.is_checked(exam):
+            continue
+        with open(logfile) as stream:
+            lines.extend(stream.readlines())
+    return lines
+
+
+def series_name(path):
+    """Returns the series name for a file: its file name sans extension"""
+    filename = os.path.basename(path)
+    return filename[:len(filename) - len(datman.utils.get_extension(filename))]
+
+
+def describe(mismatch):
+    """Returns a one line description of a mismatch"""
+    return "header {}, expected = {}, actual = {} [tolerance = {}]".format(
+        mismatch.header, mismatch.expected, mismatch.actual,
+        mismatch.tolerance)
+
+
+def to_json(value):
+    """Encodes a header value as JSON (as a string, if need be)"""
+    return json.dumps(value, default=str)
+
+# vim: ts=4 sw=4:
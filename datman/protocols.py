@@ -0,0 +1,205 @@
+"""
+Checks that each subject has the series the study protocol calls for.
+
+The export info table (see datman.exportinfo) gives the number of series of
+each tag that a subject should have in its count column, e.g. "1" or, for a
+study with more than one protocol, "1,2" (i.e. one series for subjects scanned
+with the first protocol, two for the second).
+
+The checks are done on an index of every file in a data folder, listed and
+parsed in one go, which is turned into a matrix of the number of series of
+each tag that each subject has. This is compared against every protocol at
+once:
+
+    import datman.exportinfo
+    import datman.protocols
+    exportinfo = datman.exportinfo.load('metadata/exportinfo.csv')
+    expected = datman.protocols.expected_counts(exportinfo.table)
+
+    index = datman.protocols.index_folder('data/nii')
+    counts = datman.protocols.count_tags(index, tags=expected.columns)
+    comparison = datman.protocols.compare(counts, expected)
+
+    comparison.complete            # subject -> whether it has every series
+    comparison.difference          # subject x tag: found - expected
+"""
+import collections
+import datman.scanid
+import numpy as np
+import os
+import pandas as pd
+
+# extension of the files exported in each format
+FORMAT_EXTS = {
+    'nii': '.nii.gz',
+    'mnc': '.mnc',
+    'nrrd': '.nrrd',
+    'dcm': '.dcm',
+}
+
+# tag of series that aren't exported (see xnat-extract.py)
+IGNORED_TAG = '?'
+
+# the result of comparing subjects against the protocols:
+#   protocol    subject -> the protocol the subject is compared against: the
+#               first it has every series for, or if none, the one it has the
+#               fewest series missing for
+#   complete    subject -> whether it has every series for that protocol
+#   difference  subject x tag: the number of series found less the number
+#               expected by that protocol (so, negative if series are missing)
+Comparison = collections.namedtuple(
+    'Comparison', ['protocol', 'complete', 'difference'])
+
+
+def index_folder(datadir, ext=None):
+    """
+    Lists and parses the files in each subject folder of a data folder (e.g.
+    data/nii), optionally only those with extension <ext> (e.g. '.nii.gz').
+
+    Returns a table of the parsed files (see datman.scanid.parse_many) along
+    with their subject folder (the folder column) and file names without the
+    extension (the name column). Files not following the naming scheme are
+    left out. Without <ext>, only the first file of each name is listed, so
+    that a series with several files (e.g. .nii.gz, .bvec and .bval) is only
+    listed once.
+    """
+    paths = []
+    folders = []
+    for folder in sorted(os.listdir(datadir)):
+        subjectdir = os.path.join(datadir, folder)
+        if not os.path.isdir(subjectdir):
+            continue
+        for filename in sorted(os.listdir(subjectdir)):
+            paths.append(os.path.join(subjectdir, filename))
+            folders.append(folder)
+
+    index = datman.scanid.parse_many(paths)
+    index.insert(1, 'folder', folders)
+    index = index[index['parsed']]
+    if ext is not None:
+        index = index[index['ext'] == ext]
+
+    index = index.reset_index(drop=True)
+    index['name'] = [os.path.basename(path)[:-len(e) or None]
+                     for path, e in zip(index['path'], index['ext'])]
+    if ext is None:
+        index = index.drop_duplicates(['folder', 'name']).reset_index(
+            drop=True)
+    return index
+
+
+def count_tags(index, subjects=None, tags=None):
+    """
+    Counts the series of each tag in each subject folder of an index (see
+    index_folder).
+
+    Returns a subject x tag table of counts, with a row for each of
+    <subjects> and a column for each of <tags> (by default, those in the
+    index) even if there are no series for them.
+    """
+    counts = pd.crosstab(index['folder'], index['tag'])
+    if subjects is None:
+        subjects = counts.index
+    if tags is None:
+        tags = counts.columns
+    return counts.reindex(index=list(subjects), columns=list(tags),
+                          fill_value=0).fillna(0).astype(int)
+
+
+def expected_counts(table):
+    """
+    Reads the number of series of each tag expected by each protocol from an
+    export info table (its count column).
+
+    Returns a protocol x tag table of counts. If a tag has more than one row
+    in the table, the counts in the last row are used. Raises ValueError if
+    the table has no count column, or the rows list different numbers of
+    protocols.
+    """
+    if 'count' not in table.columns:
+        raise ValueError('Export info has no count column')
+
+    counts = collections.OrderedDict()
+    for tag, count in zip(table['tag'], table['count']):
+        tag = str(tag)
+        if tag == IGNORED_TAG:
+            continue
+        counts[tag] = [int(n) for n in str(count).split(',')]
+
+    n_protocols = set(len(n) for n in counts.values())
+    if len(n_protocols) > 1:
+        raise ValueError('Tags have different numbers of protocols: {}'.format(
+            ', '.join('{} {}'.format(tag, len(n))
+                      for tag, n in counts.items())))
+
+    return pd.DataFrame(counts, columns=counts.keys())
+
+
+def compare(counts, expected):
+    """
+    Compares a subject x tag table of counts (see count_tags) against every
+    protocol in a protocol x tag table of expected counts (see
+    expected_counts) at once.
+
+    Returns a Comparison. The tables are matched up by tag; tags that are
+    only in <counts> are left out.
+    """
+    if not len(expected):   # no tags, so nothing is expected
+        expected = pd.DataFrame([[0] * len(expected.columns)],
+                                columns=expected.columns)
+
+    found = counts.reindex(columns=expected.columns, fill_value=0).values
+    differences = found[:, np.newaxis, :] - expected.values[np.newaxis, :, :]
+
+    # subject x protocol: the number of series missing
+    missing = np.where(differences < 0, -differences, 0).sum(axis=2)
+    protocol = missing.argmin(axis=1)
+    rows = np.arange(len(counts))
+
+    return Comparison(
+        protocol=pd.Series(protocol, index=counts.index),
+        complete=pd.Series(missing[rows, protocol] == 0, index=counts.index),
+        difference=pd.DataFrame(differences[rows, protocol],
+                                index=counts.index, columns=expected.columns))
+
+
+def missing_series(comparison):
+    """
+    Returns a table of the series each subject is missing, with a row for
+    each subject and tag and the columns subject, tag and missing (the number
+    of series missing).
+    """
+    return _long(-comparison.difference, 'missing')
+
+
+def extra_series(comparison):
+    """
+    Returns a table of the series each subject has more of than expected,
+    with a row for each subject and tag and the columns subject, tag and
+    extra (the number of extra series).
+    """
+    return _long(comparison.difference, 'extra')
+
+
+def flagged_series(index, flagged):
+    """
+    Returns the rows of an index (see index_folder) for the series named in
+    <flagged> (e.g. series flagged as unusable).
+    """
+    return index[index['name'].isin(set(flagged))]
+
+
+def _long(table, column):
+    """
+    Turns the positive values of a subject x tag table into a table with a
+    row for each subject and tag.
+    """
+    if table.empty:   # stack() fails on a table without rows or columns
+        return pd.DataFrame(columns=['subject', 'tag', column])
+    stacked = table.stack()
+    stacked = stacked[stacked > 0]
+    result = stacked.reset_index()
+    result.columns = ['subject', 'tag', column]
+    return result
+
+# vim: ts=4 sw=4:
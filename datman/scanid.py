@@ -27,18 +27,49 @@ FILENAME_PHA_RE = SCANID_PHA_RE + '_' + \
               r'(?P<description>[^\.]*)' + \
               r'(?P<ext>\..*)?'
 
+# matches both phantom and non-phantom filenames, for parsing many filenames at
+# once (see parse_many). The phantom subject is tried first, as it is in
+# parse_filename().
+FILENAME_ANY_RE = '(?P<study>[^_]+)_' \
+                  '(?P<site>[^_]+)_' \
+                  '(?:(?P<phantom>PHA_[^_]+)|' \
+                  '(?P<subject>[^_]+)_' \
+                  '(?P<timepoint>[^_]+)_' \
+                  '(?P<session>[^_]+))_' \
+                  r'(?P<tag>[^_]+)_' + \
+                  r'(?P<series>\d+)_' + \
+                  r'(?P<description>[^\.]*)' + \
+                  r'(?P<ext>\..*)?'
+
 SCANID_PATTERN       = re.compile('^'+SCANID_RE+'$')
 SCANID_PHA_PATTERN   = re.compile('^'+SCANID_PHA_RE+'$')
 FILENAME_PATTERN     = re.compile('^'+FILENAME_RE+'$')
 FILENAME_PHA_PATTERN = re.compile('^'+FILENAME_PHA_RE+'$')
+FILENAME_ANY_PATTERN = re.compile('^'+FILENAME_ANY_RE+'$')
+
+# columns of the table returned by parse_many()
+FILENAME_FIELDS = ['study', 'site', 'subject', 'timepoint', 'session', 'tag',
+                   'series', 'description', 'ext']
+
+# number of results to remember in parse() (per generation, see memoize)
+CACHE_SIZE = 10000
 
 class ParseException(Exception):
     pass
 
-class Identifier:
+class Identifier(object):
+    """
+    A parsed scan identifier.
+
+    Identifiers returned by parse() are cached and shared between callers, so
+    should be treated as read-only.
+    """
+    __slots__ = ('study', 'site', 'subject', 'timepoint', 'session')
+
     def __init__(self, study, site, subject, timepoint, session):
-        self.study = study
-        self.site = site
+        # there are only a few distinct studies and sites, so share the strings
+        self.study = _share(study, study)
+        self.site = _share(site, site)
         self.subject = subject
         self.timepoint = timepoint
         self.session = session
@@ -61,10 +92,66 @@ class Identifier:
                              self.session])
         else:  # it's a phantom, so no timepoints
             return self.get_full_subjectid() 
-                  
+
+# interning table for study and site names
+_share = {}.setdefault
+
+def memoize(func):
+    """
+    Remember the results (and ParseExceptions) of a single argument function.
+
+    Results are kept in two generations: once CACHE_SIZE results have been
+    added to the current generation, the previous generation is forgotten and
+    a new one started. Results used from the previous generation are moved
+    into the current one, so only the least recently used results are lost.
+
+    Results are kept by the type of the argument as well as its value, since
+    equal str and unicode arguments (e.g. 'X' and u'X') may parse differently.
+    """
+    generations = [{}, {}]   # current, previous
+
+    def memoized(arg):
+        current = generations[0]
+        key = (type(arg), arg)
+        try:
+            result = current.get(key, _MISSING)
+        except TypeError:  # unhashable, so can't be cached
+            return func(arg)
+
+        if result is _MISSING:
+            result = generations[1].get(key, _MISSING)
+            if result is _MISSING:
+                try:
+                    result = func(arg)
+                except ParseException:
+                    result = None
+            if len(current) >= CACHE_SIZE:
+                generations[:] = [{}, current]
+                current = generations[0]
+            current[key] = result
+
+        if result is None:
+            raise ParseException()
+        return result
+
+    memoized.clear = lambda: generations.__setitem__(slice(None), [{}, {}])
+    memoized.__name__ = func.__name__
+    memoized.__doc__ = func.__doc__
+    return memoized
+
+_MISSING = object()
+
+@memoize
 def parse(identifier):
     if type(identifier) is not str: raise ParseException()
 
+    # fast path: split the fields rather than use the regexes
+    fields = identifier.split('_')
+    if len(fields) == 5 and all(fields):
+        return Identifier(*fields)
+    if len(fields) == 4 and fields[2] == 'PHA' and all(fields):
+        return Identifier(fields[0], fields[1], 'PHA_' + fields[3], '', '')
+
     match = SCANID_PATTERN.match(identifier)
     if not match: match = SCANID_PHA_PATTERN.match(identifier)
     if not match: raise ParseException()
@@ -79,6 +166,13 @@ def parse(identifier):
 
 def parse_filename(path):
     fname = os.path.basename(path)
+
+    # fast path: split the fields rather than use the regexes
+    if type(fname) is str:
+        result = _split_filename(fname)
+        if result:
+            return result
+
     match = FILENAME_PHA_PATTERN.match(fname)  # check PHA first
     if not match: match = FILENAME_PATTERN.match(fname)
     if not match: raise ParseException()
@@ -94,6 +188,66 @@ def parse_filename(path):
     description = match.group("description")
     return ident, tag, series, description
 
+def _split_filename(fname):
+    """
+    Parses a filename the way FILENAME_PHA_PATTERN and FILENAME_PATTERN do,
+    but by splitting on underscores.
+
+    Returns the same as parse_filename, or None if the filename doesn't match.
+    """
+    fields = fname.split('_', 7)
+    if len(fields) < 7:
+        return None
+
+    if fields[2] == 'PHA' and fields[5].isdigit() and all(fields[:6]):
+        ident = Identifier(fields[0], fields[1], 'PHA_' + fields[3], '', '')
+        tag, series = fields[4], fields[5]
+        rest = '_'.join(fields[6:])
+    elif len(fields) == 8 and fields[6].isdigit() and all(fields[:6]):
+        ident = Identifier(fields[0], fields[1], fields[2], fields[3],
+                           fields[4])
+        tag, series, rest = fields[5], fields[6], fields[7]
+    else:
+        return None
+
+    return ident, tag, series, rest.split('.', 1)[0]
+
+def parse_many(paths):
+    """
+    Parse many filenames at once into a table.
+
+    Returns a pandas DataFrame with a row for each of <paths> (in order) and
+    the columns path, the FILENAME_FIELDS (study, site, subject, timepoint,
+    session, tag, series, description, ext) and parsed. For paths that don't
+    follow the naming scheme parsed is False and the other fields are null.
+
+    This applies one regex to all of the paths in bulk, so is much faster than
+    calling parse_filename() on each, and the result can be queried directly,
+    e.g. frame[frame.parsed].groupby('tag').size()
+    """
+    import pandas as pd
+
+    paths = list(paths)
+    match = FILENAME_ANY_PATTERN.match
+    nomatch = (None,) * FILENAME_ANY_PATTERN.groups
+    matches = (match(os.path.basename(path)) for path in paths)
+    columns = sorted(FILENAME_ANY_PATTERN.groupindex,
+                     key=FILENAME_ANY_PATTERN.groupindex.get)
+
+    frame = pd.DataFrame.from_records(
+        [m and m.groups() or nomatch for m in matches], columns=columns)
+
+    parsed = frame['study'].notnull()
+    phantom = frame['phantom'].notnull()
+    frame['subject'] = frame['subject'].where(~phantom, frame['phantom'])
+    for field in ['timepoint', 'session', 'ext']:
+        frame.loc[parsed, field] = frame.loc[parsed, field].fillna('')
+
+    frame = frame[FILENAME_FIELDS]
+    frame.insert(0, 'path', paths)
+    frame['parsed'] = parsed
+    return frame
+
 def make_filename(ident, tag, series, description, ext = None):
     filename = "_".join([str(ident), tag, series, description])
     if ext: 
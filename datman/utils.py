@@ -9,8 +9,10 @@ import zipfile
 import tarfile
 import io
 import glob
+import hashlib
 import numpy as np
 import logging
+import multiprocessing
 import subprocess as proc
 import scanid
 import nibabel as nib
@@ -34,6 +36,17 @@ SERIES_TAGS_MAP = {
 "Loc"        :  "LOC",
 } 
 
+PIXEL_DATA_TAG = dcm.tag.Tag(0x7fe0, 0x0010)
+
+# 128 byte preamble + 'DICM'
+DICOM_MIN_SIZE = 132
+
+# file extensions of files that are, or are not, likely to be dicoms
+DICOM_EXTS = ('.dcm', '.ima', '.dicom')
+NON_DICOM_EXTS = ('.xml', '.txt', '.log', '.csv', '.json', '.html', '.pdf',
+                  '.jpg', '.jpeg', '.png', '.gif', '.nii', '.gz', '.zip',
+                  '.mnc', '.nrrd', '.bvec', '.bval', '.hdr', '.img')
+
 def get_subject_from_filename(filename):
     filename = os.path.basename(filename)
     filename = filename.split('_')[0:5]
@@ -104,7 +117,57 @@ def splitext(path):
     ext = get_extension(path)
     return path[:-len(ext)], ext
 
-def get_archive_headers(path, stop_after_first = False): 
+class _StreamReader(object):
+    """
+    Wraps a file or forward-only stream (e.g. a zip member, or a member of a
+    streamed tarball) so that it can be parsed by pydicom.
+
+    Data is only read from the stream as pydicom asks for it, so stopping the
+    parse early (e.g. before the pixel data) means the rest of the file is
+    never read. pydicom rewinds a few bytes when it stops, which non-seekable
+    streams don't allow, so everything read is buffered: seeking anywhere
+    within what has been read so far is supported, and seeking forward reads
+    ahead.
+    """
+    def __init__(self, fileobj, name=None):
+        self.fileobj = fileobj
+        self.name = name or getattr(fileobj, 'name', None)
+        self.buffer = bytearray()
+        self.pos = 0
+
+    def _fill(self, size):
+        """Read from the stream until <size> bytes are buffered (or EOF)"""
+        while size is None or len(self.buffer) < size:
+            chunk = self.fileobj.read(
+                    size is None and -1 or size - len(self.buffer))
+            if not chunk:
+                break
+            self.buffer.extend(chunk)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            self._fill(None)
+            end = len(self.buffer)
+        else:
+            end = self.pos + size
+            self._fill(end)
+        data = bytes(self.buffer[self.pos:end])
+        self.pos += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            self._fill(None)
+            offset += len(self.buffer)
+        self._fill(offset)
+        self.pos = max(0, min(offset, len(self.buffer)))
+
+    def tell(self):
+        return self.pos
+
+def get_archive_headers(path, stop_after_first = False, tags = None): 
     """
     Get dicom headers from a scan archive.
 
@@ -118,54 +181,198 @@ def get_archive_headers(path, stop_after_first = False):
     If stop_after_first == True only a single set of dicom headers are
     returned for the entire archive, which is useful if you only care about the
     exam details.
+
+    If <tags> is given, only those headers are read (see read_header).
     """
     if os.path.isdir(path): 
-        return get_folder_headers(path, stop_after_first)
+        return get_folder_headers(path, stop_after_first, tags)
     elif zipfile.is_zipfile(path):
-        return get_zipfile_headers(path, stop_after_first)
+        return get_zipfile_headers(path, stop_after_first, tags)
     elif os.path.isfile(path) and path.endswith('.tar.gz'):
-        return get_tarfile_headers(path, stop_after_first)
+        return get_tarfile_headers(path, stop_after_first, tags)
     else: 
 	raise Exception("{} must be a file (zip/tar) or folder.".format(path))
 
-def get_tarfile_headers(path, stop_after_first = False): 
+def get_archive_headers_many(paths, workers = 1, stop_after_first = False,
+        tags = None):
+    """
+    Get dicom headers from many scan archives, reading them in parallel.
+
+    This is a generator that yields a (path, manifest, error) tuple for each
+    archive in <paths> as soon as it has been read, so results do not
+    necessarily come back in the order given. The manifest is as returned by
+    get_archive_headers(). If an archive can't be read, its manifest is None
+    and error is a message saying why. Otherwise error is None. A failure
+    reading one archive doesn't stop the others from being read.
+
+    <workers> is the number of processes to read archives with. If it is 1,
+    archives are read in this process, in the order given.
+    """
+    args = [(path, stop_after_first, tags) for path in paths]
+
+    if workers <= 1:
+        for arg in args:
+            yield _get_archive_headers_safely(arg)
+        return
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        for result in pool.imap_unordered(_get_archive_headers_safely, args):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def _get_archive_headers_safely(args):
+    """
+    Calls get_archive_headers(*args) and returns a (path, manifest, error)
+    tuple instead of raising an exception.
+    """
+    path = args[0]
+    try:
+        return path, get_archive_headers(*args), None
+    except Exception, e:
+        return path, None, "{}: {}".format(e.__class__.__name__, e)
+
+def read_header(source, tags = None):
+    """
+    Read the dicom headers from a file path or file-like object.
+
+    Only the headers are read: parsing stops at the PixelData element, so the
+    I/O cost is the size of the header and not of the whole file. File-like
+    objects need not be seekable (e.g. zip or tar members).
+
+    <tags> is an optional list of header names (e.g. 'SeriesDescription') or
+    (group, element) tuples. If given, parsing stops as soon as the last of
+    these headers has been read, and only these headers are kept.
+
+    Raises dicom.filereader.InvalidDicomError if source is not a dicom file.
+    """
+    wanted = tags and header_tags(tags)
+
+    def stop_when(tag, VR, length):
+        return tag == PIXEL_DATA_TAG or (wanted and tag > wanted[-1])
+
+    fileobj = source
+    if isinstance(source, basestring):
+        fileobj = open(source, 'rb')
+    try:
+        header = dcm.filereader.read_partial(
+                _StreamReader(fileobj, name=getattr(fileobj, 'name', None)),
+                stop_when)
+    finally:
+        if fileobj is not source:
+            fileobj.close()
+
+    if wanted:
+        for tag in header.keys():
+            if tag not in wanted:
+                del header[tag]
+    return header
+
+def header_tags(tags):
+    """
+    Convert a list of header names and/or (group, element) tuples into a
+    sorted list of dicom tags.
+    """
+    result = set()
+    for tag in tags:
+        if isinstance(tag, basestring):
+            name = tag
+            tag = dcm.datadict.tag_for_name(name)
+            if tag is None:
+                raise ValueError("Unknown dicom header {}".format(name))
+        result.add(dcm.tag.Tag(tag))
+    return sorted(result)
+
+def get_tarfile_headers(path, stop_after_first = False, tags = None): 
     """
     Get headers for dicom files within a tarball
+
+    The tarball is streamed: members are visited one at a time, in archive
+    order, without first indexing (and so decompressing) the entire archive.
+    Only the dicom headers of a member are read (reading stops at the pixel
+    data), and once a folder has a header the rest of its members are skipped
+    without being read.
     """
-    tar = tarfile.open(path)
-    members = tar.getmembers()
+    tar = tarfile.open(path, 'r|*')
 
     manifest = {}
     # for each dir, we want to inspect files inside of it until we find a dicom
     # file that has header information
-    for f in filter(lambda x: x.isfile(), members):
+    for f in tar:
+        if not f.isfile(): continue
         dirname = os.path.dirname(f.name)
         if dirname in manifest: continue
         try:
-            manifest[dirname] = dcm.read_file(tar.extractfile(f))
+            manifest[dirname] = read_header(tar.extractfile(f), tags)
             if stop_after_first: break
         except dcm.filereader.InvalidDicomError, e:
             continue
+    tar.close()
     return manifest 
 
-def get_zipfile_headers(path, stop_after_first = False): 
+def get_zipfile_headers(path, stop_after_first = False, tags = None): 
     """
     Get headers for a dicom file within a zipfile
+
+    Members are grouped by folder using the zip's central directory (so no
+    member is read to do this), and within each folder the most dicom-like
+    members (see dicom_likeness) are tried first. Only the header of a member
+    is decompressed, and once a folder has a header no further members of it
+    are read.
     """
     zf = zipfile.ZipFile(path)
-    
+
+    folders = {}   # folder -> members
+    order = []     # folders, in the order they appear in the archive
+    for info in zf.infolist():
+        if info.filename.endswith('/'): continue   # folder entry
+        dirname = os.path.dirname(info.filename)
+        if dirname not in folders:
+            folders[dirname] = []
+            order.append(dirname)
+        folders[dirname].append(info)
+
     manifest = {}
-    for f in zf.namelist():
-        dirname = os.path.dirname(f)
-        if dirname in manifest: continue
-        try:
-            manifest[dirname] = dcm.read_file(io.BytesIO(zf.read(f)))
-            if stop_after_first: break
-        except dcm.filereader.InvalidDicomError, e:
-            continue
+    for dirname in order:
+        for info in sorted(folders[dirname], key=dicom_likeness):
+            if info.file_size < DICOM_MIN_SIZE: continue
+            try:
+                manifest[dirname] = read_header(zf.open(info), tags)
+                break
+            except dcm.filereader.InvalidDicomError, e:
+                continue
+        if stop_after_first and manifest: break
+    zf.close()
     return manifest 
 
-def get_folder_headers(path, stop_after_first = False): 
+def dicom_likeness(info):
+    """
+    Sort key ranking zip members (ZipInfo objects) by how likely they are to
+    be dicom files, most likely first.
+
+    Files with a dicom extension come first, then files without an extension
+    (e.g. IM0001 or 1.2.840...) and files with other unknown extensions, and
+    finally known non-dicom files (catalogs, text, images, DICOMDIR). Larger
+    files are preferred within each group since small files are more often
+    text.
+    """
+    name = os.path.basename(info.filename)
+    ext = os.path.splitext(name)[1].lower()
+
+    if ext in DICOM_EXTS:
+        rank = 0
+    elif name.upper() == 'DICOMDIR' or ext in NON_DICOM_EXTS:
+        rank = 3
+    elif not ext or ext[1:].isdigit():
+        rank = 1
+    else:
+        rank = 2
+    return rank, -info.file_size, name
+
+def get_folder_headers(path, stop_after_first = False, tags = None): 
     """
     Generate a dictionary of subfolders and dicom headers.
     """
@@ -181,19 +388,20 @@ def get_folder_headers(path, stop_after_first = False):
             if os.path.isdir(filepath): 
                 subdirs.append(filepath)
                 continue
-            manifest[path] = dcm.read_file(filepath)
+            manifest[path] = read_header(filepath, tags)
             break
         except dcm.filereader.InvalidDicomError, e:
             pass
 
-    if stop_after_first: return manifest
+    if stop_after_first and manifest: return manifest
 
     # recurse
     for subdir in subdirs: 
-        manifest.update(get_folder_headers(subdir, stop_after_first))
+        manifest.update(get_folder_headers(subdir, stop_after_first, tags))
+        if stop_after_first and manifest: break
     return manifest
 
-def get_all_headers_in_folder(path, recurse = False): 
+def get_all_headers_in_folder(path, recurse = False, tags = None): 
     """
     Get DICOM headers for all files in the given path. 
 
@@ -207,13 +415,45 @@ def get_all_headers_in_folder(path, recurse = False):
             filepath = os.path.join(dirname,filename)
             headers = None
             try:
-                headers = dcm.read_file(filepath)
+                headers = read_header(filepath, tags)
             except dcm.filereader.InvalidDicomError, e:
                 continue
             manifest[filepath] = headers 
         if not recurse: break
     return manifest
 
+def fingerprint(path, sample_size = 4096):
+    """
+    Returns a fingerprint of a file, or of the files in a folder, that changes
+    whenever any of them do.
+
+    The fingerprint is made from the number of files along with each file's
+    name, size and modification time, plus a hash of a sample of the data (the
+    first and last <sample_size> bytes of the first, middle and last file), so
+    that files are never read in full.
+    """
+    if os.path.isdir(path):
+        files = sorted(os.path.join(path, f) for f in os.listdir(path))
+        files = [f for f in files if os.path.isfile(f)]
+    else:
+        files = [path]
+
+    digest = hashlib.md5()
+    for f in files:
+        stat = os.stat(f)
+        digest.update("{}\0{}\0{!r}\n".format(
+            os.path.basename(f), stat.st_size, stat.st_mtime))
+
+    samples = sorted(set([0, len(files) // 2, len(files) - 1]))
+    for f in [files[i] for i in samples if files]:
+        with open(f, 'rb') as stream:
+            digest.update(stream.read(sample_size))
+            if os.fstat(stream.fileno()).st_size > 2 * sample_size:
+                stream.seek(-sample_size, os.SEEK_END)
+            digest.update(stream.read(sample_size))
+
+    return "{}:{}".format(len(files), digest.hexdigest())
+
 def col(arr, colname):
     """
     Return the named column of an ndarray. 
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""
+Times datman.scanid filename parsing against the plain regexes.
+
+Usage:
+    benchmark_scanid.py [options]
+
+Options:
+    --names N       Number of distinct filenames to parse [default: 1000000]
+    --repeat N      Times to re-parse a small set of names [default: 3000]
+    --best-of N     Number of times to run each benchmark [default: 3]
+
+parse_filename isn't memoized (keeping results would cost more than the
+split fast path takes), so a single pass over many distinct names and
+re-parsing the same few hundred names over and over, as get_files_with_tag
+and qc_folder do, cost the same per name.
+"""
+from docopt import docopt
+import datman.scanid as scanid
+import os.path
+import time
+
+
+def make_names(count):
+    return ['/archive/data/nii/DTI_CMH_H{0:06d}_01/'
+            'DTI_CMH_H{0:06d}_01_01_T1_{1:02d}_Sag-T1-BRAVO.nii.gz'.format(
+                i, i % 20) for i in range(count)]
+
+
+def parse_regex(path):
+    """Parses a filename the way parse_filename did before the fast path"""
+    fname = os.path.basename(path)
+    match = scanid.FILENAME_PHA_PATTERN.match(fname)
+    if not match: match = scanid.FILENAME_PATTERN.match(fname)
+    if not match: raise scanid.ParseException()
+
+    ident = scanid.Identifier(study     = match.group("study"),
+                              site      = match.group("site"),
+                              subject   = match.group("subject"),
+                              timepoint = match.group("timepoint"),
+                              session   = match.group("session"))
+    return (ident, match.group("tag"), match.group("series"),
+            match.group("description"))
+
+
+def best_time(func, names, repeat, best_of):
+    times = []
+    for i in range(best_of):
+        start = time.time()
+        for j in range(repeat):
+            for name in names:
+                func(name)
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main():
+    arguments = docopt(__doc__)
+    count     = int(arguments['--names'])
+    repeat    = int(arguments['--repeat'])
+    best_of   = int(arguments['--best-of'])
+
+    names = make_names(count)
+    few = names[:300]
+    for label, func, names, repeat in [
+            ('regex, one pass', parse_regex, names, 1),
+            ('parse_filename, one pass', scanid.parse_filename, names, 1),
+            ('split fast path, one pass',
+             lambda path: scanid._split_filename(os.path.basename(path)),
+             names, 1),
+            ('regex, 300 names re-parsed', parse_regex, few, repeat),
+            ('parse_filename, 300 names re-parsed', scanid.parse_filename,
+             few, repeat)]:
+        print "{:40} {:.2f}s".format(
+            label, best_time(func, names, repeat, best_of))
+
+
+if __name__ == '__main__':
+    main()
+
+# vim: ts=4 sw=4:
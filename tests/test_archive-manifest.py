@@ -0,0 +1,106 @@
+from nose.tools import *
+from nose.plugins.skip import SkipTest
+from collections import OrderedDict
+from StringIO import StringIO
+import importlib
+import os
+import pandas as pd
+import shutil
+import sys
+import tempfile
+import zipfile
+from test_datman_utils import make_dicom
+
+manifest = importlib.import_module('bin.archive-manifest')
+
+TMPDIR = None
+
+COLUMNS = ['Path', 'PatientName', 'SeriesNumber']
+ROWS = [OrderedDict(zip(COLUMNS, ['exam/1', 'STUDY_\xc3\xa9', '1'])),
+        OrderedDict(zip(COLUMNS, ['exam/2', 'STUDY', '2'])),
+        OrderedDict(zip(COLUMNS, ['exam/3', '', '3']))]
+
+
+def setup():
+    global TMPDIR
+    TMPDIR = tempfile.mkdtemp()
+
+
+def teardown():
+    shutil.rmtree(TMPDIR)
+
+
+def test_in_order():
+    results = [('c', 3, None), ('a', 1, None), ('d', 4, None), ('b', 2, None)]
+    eq_([r[0] for r in manifest.in_order(iter(results), ['a', 'b', 'c', 'd'])],
+        ['a', 'b', 'c', 'd'])
+
+
+def test_get_rows():
+    headers = {'1': {'SeriesNumber': 1, 'PatientName': u'STUDY_\xe9'},
+               '10': {'SeriesNumber': 10},
+               '2': {'SeriesNumber': 2, 'PatientName': 'STUDY'}}
+    rows = manifest.get_rows(headers, ['PatientName', 'SeriesNumber'])
+    eq_([r.items() for r in rows], [
+        [('Path', '1'), ('PatientName', 'STUDY_\xc3\xa9'), ('SeriesNumber', '1')],
+        [('Path', '2'), ('PatientName', 'STUDY'), ('SeriesNumber', '2')],
+        [('Path', '10'), ('PatientName', ''), ('SeriesNumber', '10')]])
+    eq_(len(manifest.get_rows(headers, ['PatientName'], oneseries=True)), 1)
+
+
+def write_rows(fmt, path):
+    writer = manifest.WRITERS[fmt](path, COLUMNS)
+    for row in ROWS:
+        writer.write(row)
+    writer.close()
+
+
+def expected_frame():
+    return pd.DataFrame([row.values() for row in ROWS],
+                        columns=COLUMNS).applymap(lambda v: v.decode('utf-8'))
+
+
+def test_parquet_writer():
+    if not manifest.pyarrow:
+        raise SkipTest("pyarrow is not installed")
+    path = os.path.join(TMPDIR, 'manifest.parquet')
+    old_size, manifest.ROW_GROUP_SIZE = manifest.ROW_GROUP_SIZE, 2
+    try:
+        write_rows('parquet', path)
+    finally:
+        manifest.ROW_GROUP_SIZE = old_size
+    parquet = manifest.pyarrow.parquet.ParquetFile(path)
+    eq_(parquet.num_row_groups, 2)
+    ok_(parquet.read().to_pandas().equals(expected_frame()))
+
+
+def test_feather_writer():
+    if not manifest.pyarrow:
+        raise SkipTest("pyarrow is not installed")
+    path = os.path.join(TMPDIR, 'manifest.feather')
+    write_rows('feather', path)
+    ok_(pd.read_feather(path).equals(expected_frame()))
+
+
+def test_unreadable_archive_fails_the_run():
+    dcmfile = os.path.join(TMPDIR, 'series.dcm')
+    make_dicom(dcmfile)
+    good = os.path.join(TMPDIR, 'good.zip')
+    zf = zipfile.ZipFile(good, 'w')
+    zf.write(dcmfile, 'exam/1/0.dcm')
+    zf.close()
+    bad = os.path.join(TMPDIR, 'bad.zip')
+    open(bad, 'w').write('not a zip')
+
+    argv, sys.argv = sys.argv, ['archive-manifest.py', bad, good]
+    stdout, sys.stdout = sys.stdout, StringIO()
+    stderr, sys.stderr = sys.stderr, StringIO()
+    try:
+        with assert_raises(SystemExit) as raised:
+            manifest.main()
+        output, errors = sys.stdout.getvalue(), sys.stderr.getvalue()
+    finally:
+        sys.argv, sys.stdout, sys.stderr = argv, stdout, stderr
+    eq_(raised.exception.code, "ERROR: 1 of 2 archives couldn't be read")
+    ok_(errors.startswith("ERROR: {}: ".format(bad)), errors)
+    eq_(output.splitlines()[1:], ['exam/1,,512,DTI_CMH_H001_01_01,1,T1'])
@@ -133,3 +133,152 @@ def test_load_and_blacklist_new_stage():
     checklist.blacklist("stage", "series2")
     assert checklist.is_blacklisted("stage", "series1"), checklist
     assert checklist.is_blacklisted("stage", "series2"), checklist
+
+def test_sqlite_checklist_blacklist():
+    checklist = dm.checklist.SQLiteChecklist(':memory:')
+    assert not checklist.is_blacklisted("stage", "series"), checklist
+    checklist.blacklist("stage", "series", "Truncated scan")
+    checklist.blacklist("stage", "series", "Duplicate entry")
+    assert checklist.is_blacklisted("stage", "series"), checklist
+    assert not checklist.is_blacklisted("other", "series"), checklist
+    checklist.unblacklist("stage", "series")
+    assert not checklist.is_blacklisted("stage", "series"), checklist
+
+def test_sqlite_checklist_yaml_round_trip():
+    checklist = dm.checklist.SQLiteChecklist(':memory:')
+    checklist.import_yaml(StringIO(
+        """
+    ignore: [a, b]
+    blacklist:
+      stage:
+        series1: Truncated scan
+        series2:
+    """))
+    assert checklist.is_blacklisted("stage", "series1"), checklist
+    assert checklist.is_blacklisted("stage", "series2"), checklist
+
+    stream = StringIO()
+    checklist.save(stream)
+    stream.seek(0)
+    data = dm.checklist.load(stream).data
+    eq_(data['ignore'], ['a', 'b'])
+    eq_(data['blacklist']['stage'], {'series1': 'Truncated scan',
+                                     'series2': None})
+
+def test_load_sqlite_checklist():
+    import os, tempfile
+    tmp = tempfile.mkdtemp()
+    dbfile = os.path.join(tmp, 'checklist.db')
+    try:
+        checklist = dm.checklist.load(dbfile)
+        checklist.blacklist("stage", "series")
+        dm.checklist.save(checklist, dbfile)
+        assert dm.checklist.load(dbfile).is_blacklisted("stage", "series")
+    finally:
+        os.remove(dbfile)
+        os.rmdir(tmp)
+
+def test_save_merges_concurrent_changes():
+    import os, shutil, tempfile
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'checklist.yaml')
+    try:
+        open(path, 'w').write("blacklist:\n  stage:\n    series1:\n")
+        first = dm.checklist.load(path)
+        second = dm.checklist.load(path)
+
+        first.blacklist("stage", "series2")
+        first.unblacklist("stage", "series1")
+        dm.checklist.save(first, path, merge=True)
+
+        second.blacklist("stage", "series3")
+        dm.checklist.save(second, path, merge=True)
+
+        checklist = dm.checklist.load(path)
+        assert not checklist.is_blacklisted("stage", "series1"), checklist
+        assert checklist.is_blacklisted("stage", "series2"), checklist
+        assert checklist.is_blacklisted("stage", "series3"), checklist
+        eq_(sorted(f for f in os.listdir(tmp) if not f.endswith('.lock')),
+            ['checklist.yaml'])
+    finally:
+        shutil.rmtree(tmp)
+
+def test_save_without_merge_overwrites():
+    import os, shutil, tempfile
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'checklist.yaml')
+    try:
+        open(path, 'w').write("blacklist:\n  stage:\n    series1:\n")
+        first = dm.checklist.load(path)
+        second = dm.checklist.load(path)
+        first.unblacklist("stage", "series1")
+        dm.checklist.save(first, path)
+        dm.checklist.save(second, path)
+        assert dm.checklist.load(path).is_blacklisted("stage", "series1")
+    finally:
+        shutil.rmtree(tmp)
+
+def test_load_sections_lazily():
+    checklist = dm.checklist.Checklist(StringIO(
+        """
+    ignore: [a, b]
+    blacklist:
+      stage1:
+        series1: Truncated scan
+      # a comment
+      stage2: {series2: }
+      stage3: not a dict
+    """))
+    eq_(sorted(checklist._unparsed.keys()), ['stage1', 'stage2', 'stage3'])
+    assert checklist.is_blacklisted("stage2", "series2"), checklist
+    eq_(sorted(checklist._unparsed.keys()), ['stage1', 'stage3'])
+
+    checklist.blacklist("stage2", "series3")
+    eq_(checklist.data['ignore'], ['a', 'b'])
+    eq_(sorted(checklist.data['blacklist']['stage2']), ['series2', 'series3'])
+    eq_(checklist.data['blacklist']['stage1'], {'series1': 'Truncated scan'})
+
+def test_index_sections_falls_back_on_flow_style():
+    eq_(dm.checklist.index_sections("blacklist: {stage: {series: }}\n"), None)
+    eq_(dm.checklist.index_sections("- blacklist:\n"), None)
+    eq_(dm.checklist.index_sections("blacklist:\n  'stage':\n"), None)
+    eq_(dm.checklist.index_sections("blacklist:\n  stage:\n"),
+        {'stage': "  stage:\n"})
+
+def test_load_is_cached_until_file_changes():
+    import os, shutil, tempfile
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'checklist.yaml')
+    try:
+        open(path, 'w').write("blacklist:\n  stage:\n    series1:\n")
+        checklist = dm.checklist.load(path, cache=True)
+        assert dm.checklist.load(path, cache=True) is checklist
+        assert dm.checklist.load(path) is not checklist
+
+        open(path, 'w').write("blacklist:\n  stage:\n    series2:\n")
+        stat = os.stat(path)
+        os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+        reloaded = dm.checklist.load(path, cache=True)
+        assert reloaded is not checklist
+        assert reloaded.is_blacklisted("stage", "series2"), reloaded
+    finally:
+        shutil.rmtree(tmp)
+
+def test_uncached_loads_are_independent():
+    import os, shutil, tempfile
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'checklist.yaml')
+    try:
+        open(path, 'w').write("blacklist:\n  stage:\n    series1:\n")
+        cached = dm.checklist.load(path, cache=True)
+        checklist = dm.checklist.load(path)
+        checklist.blacklist("stage", "series2")
+        assert not dm.checklist.load(path).is_blacklisted("stage", "series2")
+        assert not cached.is_blacklisted("stage", "series2")
+
+        dm.checklist.save(checklist, path)
+        reloaded = dm.checklist.load(path, cache=True)
+        assert reloaded is not checklist and reloaded is not cached
+        assert reloaded.is_blacklisted("stage", "series2"), reloaded
+    finally:
+        shutil.rmtree(tmp)
@@ -0,0 +1,58 @@
+import datman.exportinfo
+import datman.utils
+import pandas as pd
+from StringIO import StringIO
+from nose.tools import *
+
+TABLE = """\
+pattern       tag     export_mnc  export_nii  export_nrrd  count
+Localiser     LOC     no          no          no           1
+T1            T1      yes         yes         no           1
+BRAVO         T1      yes         yes         no           1
+T2            T2      yes         no          no           1
+FLAIR         FLAIR   yes         yes         yes          1
+DTI-60        DTI-60  no          yes         yes          3
+(DTI)-\\1      DTI     no          yes         no           1
+EA.Task       EMP     no          yes         no           1
+"""
+
+
+def read_table():
+    return pd.read_table(StringIO(TABLE), sep='\s*', engine="python")
+
+
+def test_formats():
+    exportinfo = datman.exportinfo.ExportInfo(read_table())
+    eq_(exportinfo.formats, ['mnc', 'nii', 'nrrd'])
+
+
+def test_lookup():
+    exportinfo = datman.exportinfo.ExportInfo(read_table())
+    eq_(exportinfo.lookup('Sag-T1-BRAVO'), ('T1', ['mnc', 'nii']))
+    eq_(exportinfo.lookup('Ax-DTI-60'), ('DTI-60', ['nii', 'nrrd']))
+    eq_(exportinfo.lookup('EA-Task'), ('EMP', ['nii']))
+    eq_(exportinfo.lookup('Localiser'), ('LOC', []))
+    eq_(exportinfo.lookup('Calibration'), (None, []))
+    eq_(exportinfo.lookup('T2-FLAIR'), (['FLAIR', 'T2'], []))
+    eq_(exportinfo.lookup('DTI-DTI'), ('DTI', ['nii']))
+
+
+def test_guess_tag_agrees_with_utils():
+    table = read_table()
+    exportinfo = datman.exportinfo.ExportInfo(table)
+    tagmap = dict(zip(table['pattern'].tolist(), table['tag'].tolist()))
+    for description in ['Sag-T1-BRAVO', 'Ax-DTI-60', 'EA-Task', 'EA.Task',
+                        'T2-FLAIR', 'Resting', 'DTI-DTI', '']:
+        expected = datman.utils.guess_tag(description, tagmap)
+        if isinstance(expected, list):
+            expected = sorted(expected)
+        eq_(exportinfo.guess_tag(description), expected)
+        eq_(exportinfo.guess_tag(description), expected)   # memoized
+
+
+def test_compile_any():
+    eq_(len(datman.exportinfo.compile_any(['T1', 'T2.*'])), 1)
+    eq_(len(datman.exportinfo.compile_any(['(a)\\1', 'b'])), 2)
+    eq_(datman.exportinfo.compile_any([]), [])
+
+# vim: ts=4 sw=4:
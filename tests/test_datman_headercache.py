@@ -0,0 +1,80 @@
+import datman.headercache
+import os
+import shutil
+import tempfile
+import zipfile
+from nose.tools import *
+from test_datman_utils import make_dicom
+
+TMPDIR = None
+
+
+def setup():
+    global TMPDIR
+    TMPDIR = tempfile.mkdtemp()
+    make_archive('exam.zip', "T1")
+
+
+def teardown():
+    shutil.rmtree(TMPDIR)
+
+
+def make_archive(name, description):
+    dcmfile = os.path.join(TMPDIR, 'series.dcm')
+    make_dicom(dcmfile, description=description)
+    zf = zipfile.ZipFile(os.path.join(TMPDIR, name), 'w')
+    zf.write(dcmfile, 'exam/1/0.dcm')
+    zf.close()
+    os.remove(dcmfile)
+
+
+def test_cached_headers():
+    cache = datman.headercache.HeaderCache(':memory:')
+    archive = os.path.join(TMPDIR, 'exam.zip')
+
+    manifest = cache.get_archive_headers(archive)
+    eq_(manifest.keys(), ['exam/1'])
+    eq_(manifest['exam/1'].get('SeriesDescription'), "T1")
+    eq_(manifest['exam/1'].get('SeriesNumber'), 1)
+    ok_('PixelData' not in manifest['exam/1'])
+
+    eq_(cache.get_archive_headers(archive), manifest)
+    eq_(cache.prefetch(TMPDIR), [])
+
+
+def test_changed_archive_is_reread():
+    cache = datman.headercache.HeaderCache(':memory:')
+    make_archive('changed.zip', "T1")
+    archive = os.path.join(TMPDIR, 'changed.zip')
+    eq_(cache.get_archive_headers(archive)['exam/1'].SeriesDescription, "T1")
+
+    make_archive('changed.zip', "T2-FLAIR")
+    stat = os.stat(archive)
+    os.utime(archive, (stat.st_atime, stat.st_mtime + 10))
+    eq_(cache.get_archive_headers(archive)['exam/1'].SeriesDescription,
+        "T2-FLAIR")
+
+
+def test_missing_archive_does_not_stop_the_others():
+    cache = datman.headercache.HeaderCache(':memory:')
+    archive = os.path.join(TMPDIR, 'exam.zip')
+    missing = os.path.join(TMPDIR, 'missing.zip')
+
+    results = dict((path, (manifest, error)) for path, manifest, error in
+                   cache.get_archive_headers_many([missing, archive]))
+    eq_(results[archive][0].keys(), ['exam/1'])
+    eq_(results[archive][1], None)
+    eq_(results[missing][0], None)
+    ok_(results[missing][1].startswith('OSError'))
+
+
+def test_prefetch_skips_unreadable_archives():
+    cache = datman.headercache.HeaderCache(':memory:')
+    folder = os.path.join(TMPDIR, 'prefetch')
+    os.makedirs(folder)
+    shutil.copy(os.path.join(TMPDIR, 'exam.zip'), folder)
+    os.symlink(os.path.join(TMPDIR, 'missing.zip'),
+               os.path.join(folder, 'broken.zip'))
+    eq_(cache.prefetch(folder), [os.path.join(folder, 'exam.zip')])
+
+# vim: ts=4 sw=4:
@@ -0,0 +1,85 @@
+import collections
+import datman.headerchecks
+import os
+import shutil
+import tempfile
+from nose.tools import *
+
+TMPDIR = None
+
+Mismatch = collections.namedtuple(
+    'Mismatch', ['header', 'expected', 'actual', 'tolerance'])
+
+
+def setup():
+    global TMPDIR
+    TMPDIR = tempfile.mkdtemp()
+
+
+def teardown():
+    shutil.rmtree(TMPDIR)
+
+
+def test_store():
+    store = datman.headerchecks.MismatchStore(os.path.join(TMPDIR, 'h.db'))
+    t1 = 'exams/DTI_CMH_H001_01_01/DTI_CMH_H001_01_01_T1_02_SagT1.dcm'
+    dti = 'exams/DTI_CMH_H001_01_01/DTI_CMH_H001_01_01_DTI-60_05_DTI.dcm'
+    store.update_exam('DTI_CMH_H001_01_01', {
+        t1: [Mismatch('EchoTime', 30.0, 40.0, 5),
+             Mismatch('ImageType', ['A', 'B'], None, None)],
+        dti: [Mismatch('EchoTime', 80.0, 90.0, 5)]})
+
+    eq_(store.exams(), ['DTI_CMH_H001_01_01'])
+    mismatches = store.get_series('data/nii/DTI_CMH_H001_01/'
+                                  'DTI_CMH_H001_01_01_T1_02_SagT1.nii.gz')
+    eq_([(m.header, m.expected, m.actual, m.tolerance) for m in mismatches],
+        [('EchoTime', 30.0, 40.0, 5), ('ImageType', ['A', 'B'], None, None)])
+    eq_(mismatches[0].path, t1)
+    eq_(len(store.find(header='EchoTime')), 2)
+    eq_(datman.headerchecks.describe(mismatches[0]),
+        'header EchoTime, expected = 30.0, actual = 40.0 [tolerance = 5]')
+
+    # an exam's mismatches are replaced when it is checked again
+    store.update_exam('DTI_CMH_H001_01_01', {dti: []})
+    eq_(store.get_exam('DTI_CMH_H001_01_01'), [])
+    eq_(store.exams(), [])
+
+
+def test_store_records_exams_checked():
+    store = datman.headerchecks.MismatchStore(os.path.join(TMPDIR, 'c.db'))
+    t1 = 'exams/DTI_CMH_H002_01_01/DTI_CMH_H002_01_01_T1_02_SagT1.dcm'
+    store.update_exam('DTI_CMH_H002_01_01', {t1: []})
+    store.update_exam('DTI_CMH_H003_01_01', {
+        t1: [Mismatch('EchoTime', 30.0, 40.0, 5)]}, checked_at=100.0)
+    ok_(store.is_checked('DTI_CMH_H002_01_01'))
+    ok_(store.is_checked('DTI_CMH_H003_01_01'))
+    ok_(not store.is_checked('DTI_CMH_H004_01_01'))
+    eq_(list(store.db.execute('SELECT checked_at FROM checked WHERE exam = ?',
+                              ('DTI_CMH_H003_01_01',))), [(100.0,)])
+
+    # exams stored before checks were recorded
+    store.db.execute('DELETE FROM checked')
+    ok_(store.is_checked('DTI_CMH_H003_01_01'))
+    ok_(not store.is_checked('DTI_CMH_H002_01_01'))
+    store.close()
+
+
+def test_read_logs_of_exams_not_in_the_store():
+    logsdir = os.path.join(TMPDIR, 'logs')
+    os.makedirs(logsdir)
+    for exam in ['DTI_CMH_H005_01_01', 'DTI_CMH_H005_01_02',
+                 'DTI_CMH_H006_01_01']:
+        open(os.path.join(logsdir, 'dm-check-headers-{}.log'.format(exam)),
+             'w').write('{}/T1.dcm: header EchoTime\n'.format(exam))
+    store = datman.headerchecks.MismatchStore(
+        os.path.join(logsdir, datman.headerchecks.STORE_NAME))
+    eq_(datman.headerchecks.read_logs(logsdir, 'DTI_CMH_H005_01', store), [
+        'DTI_CMH_H005_01_01/T1.dcm: header EchoTime\n',
+        'DTI_CMH_H005_01_02/T1.dcm: header EchoTime\n'])
+
+    # once checked (now with no mismatches), an exam's log isn't used
+    store.update_exam('DTI_CMH_H005_01_01', {})
+    eq_(datman.headerchecks.read_logs(logsdir, 'DTI_CMH_H005_01', store), [
+        'DTI_CMH_H005_01_02/T1.dcm: header EchoTime\n'])
+    eq_(len(datman.headerchecks.read_logs(logsdir, 'DTI_CMH_H005_01')), 2)
+    store.close()
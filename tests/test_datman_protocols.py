@@ -0,0 +1,106 @@
+import datman.protocols
+import os
+import pandas as pd
+import shutil
+import tempfile
+from StringIO import StringIO
+from nose.tools import *
+
+TMPDIR = None
+
+EXPORTINFO = """\
+pattern  tag  export_nii  count
+T1       T1   yes         1,1
+DTI      DTI  yes         1,0
+Loc      ?    no          0,0
+"""
+
+FILES = [
+    'SPN01_CMH_0001_01/SPN01_CMH_0001_01_01_T1_02_SagT1.nii.gz',
+    'SPN01_CMH_0001_01/SPN01_CMH_0001_01_01_DTI_03_DTI.nii.gz',
+    'SPN01_CMH_0001_01/SPN01_CMH_0001_01_01_DTI_03_DTI.bvec',
+    'SPN01_CMH_0001_01/notes.txt',
+    'SPN01_CMH_0002_01/SPN01_CMH_0002_01_01_T1_02_SagT1.nii.gz',
+    'SPN01_CMH_0002_01/SPN01_CMH_0002_01_01_T1_05_SagT1.nii.gz',
+]
+
+SUBJECTS = ['SPN01_CMH_0001_01', 'SPN01_CMH_0002_01', 'SPN01_CMH_0003_01']
+
+
+def setup():
+    global TMPDIR
+    TMPDIR = tempfile.mkdtemp()
+    for path in FILES:
+        path = os.path.join(TMPDIR, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, 'w').close()
+    os.makedirs(os.path.join(TMPDIR, 'SPN01_CMH_0003_01'))
+
+
+def teardown():
+    shutil.rmtree(TMPDIR)
+
+
+def expected_counts():
+    table = pd.read_csv(StringIO(EXPORTINFO), sep='\s+')
+    return datman.protocols.expected_counts(table)
+
+
+def test_expected_counts():
+    expected = expected_counts()
+    eq_(list(expected.columns), ['T1', 'DTI'])
+    eq_(expected.values.tolist(), [[1, 1], [1, 0]])
+
+
+@raises(ValueError)
+def test_expected_counts_protocols_differ():
+    table = pd.DataFrame({'tag': ['T1', 'DTI'], 'count': ['1,1', '1']})
+    datman.protocols.expected_counts(table)
+
+
+def test_index_and_count():
+    index = datman.protocols.index_folder(TMPDIR, '.nii.gz')
+    eq_(len(index), 4)
+    eq_(sorted(index['name'])[0], 'SPN01_CMH_0001_01_01_DTI_03_DTI')
+
+    counts = datman.protocols.count_tags(index, SUBJECTS, ['T1', 'DTI'])
+    eq_(counts.values.tolist(), [[1, 1], [2, 0], [0, 0]])
+
+
+def test_index_without_ext_lists_each_series_once():
+    index = datman.protocols.index_folder(TMPDIR)
+    eq_(sorted(index['name']), ['SPN01_CMH_0001_01_01_DTI_03_DTI',
+                                'SPN01_CMH_0001_01_01_T1_02_SagT1',
+                                'SPN01_CMH_0002_01_01_T1_02_SagT1',
+                                'SPN01_CMH_0002_01_01_T1_05_SagT1'])
+
+
+def test_compare():
+    index = datman.protocols.index_folder(TMPDIR, '.nii.gz')
+    expected = expected_counts()
+    counts = datman.protocols.count_tags(index, SUBJECTS, expected.columns)
+    comparison = datman.protocols.compare(counts, expected)
+
+    eq_(comparison.protocol.tolist(), [0, 1, 1])
+    eq_(comparison.complete.tolist(), [True, True, False])
+    eq_(datman.protocols.missing_series(comparison).values.tolist(),
+        [['SPN01_CMH_0003_01', 'T1', 1]])
+    eq_(datman.protocols.extra_series(comparison).values.tolist(),
+        [['SPN01_CMH_0002_01', 'T1', 1]])
+
+    flagged = datman.protocols.flagged_series(
+        index, ['SPN01_CMH_0002_01_01_T1_05_SagT1'])
+    eq_(flagged['folder'].tolist(), ['SPN01_CMH_0002_01'])
+
+
+def test_compare_without_tags():
+    index = datman.protocols.index_folder(TMPDIR, '.nii.gz')
+    expected = expected_counts()[[]]
+    counts = datman.protocols.count_tags(index, SUBJECTS, [])
+    comparison = datman.protocols.compare(counts, expected)
+    for table, column in [
+            (datman.protocols.missing_series(comparison), 'missing'),
+            (datman.protocols.extra_series(comparison), 'extra')]:
+        eq_(list(table.columns), ['subject', 'tag', column])
+        eq_(len(table), 0)
@@ -95,4 +95,71 @@ def test_parse_filename_with_path():
     eq_(series, '02')
     eq_(description, 'description')
 
+def test_parse_filename_description_with_underscores():
+    ident, tag, series, description = scanid.parse_filename(
+            'DTI_CMH_H001_01_01_T1_03_desc_with_underscores.nii.gz')
+    eq_(str(ident), 'DTI_CMH_H001_01_01')
+    eq_(tag, 'T1')
+    eq_(series, '03')
+    eq_(description, 'desc_with_underscores')
+
+def test_parse_filename_PHA_not_phantom_fields():
+    # not a valid phantom name (series isn't a number), but is a valid scan
+    ident, tag, series, description = scanid.parse_filename(
+            'DTI_CMH_PHA_X_01_T1_03_description.nii.gz')
+    eq_(str(ident), 'DTI_CMH_PHA_X_01')
+    eq_(tag, 'T1')
+    eq_(series, '03')
+
+@raises(scanid.ParseException)
+def test_parse_filename_bad_series():
+    scanid.parse_filename('DTI_CMH_H001_01_01_T1_XX_description.nii.gz')
+
+def test_parse_is_memoized():
+    ok_(scanid.parse("DTI_CMH_H001_01_02") is scanid.parse("DTI_CMH_H001_01_02"))
+    for i in range(2):
+        assert_raises(scanid.ParseException, scanid.parse, "garbage")
+
+def test_parse_unicode_is_memoized_separately():
+    assert_raises(scanid.ParseException, scanid.parse, u"DTI_CMH_H003_01_02")
+    eq_(str(scanid.parse("DTI_CMH_H003_01_02")), "DTI_CMH_H003_01_02")
+    assert_raises(scanid.ParseException, scanid.parse, u"DTI_CMH_H003_01_02")
+
+@raises(scanid.ParseException)
+def test_parse_unhashable():
+    scanid.parse([])
+
+def test_study_and_site_are_shared():
+    a = scanid.parse("".join(["DTI", "_CMH_H001_01_02"]))
+    b = scanid.parse("".join(["DTI", "_CMH_H002_01_02"]))
+    ok_(a.study is b.study)
+    ok_(a.site is b.site)
+
+def test_parse_many():
+    frame = scanid.parse_many([
+        '/data/DTI_CMH_H001_01_01_T1_03_description.nii.gz',
+        'SPN01_MRC_PHA_FBN0013_RST_04_EPI-3x3x4xTR2.nii.gz',
+        'garbage.txt'])
+
+    eq_(frame['parsed'].tolist(), [True, True, False])
+    eq_(frame['study'].tolist()[:2], ['DTI', 'SPN01'])
+    eq_(frame['subject'].tolist()[:2], ['H001', 'PHA_FBN0013'])
+    eq_(frame['timepoint'].tolist()[:2], ['01', ''])
+    eq_(frame['tag'].tolist()[:2], ['T1', 'RST'])
+    eq_(frame['series'].tolist()[:2], ['03', '04'])
+    eq_(frame['ext'].tolist()[:2], ['.nii.gz', '.nii.gz'])
+    eq_(frame['path'].tolist()[2], 'garbage.txt')
+
+def test_parse_many_matches_parse_filename():
+    names = ['DTI_CMH_H001_01_01_T1_03_desc_with_underscores.nii.gz',
+             'DTI_CMH_PHA_X_01_T1_03_description.nii.gz',
+             'DTI_CMH_PHA_ADN0001_T1_02_description']
+    frame = scanid.parse_many(names)
+    for name, row in zip(names, frame.itertuples()):
+        ident, tag, series, description = scanid.parse_filename(name)
+        eq_((row.study, row.site, row.subject, row.timepoint, row.session),
+            (ident.study, ident.site, ident.subject, ident.timepoint,
+             ident.session))
+        eq_((row.tag, row.series, row.description), (tag, series, description))
+
 # vim: ts=4 sw=4:
@@ -0,0 +1,170 @@
+import datman.utils
+import dicom
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import zipfile
+from dicom.dataset import Dataset, FileDataset
+from nose.tools import *
+
+TMPDIR = None
+
+
+def make_dicom(path, series=1, description="T1", pixels=256 * 256):
+    meta = Dataset()
+    meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
+    meta.MediaStorageSOPInstanceUID = '1.2.3.{}'.format(series)
+    meta.ImplementationClassUID = '1.2.3.4'
+    meta.TransferSyntaxUID = '1.2.840.10008.1.2.1'  # explicit VR LE
+
+    ds = FileDataset(path, {}, file_meta=meta, preamble="\0" * 128)
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+    ds.PatientName = "DTI_CMH_H001_01_01"
+    ds.StudyID = "512"
+    ds.SeriesNumber = series
+    ds.SeriesDescription = description
+    ds.PixelData = "\0\1" * pixels
+    ds[dicom.tag.Tag(0x7fe0, 0x0010)].VR = 'OW'
+    ds.save_as(path)
+
+
+def setup():
+    """Make an exam folder, along with zip and tarball copies of it"""
+    global TMPDIR
+    TMPDIR = tempfile.mkdtemp()
+    for series in [1, 2]:
+        seriesdir = os.path.join(TMPDIR, 'exam', str(series))
+        os.makedirs(seriesdir)
+        open(os.path.join(seriesdir, 'catalog.xml'), 'w').write('<xml/>')
+        for i in range(3):
+            make_dicom(os.path.join(seriesdir, '{}.dcm'.format(i)),
+                       series=series, description="Series {}".format(series))
+
+    examdir = os.path.join(TMPDIR, 'exam')
+    zf = zipfile.ZipFile(os.path.join(TMPDIR, 'exam.zip'), 'w')
+    tf = tarfile.open(os.path.join(TMPDIR, 'exam.tar.gz'), 'w:gz')
+    for dirpath, dirs, files in os.walk(examdir):
+        for f in sorted(files):
+            path = os.path.join(dirpath, f)
+            zf.write(path, os.path.relpath(path, TMPDIR))
+            tf.add(path, os.path.relpath(path, TMPDIR))
+    zf.close()
+    tf.close()
+
+
+def teardown():
+    shutil.rmtree(TMPDIR)
+
+
+class CountingStream(object):
+    """A non-seekable stream that counts the bytes read from it"""
+
+    def __init__(self, data):
+        self.stream = io.BytesIO(data)
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.bytes_read += len(data)
+        return data
+
+
+def test_read_header_stops_before_pixels():
+    path = os.path.join(TMPDIR, 'exam', '1', '0.dcm')
+    stream = CountingStream(open(path, 'rb').read())
+    header = datman.utils.read_header(stream)
+
+    eq_(header.SeriesDescription, "Series 1")
+    ok_('PixelData' not in header)
+    ok_(stream.bytes_read < 4096, stream.bytes_read)
+
+
+def test_read_header_tags():
+    path = os.path.join(TMPDIR, 'exam', '1', '0.dcm')
+    header = datman.utils.read_header(path, tags=['SeriesNumber', 'StudyID'])
+    eq_(sorted(header.dir()), ['SeriesNumber', 'StudyID'])
+    eq_(header.SeriesNumber, 1)
+
+
+@raises(dicom.filereader.InvalidDicomError)
+def test_read_header_not_dicom():
+    datman.utils.read_header(os.path.join(TMPDIR, 'exam', '1', 'catalog.xml'))
+
+
+@raises(ValueError)
+def test_read_header_unknown_tag():
+    path = os.path.join(TMPDIR, 'exam', '1', '0.dcm')
+    datman.utils.read_header(path, tags=['NotADicomHeader'])
+
+
+def check_archive_headers(archive, seriesdirs):
+    manifest = datman.utils.get_archive_headers(archive)
+    eq_(sorted(manifest.keys()), seriesdirs)
+    eq_(sorted(h.SeriesDescription for h in manifest.values()),
+        ["Series 1", "Series 2"])
+
+    manifest = datman.utils.get_archive_headers(archive, stop_after_first=True)
+    eq_(len(manifest), 1)
+
+
+def test_get_archive_headers():
+    examdir = os.path.join(TMPDIR, 'exam')
+    check_archive_headers(examdir, [examdir + '/1', examdir + '/2'])
+    check_archive_headers(os.path.join(TMPDIR, 'exam.zip'),
+                          ['exam/1', 'exam/2'])
+    check_archive_headers(os.path.join(TMPDIR, 'exam.tar.gz'),
+                          ['exam/1', 'exam/2'])
+
+
+def test_get_archive_headers_many():
+    archives = [os.path.join(TMPDIR, 'exam.zip'),
+                os.path.join(TMPDIR, 'exam.tar.gz'),
+                os.path.join(TMPDIR, 'missing.zip')]
+
+    for workers in [1, 2]:
+        results = dict((path, (manifest, error)) for path, manifest, error in
+                       datman.utils.get_archive_headers_many(archives, workers))
+        eq_(sorted(results.keys()), sorted(archives))
+        eq_(len(results[archives[0]][0]), 2)
+        eq_(len(results[archives[1]][0]), 2)
+        eq_(results[archives[2]][0], None)
+        ok_(results[archives[2]][1])
+
+
+def test_dicom_likeness():
+    infos = []
+    for name, size in [('a/scan_catalog.xml', 9000), ('a/notes', 200),
+                       ('a/DICOMDIR', 5000), ('a/IM0001', 80000),
+                       ('a/0001.dcm', 80000), ('a/other.dat', 80000),
+                       ('a/t1.img', 90000)]:
+        info = zipfile.ZipInfo(name)
+        info.file_size = size
+        infos.append(info)
+
+    ranked = sorted(infos, key=datman.utils.dicom_likeness)
+    eq_([i.filename for i in ranked], ['a/0001.dcm', 'a/IM0001', 'a/notes',
+        'a/other.dat', 'a/t1.img', 'a/scan_catalog.xml', 'a/DICOMDIR'])
+
+
+def test_fingerprint():
+    seriesdir = os.path.join(TMPDIR, 'fingerprint')
+    shutil.copytree(os.path.join(TMPDIR, 'exam', '1'), seriesdir)
+    before = datman.utils.fingerprint(seriesdir)
+    ok_(before.startswith('4:'), before)
+    eq_(datman.utils.fingerprint(seriesdir), before)
+
+    # same size and mtime, different data
+    path = os.path.join(seriesdir, '2.dcm')
+    stat = os.stat(path)
+    data = open(path, 'rb').read()
+    open(path, 'wb').write(data[:-1] + '\xff')
+    os.utime(path, (stat.st_atime, stat.st_mtime))
+    ok_(datman.utils.fingerprint(seriesdir) != before)
+
+    os.remove(path)
+    ok_(datman.utils.fingerprint(seriesdir).startswith('3:'))
+
+# vim: ts=4 sw=4:
@@ -36,3 +36,36 @@ def test_mismatched_bvec_bval():
     assert bval in diffs.keys()
     assert bvec in diffs.keys()
 
+
+def test_mismatched_bvec_bval_differences():
+    standardsdir = FIXTURE_DIR + '/gold-standards'
+    examdir      = FIXTURE_DIR + '/data/nii/SPN01_CMH_PHA_FBN0000'
+    gold = check.load_gold_standards(standardsdir)
+    diffs = check.diff_files(examdir, standardsdir, gold)
+
+    bval = examdir + '/SPN01_CMH_PHA_FBN0000_DTI60-1000_04_Ax-DTI-60+5-NOASSET-incomplete.bval'
+    eq_(diffs[bval], [check.Difference('count', None, 65, 60, None)])
+
+def test_compare_bvecs():
+    expected = check.np.array([[0, 1, 0, 0.577],
+                               [0, 0, 1, 0.577],
+                               [0, 0, 0, 0.577]])
+    eq_(check.compare_bvecs(expected, expected.copy()), [])
+
+    # scaled and rounded directions match, but not flipped or zeroed ones
+    actual = check.np.array([[0, 1000, 0,  0.58],
+                             [0, 0,    -1, 0.58],
+                             [0, 0,    0,  0.57]])
+    eq_(check.compare_bvecs(expected, actual), [check.Difference(
+        'direction', 2, (0.0, 1.0, 0.0), (0.0, -1.0, 0.0), 180.0)])
+
+    actual[:, 2] = 0
+    eq_(check.compare_bvecs(expected, actual)[0].error, float('inf'))
+    eq_(check.compare_bvecs(expected, actual[:, :3]), [check.Difference(
+        'count', None, 4, 3, None)])
+
+def test_compare_bvals():
+    expected = check.np.array([0, 1000, 1000])
+    eq_(check.compare_bvals(expected, check.np.array([0, 1000.0, 1003])), [])
+    eq_(check.compare_bvals(expected, check.np.array([0, 1000, 900])),
+        [check.Difference('bval', 2, 1000.0, 900.0, 100.0)])
@@ -1,5 +1,10 @@
 from nose.tools import *
+import datman.headerchecks
+import dicom
 import importlib
+import os
+import shutil
+import tempfile
 import sys
 from StringIO import StringIO
 
@@ -75,4 +80,90 @@ def test_header_single_mismatch():
         tolerance=None)]
     assert mismatches == expected
 
+
+def test_tolerances():
+    stdhdr = mock_header({"EchoTime": 30.0, "RepetitionTime": 2.0})
+    cmphdr = mock_header({"EchoTime": 34.0, "RepetitionTime": 2.04})
+
+    eq_(check_headers.compare_headers(stdhdr, cmphdr), [])
+
+    cmphdr = mock_header({"EchoTime": 36.0, "RepetitionTime": 2.06})
+    eq_(sorted(check_headers.compare_headers(stdhdr, cmphdr)), [
+        check_headers.Mismatch(
+            header="EchoTime", expected=30.0, actual=36.0, tolerance=5),
+        check_headers.Mismatch(
+            header="RepetitionTime", expected=2.0, actual=2.1, tolerance=1)])
+
+
+def test_plan_ignores_headers():
+    stdhdr = mock_header({"same": 1, "ignored": 1})
+    plan = check_headers.ComparisonPlan(stdhdr, ignore_headers=["ignored"])
+    eq_(plan.headers, frozenset(["same"]))
+    eq_(plan.compare(mock_header({"same": 1, "ignored": 2})), [])
+    eq_(plan.compare(mock_header({"same": 1, "ignored": 2, "new": 3})),
+        [check_headers.Mismatch(
+            header="new", expected=None, actual=3, tolerance=None)])
+
+
+def test_plan_with_dicom_headers():
+    stdhdr = dicom.dataset.Dataset()
+    stdhdr.EchoTime = "30"
+    stdhdr.SeriesDescription = "T1"
+    stdhdr.add_new(0x00191010, 'SH', 'private')
+    cmphdr = dicom.dataset.Dataset()
+    cmphdr.EchoTime = "40"
+    cmphdr.SeriesDescription = "T2"
+    cmphdr.Manufacturer = "GE"
+
+    eq_(check_headers.header_names(stdhdr),
+        set(["EchoTime", "SeriesDescription"]))
+    plan = check_headers.ComparisonPlan(stdhdr,
+                                        ignore_headers=["SeriesDescription"])
+    eq_(sorted(plan.compare(cmphdr)), [
+        check_headers.Mismatch(
+            header="EchoTime", expected=30.0, actual=40.0, tolerance=5),
+        check_headers.Mismatch(
+            header="Manufacturer", expected=None, actual="GE", tolerance=None)])
+
+
+def test_settings_change_with_standards_and_ignored_headers():
+    stdfile = tempfile.NamedTemporaryFile()
+    stdfile.write("gold standard")
+    stdfile.flush()
+    stdmap = {"T1": (stdfile.name, mock_header())}
+
+    settings = check_headers.get_settings(stdmap, ["a", "b"])
+    eq_(check_headers.get_settings(stdmap, ["b", "a"]), settings)
+    ok_(check_headers.get_settings(stdmap, ["a"]) != settings)
+
+    stdfile.write("changed")
+    stdfile.flush()
+    ok_(check_headers.get_settings(stdmap, ["a", "b"]) != settings)
+
+
+def test_mismatches_are_logged_unless_asked_not_to():
+    logsdir = tempfile.mkdtemp()
+    try:
+        store = datman.headerchecks.MismatchStore(
+            os.path.join(logsdir, datman.headerchecks.STORE_NAME))
+        mismatches = {'exam/DTI_CMH_H001_01_01_T1_02_SagT1.dcm': [
+            check_headers.Mismatch(
+                header="EchoTime", expected=30.0, actual=40.0, tolerance=5)]}
+        check_headers.record_mismatches(store, logsdir,
+            '/exams/DTI_CMH_H001_01_01/', mismatches)
+        check_headers.record_mismatches(store, logsdir,
+            '/exams/DTI_CMH_H002_01_01/', mismatches, text_logs=False)
+
+        eq_(sorted(os.listdir(logsdir)), [
+            'dm-check-headers-DTI_CMH_H001_01_01.log',
+            datman.headerchecks.STORE_NAME])
+        eq_(open(os.path.join(logsdir,
+                 'dm-check-headers-DTI_CMH_H001_01_01.log')).read(),
+            'exam/DTI_CMH_H001_01_01_T1_02_SagT1.dcm: header EchoTime, '
+            'expected = 30.0, actual = 40.0 [tolerance = 5]\n')
+        eq_(store.exams(), ['DTI_CMH_H001_01_01', 'DTI_CMH_H002_01_01'])
+        store.close()
+    finally:
+        shutil.rmtree(logsdir)
+
 # vim: set ts=4 sw=4 :
@@ -0,0 +1,182 @@
+from nose.tools import *
+from StringIO import StringIO
+import importlib
+import os
+import shutil
+import sys
+import tempfile
+import zipfile
+from test_datman_utils import make_dicom
+
+watch = importlib.import_module('bin.dm-watch')
+
+TMPDIR = None
+
+
+def setup():
+    global TMPDIR
+    TMPDIR = tempfile.mkdtemp()
+
+
+def teardown():
+    shutil.rmtree(TMPDIR)
+
+
+def test_find_settled():
+    pending = {}
+    watch.update_pending(pending, 'a', (1, 10, 100.0), now=0)
+    watch.update_pending(pending, 'b', (1, 10, 100.0), now=5)
+    eq_(watch.find_settled(pending, now=50, settle=60), [])
+    eq_(watch.find_settled(pending, now=60, settle=60), ['a'])
+
+    # a change restarts the wait, an unchanged signature does not
+    watch.update_pending(pending, 'a', (1, 20, 101.0), now=62)
+    watch.update_pending(pending, 'b', (1, 10, 100.0), now=62)
+    eq_(watch.find_settled(pending, now=70, settle=60), ['b'])
+    eq_(watch.find_settled(pending, now=130, settle=60), ['b', 'a'])
+
+
+def test_signature_sees_growing_files():
+    examdir = os.path.join(TMPDIR, 'exam', '1')
+    os.makedirs(examdir)
+    path = os.path.join(examdir, '0.dcm')
+    open(path, 'w').write('DICM')
+    stat = os.stat(path)
+    before = watch.signature(os.path.join(TMPDIR, 'exam'))
+
+    # the folders are untouched, only the file is written to
+    open(path, 'a').write('more')
+    os.utime(path, (stat.st_atime, stat.st_mtime))
+    ok_(watch.signature(os.path.join(TMPDIR, 'exam')) != before)
+
+
+def capture(func, *args):
+    """Calls func, returning its result and what it printed"""
+    stdout, sys.stdout = sys.stdout, StringIO()
+    try:
+        return func(*args), sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+
+
+def make_folder(name, entries):
+    folder = os.path.join(TMPDIR, name)
+    os.makedirs(folder)
+    for entry in entries:
+        open(os.path.join(folder, entry), 'w').close()
+    return folder
+
+
+def test_failed_entries_are_retried():
+    folder = make_folder('retried', ['ok', 'flaky', 'broken'])
+    calls = []
+    outcomes = {'flaky': [False, True]}
+
+    def handler(path):
+        name = os.path.basename(path)
+        calls.append(name)
+        if name == 'broken':
+            raise ValueError("can't process")
+        return outcomes.get(name, [True]).pop(0)
+
+    done, pending, failures = set(), {}, {}
+    for now in [0, 60, 120, 180, 240, 300]:
+        capture(watch.check_folders, {folder: handler}, done, pending,
+                failures, now, 60, 2)
+    eq_(sorted(calls), ['broken', 'broken', 'broken', 'flaky', 'flaky', 'ok'])
+    eq_(done, set(os.path.join(folder, f) for f in ['ok', 'flaky', 'broken']))
+    eq_(pending, {})
+    eq_(failures, {})
+
+
+def test_exam_is_qcd_after_a_partial_extract():
+    arguments = {'--datadir': 'data', '--exportinfo': 'exportinfo.csv',
+                 '--checklist': None, '--header-cache': None,
+                 '--qcdir': 'qc', '--no-qc': False}
+    commands = []
+
+    def run(cmd):
+        commands.append(os.path.basename(cmd[1]))
+        return cmd[1].endswith('qc.py')
+
+    old_run, watch.run = watch.run, run
+    try:
+        handled, output = capture(watch.extract_exam,
+            os.path.join(TMPDIR, 'DTI_CMH_H001_01_01'), arguments)
+        eq_(commands, ['xnat-extract.py', 'qc.py'])
+        eq_(handled, False)   # so that the extract is tried again
+
+        del commands[:]
+        arguments['--no-qc'] = True
+        capture(watch.extract_exam,
+            os.path.join(TMPDIR, 'DTI_CMH_H001_01_01'), arguments)
+        eq_(commands, ['xnat-extract.py'])
+
+        # not an exam, so there's nothing to do
+        del commands[:]
+        eq_(capture(watch.extract_exam, os.path.join(TMPDIR, 'junk'),
+                    arguments)[0], True)
+        eq_(commands, [])
+    finally:
+        watch.run = old_run
+
+
+def make_archive(path, description="T1"):
+    """Makes an exam zip with a dicom with PatientName DTI_CMH_H001_01_01"""
+    dcmfile = path + '.dcm'
+    make_dicom(dcmfile, description=description)
+    zf = zipfile.ZipFile(path, 'w')
+    zf.write(dcmfile, 'exam/1/0.dcm')
+    zf.close()
+    os.remove(dcmfile)
+
+
+def test_linker():
+    zipdir = make_folder('zips', [])
+    dcmdir = make_folder('dcm', [])
+    lookup = os.path.join(TMPDIR, 'scans.csv')
+    open(lookup, 'w').write("source_name target_name\n"
+                            "2014_0126_FB001 DTI_CMH_FB001_01_01\n")
+    for name in ['2014_0126_FB001.zip', 'unlisted.zip', 'other.zip']:
+        make_archive(os.path.join(zipdir, name))
+    open(os.path.join(zipdir, 'bad.zip'), 'w').write('not a zip')
+    os.symlink(os.path.join(zipdir, 'other.zip'),
+               os.path.join(dcmdir, 'DTI_CMH_H002_01_01.zip'))
+
+    linker = watch.Linker(dcmdir, lookup)
+    listed = []
+    find_linked = watch.link.find_linked
+    watch.link.find_linked = lambda targetdir: listed.append(targetdir)
+    try:
+        for name in ['2014_0126_FB001.zip', 'unlisted.zip', 'other.zip',
+                     'notes.txt']:
+            eq_(capture(linker.link, os.path.join(zipdir, name))[0], True)
+        handled, output = capture(linker.link, os.path.join(zipdir, 'bad.zip'))
+        eq_(handled, False)
+        ok_("Can't read DICOM headers" in output, output)
+    finally:
+        watch.link.find_linked = find_linked
+
+    eq_(listed, [])   # the dcm folder was only listed when the linker started
+    eq_(sorted(os.listdir(dcmdir)), ['DTI_CMH_FB001_01_01.zip',
+        'DTI_CMH_H001_01_01.zip', 'DTI_CMH_H002_01_01.zip'])
+    eq_(os.path.realpath(os.path.join(dcmdir, 'DTI_CMH_H001_01_01.zip')),
+        os.path.realpath(os.path.join(zipdir, 'unlisted.zip')))
+
+    # the lookup table is read again once it changes
+    open(lookup, 'a').write("unlisted DTI_CMH_FB009_01_01\n")
+    os.utime(lookup, (0, 0))
+    eq_(linker.load_lookup()['unlisted'], ('DTI_CMH_FB009_01_01', {}))
+
+
+def test_linker_uses_the_scanid_field():
+    zipdir = make_folder('field-zips', [])
+    dcmdir = make_folder('field-dcm', [])
+    lookup = os.path.join(TMPDIR, 'field-scans.csv')
+    open(lookup, 'w').write("source_name target_name\n")
+    make_archive(os.path.join(zipdir, 'exam.zip'),
+                 description="DTI_CMH_H005_01_01")
+
+    linker = watch.Linker(dcmdir, lookup, 'SeriesDescription')
+    eq_(capture(linker.link, os.path.join(zipdir, 'exam.zip'))[0], True)
+    eq_(os.listdir(dcmdir), ['DTI_CMH_H005_01_01.zip'])
@@ -0,0 +1,127 @@
+from nose.tools import *
+from StringIO import StringIO
+import datman.exportinfo
+import datman.protocols
+import importlib
+import os
+import pandas as pd
+import shutil
+import sys
+import tempfile
+
+inventory = importlib.import_module('bin.inventory')
+
+TMPDIR = None
+
+EXPORTINFO = """\
+pattern  tag  export_nii  export_raw  count
+T1       T1   yes         no          1
+DTI      DTI  yes         yes         1
+"""
+
+FILES = [
+    'nii/SPN01_CMH_0001_01/SPN01_CMH_0001_01_01_T1_02_SagT1.nii.gz',
+    'nii/SPN01_CMH_0001_01/SPN01_CMH_0001_01_01_DTI_03_DTI.nii.gz',
+    'nii/SPN01_CMH_0001_01/SPN01_CMH_0001_01_01_DTI_03_DTI.bvec',
+    'nii/SPN01_CMH_0001_01/SPN01_CMH_0001_01_01_DTI_03_DTI.bval',
+    'nii/SPN01_CMH_0002_01/SPN01_CMH_0002_01_01_T1_02_SagT1.nii.gz',
+    'nii/SPN01_CMH_0002_01/SPN01_CMH_0002_01_01_T1_04_SagT1.nii.gz',
+    'nii/SPN01_CMH_0002_01/SPN01_CMH_0002_01_01_DTI_03_DTI.nii.gz',
+    'nii/SPN01_CMH_PHA_FBN0001/SPN01_CMH_PHA_FBN0001_T1_02_SagT1.nii.gz',
+    'raw/SPN01_CMH_0001_01/SPN01_CMH_0001_01_01_DTI_03_DTI.dat',
+    'raw/SPN01_CMH_0001_01/SPN01_CMH_0001_01_01_DTI_03_DTI.bvec',
+    'raw/SPN01_CMH_0001_01/SPN01_CMH_0001_01_01_DTI_03_DTI.bval',
+    'raw/SPN01_CMH_0003_01/SPN01_CMH_0003_01_01_DTI_03_DTI.dat',
+]
+
+
+def setup():
+    global TMPDIR
+    TMPDIR = tempfile.mkdtemp()
+    for path in FILES:
+        path = os.path.join(TMPDIR, 'data', path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, 'w').close()
+    open(os.path.join(TMPDIR, 'exportinfo.csv'), 'w').write(EXPORTINFO)
+
+
+def teardown():
+    shutil.rmtree(TMPDIR)
+
+
+def data(fmt):
+    return os.path.join(TMPDIR, 'data', fmt)
+
+
+def test_subjects_come_from_every_format():
+    eq_(inventory.find_subjects([data('nii'), data('raw')]),
+        ['SPN01_CMH_0001_01', 'SPN01_CMH_0002_01', 'SPN01_CMH_0003_01'])
+    eq_(inventory.find_subjects([data('nii'), data('raw')],
+                                set(['SPN01_CMH_0003_01'])),
+        ['SPN01_CMH_0003_01'])
+
+
+def find_problems(fmt, subjects, flagged=()):
+    exportinfo = datman.exportinfo.load(os.path.join(TMPDIR, 'exportinfo.csv'))
+    expected = datman.protocols.expected_counts(exportinfo.table)
+    problems = inventory.find_problems(data(fmt), fmt, exportinfo, expected,
+                                       list(flagged), subjects)
+    return [(row['subject'], row['tag'], row['problem'], row['count'])
+            for i, row in problems.iterrows()]
+
+
+def test_find_problems():
+    subjects = ['SPN01_CMH_0001_01', 'SPN01_CMH_0002_01', 'SPN01_CMH_0003_01']
+    eq_(sorted(find_problems('nii', subjects)), [
+        ('SPN01_CMH_0002_01', 'T1', 'extra', '1'),
+        ('SPN01_CMH_0003_01', 'DTI', 'missing', '1'),
+        ('SPN01_CMH_0003_01', 'T1', 'missing', '1')])
+
+    # the .bvec and .bval files aren't counted as series of their own
+    eq_(find_problems('raw', subjects), [
+        ('SPN01_CMH_0002_01', 'DTI', 'missing', '1')])
+
+
+
+def test_inventory_is_updated():
+    inventoryfile = os.path.join(TMPDIR, 'inventory.csv')
+    open(inventoryfile, 'w').write(
+        'subject,format,tag,series,problem,count\n'
+        'SPN01_CMH_0002_01,,,SPN01_CMH_0002_01_01_T1_04_SagT1,unusable,\n'
+        'SPN01_CMH_0001_01,nii,T1,,missing,1\n')
+
+    argv, sys.argv = sys.argv, ['inventory.py',
+        '--datadir', os.path.join(TMPDIR, 'data'),
+        '--exportinfo', os.path.join(TMPDIR, 'exportinfo.csv'),
+        '--inventory', inventoryfile]
+    try:
+        inventory.main()
+    finally:
+        sys.argv = argv
+
+    updated = pd.read_csv(inventoryfile, dtype=str).fillna('')
+    eq_(sorted(updated.values.tolist()), [
+        ['SPN01_CMH_0002_01', '', '', 'SPN01_CMH_0002_01_01_T1_04_SagT1',
+         'unusable', ''],
+        ['SPN01_CMH_0002_01', 'nii', 'T1', '', 'extra', '1'],
+        ['SPN01_CMH_0002_01', 'nii', 'T1', 'SPN01_CMH_0002_01_01_T1_04_SagT1',
+         'flagged', ''],
+        ['SPN01_CMH_0002_01', 'raw', 'DTI', '', 'missing', '1'],
+        ['SPN01_CMH_0003_01', 'nii', 'DTI', '', 'missing', '1'],
+        ['SPN01_CMH_0003_01', 'nii', 'T1', '', 'missing', '1']])
+
+
+def test_format_with_nothing_exported():
+    os.makedirs(data('dcm'))
+    exportinfo = datman.exportinfo.load(os.path.join(TMPDIR, 'exportinfo.csv'))
+    exportinfo = datman.exportinfo.ExportInfo(
+        exportinfo.table.assign(export_dcm='no'))
+    expected = datman.protocols.expected_counts(exportinfo.table)
+    try:
+        problems = inventory.find_problems(data('dcm'), 'dcm', exportinfo,
+            expected, [], ['SPN01_CMH_0001_01', 'SPN01_CMH_0002_01'])
+    finally:
+        os.rmdir(data('dcm'))
+    eq_(list(problems.columns), inventory.INVENTORY_COLUMNS)
+    eq_(len(problems), 0)
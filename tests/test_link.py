@@ -0,0 +1,134 @@
+from nose.tools import *
+from StringIO import StringIO
+import datman.utils
+import importlib
+import os
+import shutil
+import sys
+import tempfile
+import zipfile
+from test_datman_utils import make_dicom
+
+link = importlib.import_module('bin.link')
+
+TMPDIR = None
+
+LOOKUP = """\
+source_name       target_name           dicom_StudyID
+2014_0126_FB001   DTI_CMH_FB001_01_01
+2014_0126_FB002   DTI_CMH_FB002_01_01   512
+2014_0126_FB003   DTI_CMH_FB003_01_01   999
+2014_0126_FB004   <ignore>
+2014_0126_FB001   DTI_CMH_FB009_01_01
+"""
+
+
+def setup():
+    global TMPDIR
+    TMPDIR = tempfile.mkdtemp()
+    os.makedirs(os.path.join(TMPDIR, 'dcm'))
+    open(os.path.join(TMPDIR, 'scans.csv'), 'w').write(LOOKUP)
+    for name in ['2014_0126_FB001', '2014_0126_FB002', '2014_0126_FB003',
+                 '2014_0126_FB004', 'unlisted']:
+        make_archive(name)
+
+
+def teardown():
+    shutil.rmtree(TMPDIR)
+
+
+def make_archive(name):
+    """Makes an exam zip with a dicom with PatientName DTI_CMH_H001_01_01"""
+    dcmfile = os.path.join(TMPDIR, 'series.dcm')
+    make_dicom(dcmfile)
+    zf = zipfile.ZipFile(os.path.join(TMPDIR, name + '.zip'), 'w')
+    zf.write(dcmfile, 'exam/1/0.dcm')
+    zf.close()
+    os.remove(dcmfile)
+
+
+def archive(name):
+    return os.path.join(TMPDIR, name + '.zip')
+
+
+def make_plan(archives, targetdir=None):
+    """Makes a link plan, returning it, the archives read and the output"""
+    read = []
+
+    def get_archive_headers_many(paths, workers, stop_after_first):
+        read.extend(paths)
+        return datman.utils.get_archive_headers_many(paths, workers,
+                                                     stop_after_first)
+
+    lookup = link.load_lookup_table(os.path.join(TMPDIR, 'scans.csv'))
+    stdout, sys.stdout = sys.stdout, StringIO()
+    try:
+        plan = link.make_link_plan(archives,
+            targetdir or os.path.join(TMPDIR, 'dcm'), lookup, 'PatientName',
+            get_archive_headers_many)
+        return plan, read, sys.stdout.getvalue().splitlines()
+    finally:
+        sys.stdout = stdout
+
+
+def target(name):
+    return os.path.join(TMPDIR, 'dcm', name + '.zip')
+
+
+def test_load_lookup_table():
+    lookup = link.load_lookup_table(os.path.join(TMPDIR, 'scans.csv'))
+    eq_(sorted(lookup), ['2014_0126_FB001', '2014_0126_FB002',
+                         '2014_0126_FB003', '2014_0126_FB004'])
+    eq_(lookup['2014_0126_FB001'], ('DTI_CMH_FB001_01_01', {}))  # first used
+    eq_(lookup['2014_0126_FB002'], ('DTI_CMH_FB002_01_01',
+                                    {'StudyID': '512'}))
+    eq_(link.get_scanid_from_lookup_table(archive('2014_0126_FB004'), lookup),
+        ('<ignore>', {}))
+    eq_(link.get_scanid_from_lookup_table(archive('unlisted'), lookup),
+        (None, None))
+
+
+def test_listed_archive_is_linked_without_reading_it():
+    plan, read, output = make_plan([archive('2014_0126_FB001')])
+    eq_(plan, [(archive('2014_0126_FB001'), target('DTI_CMH_FB001_01_01'))])
+    eq_(read, [])
+
+
+def test_expected_headers_are_checked():
+    plan, read, output = make_plan([archive('2014_0126_FB002'),
+                                    archive('2014_0126_FB003')])
+    eq_(plan, [(archive('2014_0126_FB002'), target('DTI_CMH_FB002_01_01'))])
+    eq_(sorted(read), [archive('2014_0126_FB002'), archive('2014_0126_FB003')])
+    ok_("ERROR: {}: dicom field 'StudyID' = '512', expected '999'".format(
+        archive('2014_0126_FB003')) in output, output)
+
+
+def test_unlisted_archive_is_named_from_its_headers():
+    plan, read, output = make_plan([archive('unlisted'),
+                                    archive('2014_0126_FB004')])
+    eq_(plan, [(archive('unlisted'), target('DTI_CMH_H001_01_01'))])
+    eq_(read, [archive('unlisted')])   # ignored archives aren't read
+
+
+def test_existing_and_duplicate_targets_are_skipped():
+    targetdir = os.path.join(TMPDIR, 'existing')
+    os.makedirs(targetdir)
+    open(os.path.join(targetdir, 'DTI_CMH_FB001_01_01.zip'), 'w').close()
+    shutil.copy(archive('unlisted'), os.path.join(TMPDIR, 'unlisted2.zip'))
+
+    plan, read, output = make_plan([archive('2014_0126_FB001'),
+        archive('unlisted'), archive('unlisted2')], targetdir)
+    eq_(plan, [(archive('unlisted'),
+                os.path.join(targetdir, 'DTI_CMH_H001_01_01.zip'))])
+
+
+def test_unreadable_archive_error_is_reported():
+    bad = os.path.join(TMPDIR, 'bad.zip')
+    open(bad, 'w').write('not a zip')
+    plan, read, output = make_plan([bad, archive('unlisted')])
+    eq_(plan, [(archive('unlisted'), target('DTI_CMH_H001_01_01'))])
+    eq_(len(output), 1)
+    ok_(output[0].startswith("ERROR: {}: Can't read DICOM headers: ".format(
+        bad)), output)
+
+# vim: ts=4 sw=4:
@@ -0,0 +1,64 @@
+from nose.tools import *
+from nose.plugins.skip import SkipTest
+import datman.headerchecks
+import importlib
+import os
+import shutil
+import tempfile
+
+try:
+    qc = importlib.import_module('bin.qc')
+except ImportError:   # qc.py needs scipy, matplotlib, etc.
+    qc = None
+
+TMPDIR = None
+
+SERIES = 'DTI_CMH_H001_01_01_T1_02_SagT1'
+
+
+def setup():
+    global TMPDIR
+    TMPDIR = tempfile.mkdtemp()
+
+
+def teardown():
+    shutil.rmtree(TMPDIR)
+
+
+class Document(object):
+    """Collects the text (besides the title) of the figures added to it"""
+
+    def __init__(self):
+        self.texts = []
+
+    def add_figure(self, fig):
+        self.texts.append(fig.texts[-1].get_text())
+
+
+def header_checks(series, logdata, store=None):
+    doc = Document()
+    qc.add_header_checks(os.path.join(TMPDIR, series + '.nii.gz'), doc,
+                         logdata, store)
+    return doc.texts
+
+
+def test_header_checks_come_from_the_store_and_logs():
+    if not qc:
+        raise SkipTest("qc.py can't be imported")
+    store = datman.headerchecks.MismatchStore(
+        os.path.join(TMPDIR, datman.headerchecks.STORE_NAME))
+    store.update_exam('DTI_CMH_H001_01_01', {SERIES + '.dcm': [
+        datman.headerchecks.Mismatch(None, None, None, 'EchoTime', 30.0, 40.0,
+                                     5)]})
+    # logs are only read for exams the store hasn't checked
+    logdata = ['DTI_CMH_H001_01_02_DTI_03_DTI.dcm: header from the log\n']
+    try:
+        eq_(header_checks(SERIES, logdata, store), [
+            'header EchoTime, expected = 30.0, actual = 40.0 '
+            '[tolerance = 5]\n'])
+        eq_(header_checks('DTI_CMH_H001_01_02_DTI_03_DTI', logdata, store),
+            ['header from the log\n'])
+        eq_(header_checks('DTI_CMH_H001_01_01_RST_04_Rest', logdata, store),
+            [])
+    finally:
+        store.close()
@@ -0,0 +1,632 @@
+from dicom.dataset import Dataset, FileDataset
+from nose.tools import *
+from StringIO import StringIO
+import datman.checklist
+import datman.exportinfo
+import datman.utils
+import dicom
+import gzip
+import importlib
+import nibabel
+import numpy as np
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+
+extract = importlib.import_module('bin.xnat-extract')
+
+EXPORTINFO = """\
+pattern  tag  export_nii  export_nrrd  export_dcm  count
+T1       T1   yes         yes          yes         1
+Rest     RST  yes         no           no          1
+"""
+
+TMPDIR = None
+
+
+def setup():
+    global TMPDIR
+    TMPDIR = tempfile.mkdtemp()
+    # the test series are simple enough to export without dcm2nii, etc.
+    extract.IN_PROCESS = True
+
+
+def teardown():
+    shutil.rmtree(TMPDIR)
+    extract.IN_PROCESS = False
+
+
+def make_series(name, dicoms):
+    seriesdir = os.path.join(TMPDIR, name)
+    os.makedirs(seriesdir)
+    open(os.path.join(seriesdir, 'scan_1_catalog.xml'), 'w').write('<xml/>')
+    for i in range(dicoms):
+        open(os.path.join(seriesdir, '{}.dcm'.format(i)), 'w').write('')
+    return seriesdir
+
+
+def make_nifti(name, shape):
+    path = os.path.join(TMPDIR, name)
+    nibabel.save(nibabel.Nifti1Image(np.zeros(shape), np.eye(4)), path)
+    return path
+
+
+def test_verify_nii():
+    nifti = make_nifti('t1.nii.gz', (8, 8, 5))
+    extract.verify_nii(nifti, make_series('slices', 5))
+    extract.verify_nii(nifti, make_series('multiframe', 1))
+
+    nifti = make_nifti('fmri.nii.gz', (8, 8, 5, 3))
+    extract.verify_nii(nifti, make_series('fmri', 15))
+    extract.verify_nii(nifti, make_series('mosaic', 3))
+
+
+@raises(ValueError)
+def test_verify_nii_missing_slices():
+    nifti = make_nifti('truncated.nii.gz', (8, 8, 5))
+    extract.verify_nii(nifti, make_series('truncated', 4))
+
+
+def test_export_is_renamed_into_place():
+    seriesdir = make_series('dcm', 0)
+    dcmfile = os.path.join(seriesdir, 'IM0001')
+    open(dcmfile, 'w').write('DICM')
+    header = type('Header', (object,), {'filename': dcmfile})()
+
+    outputdir = os.path.join(TMPDIR, 'output')
+    os.makedirs(outputdir)
+    extract.export_dcm_command(seriesdir, outputdir, 'stem', header)
+    eq_(os.listdir(outputdir), ['stem.dcm'])
+
+
+@raises(ValueError)
+def test_missing_output_fails_export():
+    outputdir = os.path.join(TMPDIR, 'missing')
+    os.makedirs(outputdir)
+    try:
+        extract.export_mnc_command(make_series('mnc', 3), outputdir, 'stem')
+    finally:
+        eq_(os.listdir(outputdir), [])   # temporary folder removed
+
+
+def capture(func, *args):
+    """Calls func(*args), returning its result and the lines it printed"""
+    stdout, sys.stdout = sys.stdout, StringIO()
+    try:
+        return func(*args), sys.stdout.getvalue().splitlines()
+    finally:
+        sys.stdout = stdout
+
+
+def run_tasks(tasks, jobs):
+    """Runs export tasks, returning the failed tasks and the output"""
+    return capture(extract.run_tasks, tasks, jobs)
+
+
+class Tracker(object):
+    """Tracks the most exports of each format running at once"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = {}
+        self.most = {}
+        self.finished = []
+
+    def export(self, name, fmt, delay):
+        with self.lock:
+            self.running[fmt] = self.running.get(fmt, 0) + 1
+            self.most[fmt] = max(self.most.get(fmt, 0), self.running[fmt])
+        time.sleep(delay)
+        extract.log("exported {}".format(name))
+        with self.lock:
+            self.running[fmt] -= 1
+            self.finished.append(name)
+
+
+def test_format_jobs_limits_conversions():
+    tracker = Tracker()
+    tasks = [(fmt, tracker.export, (name, fmt, 0.05))
+             for name in range(4) for fmt in ['nrrd', 'nii']]
+    extract.FORMAT_LIMITS['nrrd'] = 1
+    try:
+        failed, output = run_tasks(tasks, jobs=8)
+    finally:
+        extract.FORMAT_LIMITS.clear()
+    eq_(failed, [])
+    eq_(tracker.most['nrrd'], 1)
+    ok_(tracker.most['nii'] > 1)
+
+
+def test_limited_format_does_not_hold_up_the_others():
+    tracker = Tracker()
+    tasks = [('nrrd', tracker.export, ('nrrd{}'.format(i), 'nrrd', 0.1))
+             for i in range(3)]
+    tasks += [('nii', tracker.export, ('nii{}'.format(i), 'nii', 0.01))
+              for i in range(2)]
+    extract.FORMAT_LIMITS['nrrd'] = 1
+    try:
+        failed, output = run_tasks(tasks, jobs=2)
+    finally:
+        extract.FORMAT_LIMITS.clear()
+    eq_(failed, [])
+    eq_(tracker.most, {'nrrd': 1, 'nii': 1})
+    eq_(tracker.finished, ['nii0', 'nii1', 'nrrd0', 'nrrd1', 'nrrd2'])
+    eq_(output, ["exported {}".format(task[2][0]) for task in tasks])
+
+
+def test_task_output_is_shown_in_order():
+    tracker = Tracker()
+    tasks = [('nii', tracker.export, (name, 'nii', 0.1 - name * 0.03))
+             for name in range(4)]
+    failed, output = run_tasks(tasks, jobs=4)
+    eq_(output, ["exported {}".format(name) for name in range(4)])
+
+
+def test_failed_task_does_not_stop_the_others():
+    def fail(name, fmt, delay):
+        extract.log("starting {}".format(name))
+        raise ValueError("conversion failed")
+
+    tracker = Tracker()
+    tasks = [('nii', tracker.export, (0, 'nii', 0.05)),
+             ('nii', fail, (1, 'nii', 0)),
+             ('nii', tracker.export, (2, 'nii', 0.05))]
+    failed, output = run_tasks(tasks, jobs=2)
+    eq_(failed, [tasks[1]])
+    eq_(output, ["exported 0", "starting 1",
+                 "ERROR: Exporting 1 to nii failed: conversion failed",
+                 "exported 2"])
+
+
+def make_dicom(path, description, series, position, pixels, instance=1):
+    meta = Dataset()
+    meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
+    meta.MediaStorageSOPInstanceUID = '1.2.3.{}.{}'.format(series, instance)
+    meta.ImplementationClassUID = '1.2.3.4'
+    meta.TransferSyntaxUID = '1.2.840.10008.1.2.1'  # explicit VR LE
+
+    ds = FileDataset(path, {}, file_meta=meta, preamble="\0" * 128)
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+    ds.PatientName = "DTI_CMH_H001_01_01"
+    ds.SeriesNumber = series
+    ds.SeriesDescription = description
+    ds.InstanceNumber = instance
+    ds.ImageOrientationPatient = ['1', '0', '0', '0', '1', '0']
+    ds.ImagePositionPatient = [str(n) for n in position]
+    ds.PixelSpacing = ['2', '3']
+    ds.SliceThickness = '4'
+    ds.Rows, ds.Columns = pixels.shape
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 1
+    ds.PixelData = pixels.astype('<i2').tostring()
+    ds[dicom.tag.Tag(0x7fe0, 0x0010)].VR = 'OW'
+    ds.save_as(path)
+
+
+def make_dicom_series(seriesdir, description="T1", series=1, slices=5,
+                      positions=None):
+    """
+    Writes a series of 3 row x 4 column slices, 4mm apart, in which pixel
+    (row j, column i) of slice k is k * 100 + j * 10 + i. The files are named
+    in the reverse of slice order.
+    """
+    if not os.path.exists(seriesdir):
+        os.makedirs(seriesdir)
+    open(os.path.join(seriesdir, 'scan_1_catalog.xml'), 'w').write('<xml/>')
+    positions = positions or [(10, 20, 4 * k) for k in range(slices)]
+    for k, position in enumerate(positions):
+        pixels = k * 100 + np.arange(3)[:, np.newaxis] * 10 + np.arange(4)
+        make_dicom(os.path.join(seriesdir, '{}.dcm'.format(slices - k)),
+                   description, series, position, pixels, instance=k + 1)
+    return seriesdir
+
+
+def expected_data(slices=5):
+    i, j, k = np.meshgrid(np.arange(4), np.arange(3), np.arange(slices),
+                          indexing='ij')
+    return k * 100 + j * 10 + i
+
+
+def load_exportinfo(table=EXPORTINFO):
+    path = os.path.join(TMPDIR, 'exportinfo.csv')
+    open(path, 'w').write(table)
+    return datman.exportinfo.load(path)
+
+
+def read_nrrd(path):
+    data = open(path, 'rb').read()
+    header, body = data.split('\n\n', 1)
+    fields = dict(line.split(': ', 1) for line in header.splitlines()[1:])
+    shape = [int(n) for n in fields['sizes'].split()]
+    pixels = np.frombuffer(gzip.GzipFile(fileobj=StringIO(body)).read(),
+                           dtype='<i2').reshape(shape, order='F')
+    return fields, pixels
+
+
+def test_decode_series():
+    seriesdir = make_dicom_series(os.path.join(TMPDIR, 'decode'))
+    volume = extract.decode_series(seriesdir)
+    eq_(volume.data.shape, (4, 3, 5))
+    ok_((volume.data == expected_data()).all())
+    ok_(np.allclose(volume.affine, [[3, 0, 0, 10],
+                                    [0, 2, 0, 20],
+                                    [0, 0, 4, 0],
+                                    [0, 0, 0, 1]]))
+
+
+@raises(ValueError)
+def test_decode_multiple_volumes():
+    seriesdir = make_dicom_series(os.path.join(TMPDIR, 'volumes'),
+        positions=[(0, 0, 0), (0, 0, 4), (0, 0, 0), (0, 0, 4)])
+    extract.decode_series(seriesdir)
+
+
+def test_series_is_decoded_once_for_its_exports():
+    seriesdir = make_dicom_series(os.path.join(TMPDIR, 'once'))
+    outputdir = os.path.join(TMPDIR, 'once-output')
+    os.makedirs(outputdir)
+
+    decoded = []
+    decode_series = extract.decode_series
+    extract.decode_series = lambda path: decoded.append(path) or \
+                                         decode_series(path)
+    try:
+        volume = extract.SeriesVolume()
+        volume.reserve(2)
+        for exporter in [extract.export_nii_command,
+                         extract.export_nrrd_command]:
+            extract.export(seriesdir, outputdir, 'stem', exporter,
+                           volume=volume)
+    finally:
+        extract.decode_series = decode_series
+
+    eq_(decoded, [seriesdir])
+    eq_(volume.volume, None)   # dropped once both exports are done
+    eq_(sorted(os.listdir(outputdir)), ['stem.nii.gz', 'stem.nrrd'])
+
+    image = nibabel.load(os.path.join(outputdir, 'stem.nii.gz'))
+    ok_((image.get_data() == expected_data()).all())
+    ok_(np.allclose(image.affine, [[-3, 0, 0, -10],
+                                   [0, -2, 0, -20],
+                                   [0, 0, 4, 0],
+                                   [0, 0, 0, 1]]))
+
+    fields, pixels = read_nrrd(os.path.join(outputdir, 'stem.nrrd'))
+    eq_(fields['space'], 'left-posterior-superior')
+    eq_(fields['space directions'], '(3.0,0.0,0.0) (0.0,2.0,0.0) (0.0,0.0,4.0)')
+    eq_(fields['space origin'], '(10.0,20.0,0.0)')
+    ok_((pixels == expected_data()).all())
+
+
+def test_series_that_cant_be_decoded_is_left_to_converters():
+    seriesdir = make_dicom_series(os.path.join(TMPDIR, 'undecodable'),
+        positions=[(0, 0, 0), (0, 0, 4), (0, 0, 0), (0, 0, 4)])
+    volume = extract.SeriesVolume()
+    eq_(volume.load(seriesdir), None)
+
+
+def test_exports_share_the_series_header_and_volume():
+    exportinfo = load_exportinfo()
+    header = {'SeriesDescription': 'Sag-T1', 'SeriesNumber': 3}
+    tasks = extract.export_series(exportinfo, 'series', header,
+        exportinfo.formats, 'DTI_CMH_H001_01', 'DTI_CMH_H001_01_01',
+        os.path.join(TMPDIR, 'shared'), datman.checklist.load())
+
+    eq_([fmt for fmt, exporter, args in tasks], ['nii', 'nrrd', 'dcm'])
+    ok_(all(args[4] is header for fmt, exporter, args in tasks))
+    volume = tasks[0][2][5]
+    ok_(all(args[5] is volume for fmt, exporter, args in tasks))
+    eq_(volume.uses, 3)
+
+
+def test_external_converters_are_the_default():
+    exportinfo = load_exportinfo()
+    header = {'SeriesDescription': 'Sag-T1', 'SeriesNumber': 3}
+    extract.IN_PROCESS = False
+    try:
+        tasks = extract.export_series(exportinfo, 'series', header,
+            exportinfo.formats, 'DTI_CMH_H001_01', 'DTI_CMH_H001_01_01',
+            os.path.join(TMPDIR, 'external'), datman.checklist.load())
+    finally:
+        extract.IN_PROCESS = True
+    eq_([(fmt, args[5]) for fmt, exporter, args in tasks],
+        [('nii', None), ('nrrd', None), ('dcm', None)])
+
+
+def test_headers_are_read_once_per_series():
+    examdir = os.path.join(TMPDIR, 'headers', 'DTI_CMH_H001_01_01')
+    for series, description in [(1, 'Sag-T1'), (2, 'Resting')]:
+        make_dicom_series(os.path.join(examdir, 'SCANS', str(series),
+                                       'DICOM'), description, series)
+    exportinfo = load_exportinfo()
+
+    reads = []
+    get_archive_headers = extract.get_archive_headers
+    extract.get_archive_headers = lambda path, **kwargs: reads.append(path) \
+                                  or get_archive_headers(path, **kwargs)
+    try:
+        tasks, exam = extract.extract_archive(exportinfo, examdir,
+            os.path.join(TMPDIR, 'headers', 'data'), datman.checklist.load())
+    finally:
+        extract.get_archive_headers = get_archive_headers
+
+    eq_(sorted(reads), [os.path.join(examdir, 'SCANS', '1', 'DICOM'),
+                        os.path.join(examdir, 'SCANS', '2', 'DICOM')])
+    eq_([(fmt, os.path.basename(args[0])) for fmt, exporter, args in tasks],
+        [('nii', 'DICOM'), ('nrrd', 'DICOM'), ('dcm', 'DICOM'),
+         ('nii', 'DICOM'), ('resources', 'DTI_CMH_H001_01_01')])
+
+
+def make_exam(name, subject='H001'):
+    """Makes an exam folder with a T1 series and a resting state series"""
+    examdir = os.path.join(TMPDIR, name, 'DTI_CMH_{}_01_01'.format(subject))
+    for series, description in [(1, 'Sag-T1'), (2, 'Resting')]:
+        make_dicom_series(os.path.join(examdir, 'SCANS', str(series),
+                                       'DICOM'), description, series)
+    return examdir
+
+
+def export_exam(examdir, datadir, exportinfo=None):
+    """Exports an exam as xnat-extract.py does, returning the tasks run"""
+    tasks, exam = extract.extract_archive(exportinfo or load_exportinfo(),
+        examdir, datadir, datman.checklist.load())
+    failed, output = run_tasks(tasks, 1)
+    eq_(failed, [])
+    if exam:
+        extract.update_manifest(exam, set())
+    return [(fmt, os.path.relpath(args[0], examdir))
+            for fmt, exporter, args in tasks if fmt != 'resources']
+
+
+def test_unchanged_series_are_skipped():
+    examdir = make_exam('unchanged')
+    datadir = os.path.join(TMPDIR, 'unchanged', 'data')
+    eq_(export_exam(examdir, datadir),
+        [('nii', 'SCANS/1/DICOM'), ('nrrd', 'SCANS/1/DICOM'),
+         ('dcm', 'SCANS/1/DICOM'), ('nii', 'SCANS/2/DICOM')])
+    ok_(os.path.exists(os.path.join(datadir, 'manifests',
+                                    'DTI_CMH_H001_01_01.json')))
+
+    decode_series = extract.decode_series
+    extract.decode_series = None   # nothing should be read
+    try:
+        eq_(export_exam(examdir, datadir), [])
+    finally:
+        extract.decode_series = decode_series
+
+
+def test_changed_series_is_exported_again():
+    examdir = make_exam('changed')
+    datadir = os.path.join(TMPDIR, 'changed', 'data')
+    export_exam(examdir, datadir)
+    nifti = os.path.join(datadir, 'nii', 'DTI_CMH_H001_01',
+                         'DTI_CMH_H001_01_01_T1_01_Sag-T1.nii.gz')
+    eq_(nibabel.load(nifti).shape, (4, 3, 5))
+
+    # re-archived with another slice
+    make_dicom_series(os.path.join(examdir, 'SCANS', '1', 'DICOM'),
+                      'Sag-T1', 1, slices=6)
+    eq_(export_exam(examdir, datadir),
+        [('nii', 'SCANS/1/DICOM'), ('nrrd', 'SCANS/1/DICOM'),
+         ('dcm', 'SCANS/1/DICOM')])
+    eq_(nibabel.load(nifti).shape, (4, 3, 6))
+
+
+def test_stale_outputs_are_removed():
+    examdir = make_exam('stale')
+    datadir = os.path.join(TMPDIR, 'stale', 'data')
+    export_exam(examdir, datadir)
+    outputdir = os.path.join(datadir, 'nrrd', 'DTI_CMH_H001_01')
+    nrrd = os.path.join(outputdir, 'DTI_CMH_H001_01_01_T1_01_Sag-T1.nrrd')
+    open(nrrd, 'a').write('truncated')
+
+    tasks, exam = extract.extract_archive(load_exportinfo(), examdir,
+        datadir, datman.checklist.load())
+    eq_(os.listdir(outputdir), [])   # the changed output was removed
+    eq_([fmt for fmt, exporter, args in tasks],
+        ['nii', 'nrrd', 'dcm', 'resources'])
+
+
+def test_remove_stale_outputs():
+    datadir = os.path.join(TMPDIR, 'remove')
+    os.makedirs(datadir)
+    outputs = {}
+    for name in ['a.nii.gz', 'b.nrrd']:
+        path = os.path.join(datadir, name)
+        open(path, 'w').write(name)
+        outputs[name] = datman.utils.fingerprint(path)
+    record = {'fingerprint': 'series', 'outputs': outputs}
+
+    ok_(not extract.remove_stale_outputs(record, 'series', datadir))
+    eq_(sorted(os.listdir(datadir)), ['a.nii.gz', 'b.nrrd'])
+
+    os.remove(os.path.join(datadir, 'b.nrrd'))
+    ok_(extract.remove_stale_outputs(record, 'series', datadir))
+    eq_(sorted(os.listdir(datadir)), ['a.nii.gz'])
+
+    # the series has changed, so all of its outputs are out of date
+    ok_(extract.remove_stale_outputs(record, 'changed', datadir))
+    eq_(os.listdir(datadir), [])
+
+
+def test_changed_settings_invalidate_the_manifest():
+    examdir = make_exam('settings')
+    datadir = os.path.join(TMPDIR, 'settings', 'data')
+    export_exam(examdir, datadir)
+    manifestfile = os.path.join(datadir, 'manifests',
+                                'DTI_CMH_H001_01_01.json')
+    settings = extract.get_settings(load_exportinfo())
+    ok_(extract.read_manifest(manifestfile, settings)['series'])
+
+    exportinfo = load_exportinfo(EXPORTINFO.replace(
+        'RST  yes         no ', 'RST  yes         yes'))
+    ok_(extract.get_settings(exportinfo) != settings)
+    eq_(extract.read_manifest(manifestfile,
+                              extract.get_settings(exportinfo))['series'], {})
+    eq_(export_exam(examdir, datadir, exportinfo),
+        [('nii', 'SCANS/1/DICOM'), ('nrrd', 'SCANS/1/DICOM'),
+         ('dcm', 'SCANS/1/DICOM'), ('nii', 'SCANS/2/DICOM'),
+         ('nrrd', 'SCANS/2/DICOM')])
+
+
+def make_exam_archive(examdir, ext):
+    """Archives an exam folder, as a zip or tar archive with extension ext"""
+    path = examdir + ext
+    parent = os.path.dirname(examdir)
+    if ext == '.zip':
+        archive = zipfile.ZipFile(path, 'w')
+        add = archive.write
+    else:
+        archive = tarfile.open(path, 'w:gz' if 'gz' in ext else 'w')
+        add = archive.add
+    for dirpath, dirs, files in os.walk(examdir):
+        for f in sorted(files):
+            add(os.path.join(dirpath, f),
+                os.path.relpath(os.path.join(dirpath, f), parent))
+    archive.close()
+    return path
+
+
+def use_scratch(name):
+    scratch = os.path.join(TMPDIR, name, 'scratch')
+    os.makedirs(scratch)
+    extract.SCRATCH = scratch
+    return scratch
+
+
+def check_archive_export(ext):
+    examdir = make_exam('archive' + ext, 'H00' + str(len(ext)))
+    archive = make_exam_archive(examdir, ext)
+    shutil.rmtree(examdir)
+    datadir = os.path.join(TMPDIR, 'archive' + ext, 'data')
+    scratch = use_scratch('archive' + ext)
+    exam = os.path.basename(examdir)
+    try:
+        eq_(sorted(export_exam(archive, datadir)),
+            [('dcm', exam + '/SCANS/1/DICOM'), ('nii', exam + '/SCANS/1/DICOM'),
+             ('nii', exam + '/SCANS/2/DICOM'),
+             ('nrrd', exam + '/SCANS/1/DICOM')])
+    finally:
+        extract.SCRATCH = None
+
+    stem = os.path.join(exam[:-3], exam + '_T1_01_Sag-T1')
+    for fmt, ext in [('nii', '.nii.gz'), ('nrrd', '.nrrd'), ('dcm', '.dcm')]:
+        ok_(os.path.exists(os.path.join(datadir, fmt, stem + ext)))
+    eq_(nibabel.load(os.path.join(datadir, 'nii', stem + '.nii.gz')).shape,
+        (4, 3, 5))
+    eq_(os.listdir(scratch), [])   # each series removed once exported
+    eq_(export_exam(archive, datadir), [])
+
+
+def test_export_from_archives():
+    for ext in ['.zip', '.tar', '.tar.gz', '.tgz']:
+        yield check_archive_export, ext
+
+
+def test_unused_archive_is_closed():
+    examdir = make_exam('unused')
+    archive = make_exam_archive(examdir, '.tgz')
+    opened = []
+
+    class ExamArchive(extract.ExamArchive):
+        def __init__(self, *args):
+            super(ExamArchive, self).__init__(*args)
+            opened.append(self)
+
+    exam_archive, extract.ExamArchive = extract.ExamArchive, ExamArchive
+    try:
+        tasks, exam = extract.extract_archive(
+            load_exportinfo(EXPORTINFO.replace('T1 ', 'XX ')
+                                      .replace('Rest', 'None')),
+            archive, os.path.join(TMPDIR, 'unused', 'data'),
+            datman.checklist.load())
+    finally:
+        extract.ExamArchive = exam_archive
+    eq_(tasks, [])
+    eq_((opened[0].tar, opened[0].folders), (None, None))
+
+
+def test_archive_is_closed_until_its_exports_run():
+    examdir = make_exam('reopened')
+    archive = make_exam_archive(examdir, '.tgz')
+    datadir = os.path.join(TMPDIR, 'reopened', 'data')
+    opened = []
+
+    class ExamArchive(extract.ExamArchive):
+        def open(self):
+            if not self.tar:
+                opened.append(self)
+            super(ExamArchive, self).open()
+
+    exam_archive, extract.ExamArchive = extract.ExamArchive, ExamArchive
+    try:
+        tasks, exam = extract.extract_archive(load_exportinfo(), archive,
+            datadir, datman.checklist.load())
+        eq_(len(opened), 1)
+        eq_(opened[0].tar, None)   # closed once planned
+
+        failed, output = run_tasks(tasks, jobs=2)
+    finally:
+        extract.ExamArchive = exam_archive
+    eq_(failed, [])
+    eq_(len(opened), 2)          # opened again by the first export
+    eq_(opened[1].tar, None)     # and closed by the last
+    ok_(os.path.exists(os.path.join(datadir, 'nii', 'DTI_CMH_H001_01',
+        'DTI_CMH_H001_01_01_T1_01_Sag-T1.nii.gz')))
+
+
+def test_dry_run_does_not_unpack_archives():
+    examdir = make_exam('dryrun')
+    archive = make_exam_archive(examdir, '.zip')
+    datadir = os.path.join(TMPDIR, 'dryrun', 'data')
+    scratch = use_scratch('dryrun')
+    extract.DRYRUN = True
+    try:
+        tasks, exam = extract.extract_archive(load_exportinfo(), archive,
+                                              datadir, datman.checklist.load())
+        eq_(len(tasks), 4)
+        eq_(run_tasks(tasks, 1)[0], [])
+    finally:
+        extract.DRYRUN = False
+        extract.SCRATCH = None
+    eq_(os.listdir(scratch), [])
+    ok_(not os.path.exists(datadir))
+
+
+def test_bad_archive_does_not_stop_the_others():
+    good = make_exam_archive(make_exam('bad', 'H001'), '.zip')
+    bad = make_exam_archive(make_exam('bad', 'H002'), '.tgz')
+    data = open(bad, 'rb').read()
+    open(bad, 'wb').write(data[:len(data) // 2])   # truncated
+    datadir = os.path.join(TMPDIR, 'bad', 'data')
+    load_exportinfo()
+
+    def main():
+        try:
+            extract.main()
+        except SystemExit, e:
+            return e.code
+
+    argv, sys.argv = sys.argv, ['xnat-extract.py', '--in-process',
+        '--datadir', datadir,
+        '--exportinfo', os.path.join(TMPDIR, 'exportinfo.csv'), bad, good]
+    try:
+        code, output = capture(main)
+    finally:
+        sys.argv = argv
+        extract.SCRATCH = None
+    eq_(code, 1)
+    ok_(output[0].startswith("ERROR: Exporting {} failed".format(bad)),
+        output)
+    ok_(os.path.exists(os.path.join(datadir, 'nii', 'DTI_CMH_H001_01',
+        'DTI_CMH_H001_01_01_T1_01_Sag-T1.nii.gz')))
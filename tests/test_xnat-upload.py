@@ -0,0 +1,124 @@
+from nose.tools import *
+import BaseHTTPServer
+import importlib
+import os
+import shutil
+import tempfile
+import threading
+import zipfile
+
+upload = importlib.import_module('bin.xnat-upload')
+upload.BACKOFF = 0
+
+TMPDIR = None
+ARCHIVE = None
+
+
+class StubXNAT(BaseHTTPServer.HTTPServer):
+    """Records the requests made to it, failing some of them"""
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+        self.requests = []
+        self.failures = {}  # path prefix -> number of times to fail with 502
+        self.lock = threading.Lock()
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def handle_request(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        server = self.server
+        with server.lock:
+            server.requests.append((self.command, self.path, body))
+            status = 200
+            for prefix, count in server.failures.items():
+                if self.path.startswith(prefix) and count:
+                    server.failures[prefix] -= 1
+                    status = 502
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    do_PUT = do_POST = handle_request
+
+    def log_message(self, *args):
+        pass
+
+
+def setup():
+    global TMPDIR, ARCHIVE
+    TMPDIR = tempfile.mkdtemp()
+    ARCHIVE = os.path.join(TMPDIR, 'DTI_CMH_H001_01_01.zip')
+    zf = zipfile.ZipFile(ARCHIVE, 'w')
+    zf.writestr('exam/1/0.dcm', 'not really a dicom')
+    zf.writestr('exam/1/IM0001', '\0' * 128 + 'DICM' + 'header')
+    zf.writestr('exam/notes.txt', 'notes')
+    zf.writestr('exam/physio.log', 'physio')
+    zf.writestr('exam/empty/', '')
+    zf.close()
+
+
+def teardown():
+    shutil.rmtree(TMPDIR)
+
+
+def serve():
+    server = StubXNAT()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:{}'.format(server.server_port)
+
+
+def test_find_non_dicoms():
+    eq_(sorted(upload.find_non_dicoms(zipfile.ZipFile(ARCHIVE))),
+        ['exam/notes.txt', 'exam/physio.log'])
+
+
+def test_upload():
+    server, url = serve()
+    try:
+        session = upload.make_session(('user', 'pass'), jobs=2)
+        upload.upload(session, url, 'DTI', 'DTI_CMH_H001_01_01', ARCHIVE,
+                      jobs=2)
+    finally:
+        server.shutdown()
+
+    eq_([r[0] for r in server.requests[:2]], ['PUT', 'POST'])
+    eq_(server.requests[1][2], open(ARCHIVE, 'rb').read())
+    attached = sorted((r[1].split('/files/')[1], r[2])
+                      for r in server.requests[2:])
+    eq_(attached, [('exam/notes.txt?inbody=true', 'notes'),
+                   ('exam/physio.log?inbody=true', 'physio')])
+
+
+def test_upload_retries_failed_request_only():
+    server, url = serve()
+    server.failures['/data/services/import'] = 2
+    try:
+        session = upload.make_session(('user', 'pass'))
+        upload.upload(session, url, 'DTI', 'DTI_CMH_H001_01_01', ARCHIVE,
+                      retries=2)
+    finally:
+        server.shutdown()
+
+    paths = [r[1].split('?')[0] for r in server.requests]
+    eq_(paths.count('/REST/projects/DTI/subjects/DTI_CMH_H001_01_01'), 1)
+    eq_(paths.count('/data/services/import'), 3)
+    for method, path, body in server.requests:
+        if path.startswith('/data/services/import'):
+            eq_(body, open(ARCHIVE, 'rb').read())
+
+
+@raises(upload.requests.exceptions.HTTPError)
+def test_upload_gives_up():
+    server, url = serve()
+    server.failures['/data/services/import'] = 3
+    try:
+        session = upload.make_session(('user', 'pass'))
+        upload.upload(session, url, 'DTI', 'DTI_CMH_H001_01_01', ARCHIVE,
+                      retries=2)
+    finally:
+        server.shutdown()